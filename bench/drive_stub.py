@@ -0,0 +1,210 @@
+"""
+ベンチマーク用のGoogle Drive v3スタブサーバー
+OAuthトークン、files / permissions / changes、レジューマブルアップロードの
+最小限の挙動を模倣する。受信したデータは保存せずバイト数だけ数える
+"""
+import asyncio
+import itertools
+import json
+import re
+import threading
+from urllib.parse import urlsplit
+
+import httplib2
+from aiohttp import web
+
+BLOCK = 1024 * 1024
+
+class DriveStub:
+    """ローカルで動くDrive APIの代役"""
+
+    def __init__(self, port: int = 0, upload_mbps: float = 0, latency_sec: float = 0.02):
+        self.port = port
+        self.upload_mbps = upload_mbps  # 受信速度の上限(MB/s, 0で無制限)
+        self.latency = latency_sec      # APIごとの擬似レイテンシ
+        self.files: dict[str, dict] = {}
+        self.sessions: dict[str, dict] = {}
+        self.calls: dict[str, int] = {}
+        self.bytes_received = 0
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.images: dict[str, int] = {}  # /img/<name> で返す画像のサイズ
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 * BLOCK)
+        app.router.add_post("/token", self.token)
+        app.router.add_post("/upload/drive/v3/files", self.start_upload)
+        app.router.add_put("/upload/session/{sid}", self.put_chunk)
+        app.router.add_get("/drive/v3/files", self.list_files)
+        app.router.add_get("/drive/v3/files/{fid}", self.get_file)
+        app.router.add_delete("/drive/v3/files/{fid}", self.delete_file)
+        app.router.add_post("/drive/v3/files", self.create_file)
+        app.router.add_post("/drive/v3/files/{fid}/permissions", self.create_permission)
+        app.router.add_get("/drive/v3/changes/startPageToken", self.start_page_token)
+        app.router.add_get("/drive/v3/changes", self.list_changes)
+        app.router.add_post("/batch/drive/v3", self.batch)
+        app.router.add_get("/img/{name}", self.image)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def start_in_thread(self):
+        """専用スレッドのイベントループで起動する（ボット側のループが塞がってもスタブは応答し続ける）"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name="drive-stub", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _delay(self, nbytes: int = 0):
+        wait = self.latency
+        if self.upload_mbps > 0 and nbytes:
+            wait += nbytes / (self.upload_mbps * BLOCK)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def token(self, request):
+        self._count("token")
+        return web.json_response({"access_token": "bench-token", "expires_in": 3600, "token_type": "Bearer"})
+
+    def _new_file(self, metadata: dict, size: int = 0) -> dict:
+        fid = f"file{next(self._ids)}"
+        f = {"id": fid, "name": metadata.get("name", fid), "parents": metadata.get("parents", []),
+             "mimeType": metadata.get("mimeType", "application/octet-stream"), "size": size, "trashed": False}
+        self.files[fid] = f
+        return f
+
+    async def start_upload(self, request):
+        self._count("upload_start")
+        body = await request.read()
+        metadata = json.loads(body) if body else {}
+        sid = f"s{next(self._ids)}"
+        self.sessions[sid] = {"metadata": metadata, "received": 0}
+        await self._delay()
+        return web.Response(status=200, headers={"Location": f"{self.base_url}/upload/session/{sid}"})
+
+    async def put_chunk(self, request):
+        self._count("upload_chunk")
+        session = self.sessions.get(request.match_info["sid"])
+        if session is None:
+            return web.Response(status=404)
+        data = await request.read()
+        await self._delay(len(data))
+        m = re.match(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", request.headers.get("Content-Range", ""))
+        if data and m and m.group(1):
+            session["received"] = int(m.group(2)) + 1
+            self.bytes_received += len(data)
+        total = m.group(3) if m else "*"
+        if total != "*" and session["received"] >= int(total):
+            f = self._new_file(session["metadata"], session["received"])
+            return web.json_response({"id": f["id"]})
+        headers = {"Range": f"bytes=0-{session['received'] - 1}"} if session["received"] else {}
+        return web.Response(status=308, headers=headers)
+
+    async def create_file(self, request):
+        self._count("files_create")
+        await self._delay()
+        f = self._new_file(await request.json())
+        return web.json_response({"id": f["id"]})
+
+    async def list_files(self, request):
+        self._count("files_list")
+        await self._delay()
+        return web.json_response({"files": [
+            {"id": f["id"], "md5Checksum": f.get("md5Checksum")} for f in self.files.values() if not f["trashed"]
+        ]})
+
+    async def get_file(self, request):
+        self._count("files_get")
+        await self._delay()
+        f = self.files.get(request.match_info["fid"])
+        if f is None:
+            return web.json_response({"error": {"code": 404, "message": "File not found"}}, status=404)
+        return web.json_response(f)
+
+    async def delete_file(self, request):
+        self._count("files_delete")
+        self.files.pop(request.match_info["fid"], None)
+        return web.Response(status=204)
+
+    async def create_permission(self, request):
+        self._count("permissions_create")
+        await self._delay()
+        return web.json_response({"id": "anyoneWithLink", "role": "reader", "type": "anyone"})
+
+    async def start_page_token(self, request):
+        self._count("changes_start")
+        return web.json_response({"startPageToken": "1"})
+
+    async def list_changes(self, request):
+        self._count("changes_list")
+        return web.json_response({"newStartPageToken": "1", "changes": []})
+
+    async def batch(self, request):
+        """multipart/mixed のバッチリクエストを各パートごとに成功として返す"""
+        self._count("batch")
+        await self._delay()
+        boundary = request.content_type and request.headers["Content-Type"].split("boundary=")[-1].strip('"')
+        body = (await request.read()).decode(errors="replace")
+        ids = re.findall(r"Content-ID: <([^>]+)>", body)
+        out_boundary = "batch_bench"
+        parts = []
+        for cid in ids:
+            self._count("batch_part")
+            parts.append(
+                f"--{out_boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{{\"id\": \"anyoneWithLink\"}}\r\n"
+            )
+        parts.append(f"--{out_boundary}--\r\n")
+        return web.Response(
+            body="".join(parts).encode(),
+            headers={"Content-Type": f"multipart/mixed; boundary={out_boundary}"},
+        )
+
+    async def image(self, request):
+        self._count("image")
+        size = self.images.get(request.match_info["name"], 200 * 1024)
+        await self._delay()
+        # 内容ハッシュによる重複排除に引っかからないよう画像ごとに内容を変える
+        head = b"\xff\xd8\xff" + request.match_info["name"].encode()
+        return web.Response(body=head + bytes(max(0, size - len(head))), content_type="image/jpeg")
+
+def routed_http_class(stub: DriveStub):
+    """https://*.googleapis.com 宛てのリクエストをスタブへ転送するhttplib2.Http"""
+    original = httplib2.Http
+
+    class StubRoutedHttp(original):
+        def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+            parts = urlsplit(uri)
+            if parts.hostname and parts.hostname.endswith("googleapis.com"):
+                path = parts.path
+                if parts.hostname == "oauth2.googleapis.com":
+                    path = "/token"
+                uri = f"{stub.base_url}{path}" + (f"?{parts.query}" if parts.query else "")
+            return super().request(uri, method, body, headers, *args, **kwargs)
+
+    return StubRoutedHttp
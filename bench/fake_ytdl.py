@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の偽yt-dlp
+ネットワークに接続せず、指定サイズのファイルを指定速度で書き出す
+
+環境変数:
+  FAKE_YTDL_SIZE_MB     書き出すファイルサイズ(MB)          既定: 5
+  FAKE_YTDL_MBPS        書き込み速度(MB/s, 0で無制限)       既定: 50
+  FAKE_YTDL_STARTUP_SEC 起動・情報抽出にかかる時間(秒)      既定: 0.3
+  FAKE_YTDL_FAIL_RATE   失敗させる割合(0〜1)                既定: 0
+  FAKE_YTDL_FAIL_KIND   失敗の種類(other/rate_limited/login_required) 既定: other
+  FAKE_YTDL_ITEMS       1投稿あたりの項目数（2以上でカルーセル）既定: 1
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+BLOCK = 1024 * 1024
+
+# 実際のyt-dlpのエラー出力に近いメッセージ
+FAIL_MESSAGES = {
+    "rate_limited": "HTTP Error 429: Too Many Requests",
+    "login_required": "This content is only available for registered users. "
+                      "Use --cookies, --cookies-from-browser, --username and --password",
+}
+
+def parse_args(argv: list[str]) -> tuple[dict, str]:
+    """必要なオプションだけを解釈し、残りは無視する"""
+    opts = {}
+    url = ""
+    i = 0
+    takes_value = {"-o", "-f", "-S", "--merge-output-format", "--cookies", "--progress-template", "--load-info-json",
+                   "--playlist-end", "-N"}
+    while i < len(argv):
+        arg = argv[i]
+        if arg in takes_value and i + 1 < len(argv):
+            opts[arg] = argv[i + 1]
+            i += 2
+            continue
+        if arg.startswith("-"):
+            opts[arg] = True
+        else:
+            url = arg
+        i += 1
+    return opts, url
+
+def write_media(out, video_id: str, size: int, mbps: float, report=None):
+    """指定速度で size バイトを書き出す"""
+    block = os.urandom(BLOCK)  # ハッシュ重複排除に引っかからないよう動画ごとに内容を変える
+    block = video_id.encode() + block[len(video_id):]
+    written = 0
+    start = time.monotonic()
+    while written < size:
+        n = min(BLOCK, size - written)
+        out.write(block[:n])
+        written += n
+        if report:
+            report(written, time.monotonic() - start)
+        if mbps > 0:
+            # 指定速度を超えないように待機
+            ahead = written / (mbps * BLOCK) - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    out.flush()
+
+def main() -> int:
+    opts, url = parse_args(sys.argv[1:])
+    size = int(float(os.environ.get("FAKE_YTDL_SIZE_MB", "5")) * BLOCK)
+    mbps = float(os.environ.get("FAKE_YTDL_MBPS", "50"))
+    startup = float(os.environ.get("FAKE_YTDL_STARTUP_SEC", "0.3"))
+    fail_rate = float(os.environ.get("FAKE_YTDL_FAIL_RATE", "0"))
+    items = int(os.environ.get("FAKE_YTDL_ITEMS", "1"))
+    if opts.get("--load-info-json"):
+        # 取得済みメタデータを使う場合は情報抽出の時間を省く
+        with open(opts["--load-info-json"]) as f:
+            loaded = json.load(f)
+        url = loaded.get("webpage_url", url)
+        startup = 0
+    if "?item=" in url:
+        items = 1  # カルーセルの1項目
+    video_id = hashlib.sha1(url.encode()).hexdigest()[:11]
+
+    time.sleep(startup)
+    if random.random() < fail_rate:
+        print(f"ERROR: [fake] {url}: {FAIL_MESSAGES.get(os.environ.get('FAKE_YTDL_FAIL_KIND'), 'simulated failure')}",
+              file=sys.stderr)
+        return 1
+
+    def video_info(item_url: str) -> dict:
+        item_id = hashlib.sha1(item_url.encode()).hexdigest()[:11]
+        return {
+            "id": item_id,
+            "title": f"bench {item_id}",
+            "uploader": "bench",
+            "duration": 30,
+            "thumbnail": f"https://pbs.twimg.com/media/{item_id}.jpg",
+            "ext": "mp4",
+            "filesize": size,
+            "webpage_url": item_url,
+            "formats": [{"format_id": "fake", "ext": "mp4", "filesize": size, "protocol": "https"}],
+        }
+
+    if items > 1:
+        info = {
+            "_type": "playlist",
+            "id": video_id,
+            "webpage_url": url,
+            "entries": [video_info(f"{url}?item={n}") for n in range(1, items + 1)],
+        }
+    else:
+        info = video_info(url)
+    if opts.get("-J") or opts.get("--dump-single-json"):
+        print(json.dumps(info))
+        return 0
+
+    # --progress-template が指定されていれば、yt-dlpと同様に進捗を1行ずつ出力する
+    out_tpl = opts.get("-o", "%(uploader)s_%(id)s.%(ext)s")
+    template = opts.get("--progress-template", "")
+    template = template.split(":", 1)[1] if template.startswith("download:") else ""
+    progress_out = sys.stderr if out_tpl == "-" else sys.stdout
+
+    def report(done: int, elapsed: float):
+        speed = done / elapsed if elapsed > 0 else None
+        values = {
+            "downloaded_bytes": done,
+            "total_bytes": size,
+            "total_bytes_estimate": "NA",
+            "speed": speed if speed else "NA",
+            "eta": (size - done) / speed if speed else "NA",
+        }
+        line = template
+        for name, value in values.items():
+            line = line.replace(f"%(progress.{name})s", str(value))
+        print(line, file=progress_out, flush=True)
+
+    # 実際のyt-dlpと同様に、プレイリストは項目を順番にダウンロードする
+    for entry in info.get("entries", [info]):
+        if out_tpl == "-":
+            write_media(sys.stdout.buffer, entry["id"], size, mbps, report if template else None)
+            continue
+        path = out_tpl % {"uploader": "bench", "id": entry["id"], "ext": "mp4", "title": entry["title"]}
+        with open(path, "wb") as out:
+            write_media(out, entry["id"], size, mbps, report if template else None)
+        if opts.get("--write-thumbnail"):
+            with open(os.path.splitext(path)[0] + ".jpg", "wb") as thumb:
+                thumb.write(b"\xff\xd8\xff" + b"\0" * 1024)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
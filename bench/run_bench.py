@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+ボットのスループット計測用ハーネス（オフライン）
+
+実際のハンドラ（on_message → download_and_upload_media / download_and_upload_image →
+upload_to_drive）を、偽yt-dlp・Driveスタブ・模擬Discordチャンネルに対して実行し、
+jobs/sec、エンドツーエンドのp50/p95/p99レイテンシ、ピークRSS、一時ディスク使用量のピークを表示する
+
+使い方:
+  python bench/run_bench.py --scenario links50
+  python bench/run_bench.py --scenario youtube10x500 --json
+  python bench/run_bench.py --scenario custom --platform tiktok --links 20 --size-mb 30
+  python bench/run_bench.py --scenario links50 --split   # gateway/worker分離（共有キュー経由）で計測
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE))
+
+# シナリオ: platform, links, size_mb, ytdl_mbps（items: 1投稿あたりの項目数）
+SCENARIOS = {
+    "links50": {"platform": "twitter", "links": 50, "size_mb": 5, "mbps": 50},
+    "youtube10x500": {"platform": "youtube", "links": 10, "size_mb": 500, "mbps": 200},
+    "instagram20": {"platform": "instagram", "links": 20, "size_mb": 15, "mbps": 30},
+    "images30": {"platform": "image", "links": 30, "size_mb": 0.5, "mbps": 0},
+    "carousel10x4": {"platform": "instagram", "links": 10, "size_mb": 5, "mbps": 30, "items": 4},
+}
+
+CUSTOM_DEFAULTS = {"platform": "twitter", "links": 10, "size_mb": 5, "mbps": 50}
+
+URL_TEMPLATES = {
+    "twitter": "https://x.com/bench/status/{n}",
+    "instagram": "https://www.instagram.com/reel/BENCH{n}/",
+    "tiktok": "https://www.tiktok.com/@bench/video/{n}",
+    "youtube": "https://youtube.com/shorts/bench{n}",
+}
+
+def fake_service_account(token_uri: str) -> str:
+    """署名可能な使い捨ての鍵でサービスアカウントJSONを作る"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": pem,
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    })
+
+class FakeMessage:
+    def __init__(self, channel, content: str = "", embed=None, file=None, view=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.file = file
+        self.view = view
+        self.author = type("Author", (), {"bot": False})()
+        self.id = id(self)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        if kwargs.get("view") is not None:
+            self.view = kwargs["view"]
+        self.channel.record(self)
+        return self
+
+    async def delete(self):
+        return None
+
+class FakeChannel:
+    """送信内容と時刻を記録する模擬Discordチャンネル"""
+
+    def __init__(self, channel_id: int, urls: list[str]):
+        self.id = channel_id
+        self.name = "bench"
+        self.pending = set(urls)
+        self.completed: dict[str, float] = {}
+        self.sent = 0
+        self.done = asyncio.Event()
+
+    async def send(self, content=None, embed=None, file=None, view=None, **kwargs):
+        self.sent += 1
+        if file is not None and hasattr(file, "fp"):
+            file.fp.close()
+        message = FakeMessage(self, content or "", embed, file, view)
+        self.record(message)
+        return message
+
+    def record(self, message: FakeMessage):
+        """結果メッセージ（待機中・進捗以外）を受け取ったURLを完了として記録"""
+        # まとめ返信は全ページ、リンク毎の項目（名前にURL・値に状態）を個別に判定する
+        pages = getattr(message.view, "pages", None) or [message.embed]
+        grouped = [
+            (f.name, f.value) for embed in pages if embed is not None
+            for f in embed.fields if "://" in f.name
+        ]
+        if grouped:
+            for name, value in grouped:
+                url = name.split(" ", 1)[-1]
+                self._complete(value, [url] if url in self.pending else [])
+            return
+        text = message.content or ""
+        if message.embed is not None:
+            text += " " + (message.embed.description or "") + " " + (message.embed.title or "")
+            text += " ".join(f.value for f in message.embed.fields)
+        self._complete(text, [url for url in self.pending if url in text])
+
+    def _complete(self, text: str, urls: list[str]):
+        if text.startswith(("⏳", "🔄")) or ("Google Drive リンク" not in text and "完了" not in text
+                                          and not text.startswith(("❌", "⚠️", "✅", "♻️"))):
+            return
+        now = time.perf_counter()
+        for url in urls:
+            self.pending.discard(url)
+            self.completed[url] = now
+        if not self.pending:
+            self.done.set()
+
+def process_tree_rss_kb(root_pid: int) -> int:
+    """自身と子孫プロセスのRSS合計(KB)を/procから取得"""
+    children: dict[int, list[int]] = {}
+    rss: dict[int, int] = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry.name}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss[int(entry.name)] = int(line.split()[1])
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+async def sample_resources(scratch: str, peaks: dict, stop: asyncio.Event, interval: float = 0.2):
+    while not stop.is_set():
+        peaks["rss_kb"] = max(peaks["rss_kb"], process_tree_rss_kb(os.getpid()))
+        peaks["disk"] = max(peaks["disk"], dir_size(scratch))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+async def run(args) -> dict:
+    from drive_stub import DriveStub, routed_http_class
+    import httplib2
+
+    if args.scenario != "custom" and args.scenario not in SCENARIOS:
+        raise SystemExit(f"unknown scenario: {args.scenario}")
+    scenario = dict(SCENARIOS.get(args.scenario, CUSTOM_DEFAULTS))
+    for key in ("platform", "links", "size_mb", "mbps", "items"):
+        value = getattr(args, key)
+        if value is not None:
+            scenario[key] = value
+
+    stub = DriveStub(upload_mbps=args.drive_mbps, latency_sec=args.api_latency)
+    stub.start_in_thread()
+
+    scratch = tempfile.mkdtemp(prefix="videodl-bench-")
+    os.environ.update({
+        "DISCORD_TOKEN": "bench",
+        "TARGET_CHANNEL_ID_1": "1",
+        "TARGET_CHANNEL_ID_2": "2",
+        "GOOGLE_DRIVE_FOLDER_ID": "benchfolder",
+        "GOOGLE_SERVICE_ACCOUNT_JSON": fake_service_account("https://oauth2.googleapis.com/token"),
+        "DATA_DIR": os.path.join(scratch, "data"),
+        "TMPDIR": scratch,
+        "YTDL_BACKEND": "subprocess",
+        "PLATFORM_RATE_PER_MIN": os.environ.get("PLATFORM_RATE_PER_MIN", ""),  # 既定ではレート制限なしで計測
+        "METRICS_PORT": "0",
+        "ROLE": "worker" if args.split else "all",
+        "WORKER_ID": "bench",
+        "QUEUE_POLL_SEC": "0.05",
+        "FAKE_YTDL_SIZE_MB": str(scenario["size_mb"]),
+        "FAKE_YTDL_MBPS": str(scenario["mbps"]),
+        "FAKE_YTDL_ITEMS": str(scenario.get("items", 1)),
+    })
+    tempfile.tempdir = scratch
+    # Drive APIへの通信はすべてスタブへ
+    httplib2.Http = routed_http_class(stub)
+
+    import discord_video_dl as app
+    app.YTDL = str(HERE / "fake_ytdl.py")
+
+    async def no_commands(message):
+        return None
+    app.bot.process_commands = no_commands
+
+    if scenario["platform"] == "image":
+        urls = []
+        for n in range(scenario["links"]):
+            name = f"bench{n}.jpg"
+            stub.images[name] = int(scenario["size_mb"] * 1024 * 1024)
+            urls.append(f"{stub.base_url}/img/{name}")
+    else:
+        template = URL_TEMPLATES[scenario["platform"]]
+        urls = [template.format(n=n) for n in range(scenario["links"])]
+
+    channel = FakeChannel(app.CHANNEL_1, urls)
+    message = FakeMessage(channel, " ".join(urls))
+    peaks = {"rss_kb": 0, "disk": 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_resources(scratch, peaks, stop))
+
+    start = time.perf_counter()
+    background = []
+    if args.split:
+        # 同じプロセス内でgateway（キュー登録・送信箱の反映）とworkerを動かす
+        local_scheduler = app.scheduler
+        app.scheduler = app.QueueScheduler()
+        await app.on_message(message)
+        app.scheduler = local_scheduler
+        app.bot.get_channel = lambda channel_id: channel
+        app.outbox_relay.start()
+        background = [app.outbox_relay.task, asyncio.create_task(app.queue_worker.run())]
+    else:
+        await app.on_message(message)
+    try:
+        await asyncio.wait_for(channel.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ timeout: {len(channel.pending)} job(s) did not finish", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await app.image_fetcher.close()
+    stub.stop_thread()
+
+    latencies = [t - start for t in channel.completed.values()]
+    return {
+        "scenario": args.scenario,
+        "split": args.split,
+        **scenario,
+        "completed": len(channel.completed),
+        "elapsed_sec": round(elapsed, 3),
+        "jobs_per_sec": round(len(channel.completed) / elapsed, 3) if elapsed else 0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        "latency_mean": round(statistics.fmean(latencies), 3) if latencies else None,
+        "peak_rss_mb": round(peaks["rss_kb"] / 1024, 1),
+        "peak_tmp_disk_mb": round(peaks["disk"] / (1024 * 1024), 1),
+        "drive_bytes_mb": round(stub.bytes_received / (1024 * 1024), 1),
+        "drive_calls": stub.calls,
+        "discord_messages": channel.sent,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="links50", help=f"{', '.join(SCENARIOS)} または custom")
+    parser.add_argument("--platform", choices=[*URL_TEMPLATES, "image"])
+    parser.add_argument("--links", type=int)
+    parser.add_argument("--size-mb", dest="size_mb", type=float)
+    parser.add_argument("--mbps", type=float, help="偽yt-dlpの書き込み速度(MB/s)")
+    parser.add_argument("--items", type=int, help="1投稿あたりの項目数（カルーセル）")
+    parser.add_argument("--drive-mbps", type=float, default=0, help="Driveスタブの受信速度上限(MB/s)")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Drive APIごとの擬似レイテンシ(秒)")
+    parser.add_argument("--split", action="store_true", help="gateway/workerに分離した構成（ROLE=worker + 共有キュー）で実行")
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    if args.json:
+        # ボットのログはstderrへ逃がし、stdoutはJSONだけにする
+        with contextlib.redirect_stdout(sys.stderr):
+            result = asyncio.run(run(args))
+    else:
+        result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    width = max(len(k) for k in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value}")
+
+if __name__ == "__main__":
+    main()
@@ -1,166 +1,3589 @@
 # discord_video_dl_improved.py
-import os, re, asyncio, tempfile, shutil, subprocess, requests, json
+import os, re, io, asyncio, tempfile, shutil, subprocess, json, random, threading, itertools, bisect, sqlite3, time, hashlib
+import socket
+import uuid
+import multiprocessing
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache, partial
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from pathlib import Path
 from datetime import datetime
 import discord
+import httplib2
+import aiofiles
+import aiohttp
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 from discord.ext import commands
-from urllib.parse import urlparse
-from googleapiclient.discovery import build
+from urllib.parse import urlparse, urlsplit, urlunsplit, urljoin, parse_qsl, urlencode
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request as AuthRequest
 
 # --------------------------------------------------
 # 1. 環境変数
 # --------------------------------------------------
-TOKEN = os.environ["DISCORD_TOKEN"]
+ROLE = os.environ.get("ROLE", "all")  # all: 1プロセスで受信と実行 / gateway: Discord受信とキュー登録のみ / worker: キューのジョブを実行
+TOKEN = os.environ.get("DISCORD_TOKEN", "")  # workerロールでは不要
 CHANNEL_1 = int(os.environ["TARGET_CHANNEL_ID_1"])  # メインチャンネル
 CHANNEL_2 = int(os.environ["TARGET_CHANNEL_ID_2"])  # 外注共有用チャンネル
 GOOGLE_DRIVE_FOLDER_ID = os.environ.get("GOOGLE_DRIVE_FOLDER_ID", "")  # Google Driveの保存フォルダID
 GOOGLE_SERVICE_ACCOUNT_JSON = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON", "")  # サービスアカウントJSON
+DRIVE_UPLOAD_WORKERS = int(os.environ.get("DRIVE_UPLOAD_WORKERS", "2"))  # 同時アップロード数
+DRIVE_CHUNK_MB = int(os.environ.get("DRIVE_CHUNK_MB", "8"))  # レジューマブルアップロードのチャンクサイズ(MB)
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))  # 全体の同時実行ジョブ数
+DATA_DIR = os.environ.get("DATA_DIR", "/app/data")  # 永続ボリュームのマウント先
+CACHE_TTL_DAYS = float(os.environ.get("CACHE_TTL_DAYS", "30"))  # URLキャッシュの有効期間(日)
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "5000"))  # URLキャッシュの最大件数
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get("JOURNAL_MAX_ATTEMPTS", "3"))  # 再起動後にジョブを再開する最大回数
+# プラットフォーム別の同時実行数 (例: "instagram=2,twitter=2")
+PLATFORM_CONCURRENCY = os.environ.get(
+    "PLATFORM_CONCURRENCY", "instagram=2,twitter=2,tiktok=2,youtube=1,image=2"
+)
+# プラットフォーム別のyt-dlp実行レート（1分あたりの回数）
+PLATFORM_RATE_PER_MIN = os.environ.get(
+    "PLATFORM_RATE_PER_MIN", "instagram=20,twitter=40,tiktok=40,youtube=60"
+)
+RATE_BURST = int(os.environ.get("RATE_BURST", "3"))  # レート制限内で連続実行できる回数
+RATE_RETRY_MAX = int(os.environ.get("RATE_RETRY_MAX", "3"))  # レート制限・ログイン要求時の再試行回数
+BACKOFF_BASE_SEC = float(os.environ.get("BACKOFF_BASE_SEC", "30"))  # レート制限時の待機時間の基準(秒)
+BACKOFF_MAX_SEC = float(os.environ.get("BACKOFF_MAX_SEC", "900"))  # レート制限時の待機時間の上限(秒)
+YTDL_BACKEND = os.environ.get("YTDL_BACKEND", "pool")  # "pool"（常駐プロセス）または "subprocess"
+YTDL_POOL_WORKERS = int(os.environ.get("YTDL_POOL_WORKERS", str(MAX_CONCURRENT_JOBS)))  # 常駐yt-dlpプロセス数
+PROBE_ENABLED = os.environ.get("PROBE_ENABLED", "1") == "1"  # ダウンロード前にメタデータを取得して形式・送信先を決める
+PROBE_CACHE_TTL = float(os.environ.get("PROBE_CACHE_TTL", "300"))  # メタデータのキャッシュ期間(秒)
+PROBE_NOTICE_MB = float(os.environ.get("PROBE_NOTICE_MB", "20"))  # この予想サイズ以上なら事前にサイズと所要時間を通知
+STREAM_UPLOAD = os.environ.get("STREAM_UPLOAD", "1") == "1"  # 一時ファイルを使わずDriveへ直接ストリーミング
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", "3"))  # ストリーミング時のメモリバッファ(チャンク数)
+DRIVE_HASH_DEDUP = os.environ.get("DRIVE_HASH_DEDUP", "1") == "1"  # 同一内容のファイルはアップロードせず再利用
+DRIVE_INDEX_REFRESH_SEC = float(os.environ.get("DRIVE_INDEX_REFRESH_SEC", "60"))  # Driveハッシュ索引の差分更新間隔(秒)
+MULTI_ITEM_MAX = int(os.environ.get("MULTI_ITEM_MAX", "20"))  # 複数メディア投稿（カルーセル等）で処理する最大件数
+MULTI_ITEM_CONCURRENCY = int(os.environ.get("MULTI_ITEM_CONCURRENCY", "3"))  # 複数メディア投稿の同時ダウンロード数
+DRIVE_POST_SUBFOLDER = os.environ.get("DRIVE_POST_SUBFOLDER", "0") == "1"  # 複数メディア投稿を投稿毎のサブフォルダにまとめる
+DRIVE_FOLDER_IS_SHARED = os.environ.get("DRIVE_FOLDER_IS_SHARED", "0") == "1"  # 保存先フォルダが「リンクを知っている全員」に共有済み（ファイル毎の公開設定を省略）
+DRIVE_BATCH_WINDOW_SEC = float(os.environ.get("DRIVE_BATCH_WINDOW_SEC", "0.2"))  # 公開設定をバッチにまとめるために待つ最長時間(秒)。実行中のジョブが全て公開待ちになれば待たずに送る
+REPLY_GROUP_WINDOW_SEC = float(os.environ.get("REPLY_GROUP_WINDOW_SEC", "1.5"))  # 複数リンクのメッセージへのまとめ返信を更新する間隔(秒)。0でリンク毎に返信
+PROGRESS_EDIT_SEC = float(os.environ.get("PROGRESS_EDIT_SEC", "3"))  # 進捗メッセージを編集する最小間隔(秒)
+PREVIEW_REPLY = os.environ.get("PREVIEW_REPLY", "1") == "1"  # メタデータ取得後すぐにプレビューを返信し、完了時に結果へ書き換える
+YTDL_STDERR_TAIL_LINES = int(os.environ.get("YTDL_STDERR_TAIL_LINES", "50"))  # エラー報告用に保持するyt-dlp出力の末尾行数
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", "8"))  # 画像取得の同時実行数（全体）
+IMAGE_CONN_PER_HOST = int(os.environ.get("IMAGE_CONN_PER_HOST", "4"))  # 同一ホスト(pbs.twimg.com等)への同時接続数
+IMAGE_CHUNK_KB = int(os.environ.get("IMAGE_CHUNK_KB", "256"))  # 画像の読み込み・書き込み単位(KB)
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "")  # ジョブ作業ディレクトリのルート（既定は DATA_DIR/jobs）
+DISK_RESERVE_MB = int(os.environ.get("DISK_RESERVE_MB", "256"))  # 作業領域に常に残しておく空き容量(MB)
+JOB_DISK_DEFAULT_MB = int(os.environ.get("JOB_DISK_DEFAULT_MB", "300"))  # サイズが分からないジョブの想定ディスク使用量(MB)
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", "150"))  # 動画ジョブ1件あたりの想定メモリ使用量(MB)
+MEMORY_LIMIT_MB = int(os.environ.get("MEMORY_LIMIT_MB", "0"))  # メモリ予算(MB)。0でcgroup上限/搭載メモリの85%
+COMPRESS_PRESET = os.environ.get("COMPRESS_PRESET", "veryfast")  # !compress の再エンコードに使うx264プリセット
+COMPRESS_SEGMENTS = int(os.environ.get("COMPRESS_SEGMENTS", "0"))  # 再エンコードを分割して並列に行う数（0でCPUコア数、最大4）
+COMPRESS_SEGMENT_MIN_SEC = float(os.environ.get("COMPRESS_SEGMENT_MIN_SEC", "60"))  # この長さ未満の動画は分割しない(秒)
+FASTSTART_REMUX = os.environ.get("FASTSTART_REMUX", "1") == "1"  # アップロード前にMP4の索引(moov)を先頭へ移す無劣化リマックスを行う
+REMUX_CONCURRENCY = int(os.environ.get("REMUX_CONCURRENCY", "2"))  # 同時に動かすリマックス用ffmpegプロセス数
+SHORT_LINK_CACHE_SEC = float(os.environ.get("SHORT_LINK_CACHE_SEC", "86400"))  # 短縮URLの展開結果を保持する期間(秒)
+QUEUE_DB = os.environ.get("QUEUE_DB", "")  # gateway/worker間の共有ジョブキュー（既定は DATA_DIR/queue.sqlite3）
+WORKER_ID = os.environ.get("WORKER_ID", "") or socket.gethostname()  # ワーカー識別子（同じホストで複数起動する場合は個別に指定）
+WORKER_LEASE_SEC = float(os.environ.get("WORKER_LEASE_SEC", "120"))  # 取得したジョブの貸出期限(秒)。期限切れのジョブは他のワーカーが引き継ぐ
+QUEUE_POLL_SEC = float(os.environ.get("QUEUE_POLL_SEC", "0.5"))  # キュー・送信箱を確認する間隔(秒)
+FRAGMENT_CONCURRENCY = os.environ.get(
+    "FRAGMENT_CONCURRENCY", "youtube=4,twitter=4,instagram=2,tiktok=1"
+)  # HLS/DASHの断片を同時に取得する数（ジョブ毎・プラットフォーム別）
+FRAGMENT_CONNECTIONS_MAX = int(os.environ.get("FRAGMENT_CONNECTIONS_MAX", "16"))  # 全ジョブ合計の断片取得の同時接続数
+SPLIT_STREAM_DOWNLOAD = os.environ.get("SPLIT_STREAM_DOWNLOAD", "1") == "1"  # 映像と音声が別形式の場合は同時にダウンロードしてから結合する
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "8080"))  # Prometheusメトリクス公開ポート（0で無効）
+
+# --------------------------------------------------
+# 1-1. メトリクス（Prometheus）
+# --------------------------------------------------
+STAGE_SECONDS = Histogram(
+    "videodl_stage_seconds", "各処理段階の所要時間(秒)", ["stage", "platform"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+STAGE_INFLIGHT = Gauge("videodl_stage_inflight", "実行中の処理数", ["stage"])
+STAGE_FAILURES = Counter("videodl_stage_failures_total", "処理段階の失敗数", ["stage", "platform"])
+TRANSFER_BYTES = Counter("videodl_bytes_total", "転送バイト数", ["direction", "platform"])
+DELIVERIES = Counter(
+    "videodl_deliveries_total", "結果の返信数（drive / discord / discord_fallback / cache / failed）",
+    ["platform", "via"],
+)
+JOBS_QUEUED = Gauge("videodl_jobs_queued", "スケジューラで待機中のジョブ数")
+JOBS_RUNNING = Gauge("videodl_jobs_running", "実行中のジョブ数")
+STARTUP_SECONDS = Gauge("videodl_startup_seconds", "プロセス起動からの所要時間(秒)", ["phase"])
+DOWNLOAD_THROUGHPUT = Histogram(
+    "videodl_download_throughput_mbps", "ダウンロードの実効スループット(MB/s)", ["platform"],
+    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+PROCESS_START = time.monotonic()
+PROCESS_START_WALL = time.time()  # 作業領域の掃除で、今回のプロセスが作成したものを区別する
+
+@contextmanager
+def track_stage(stage: str, platform: str):
+    """処理段階の所要時間・実行中数・失敗数を記録"""
+    STAGE_INFLIGHT.labels(stage).inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.labels(stage, platform).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage, platform).observe(time.perf_counter() - start)
+        STAGE_INFLIGHT.labels(stage).dec()
+
+async def metrics_handler(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+metrics_runner = None
+
+async def start_metrics_server():
+    """/metrics を内部ポートで公開"""
+    global metrics_runner
+    if metrics_runner is not None or METRICS_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, "0.0.0.0", METRICS_PORT).start()
+    print(f"メトリクスサーバー起動: :{METRICS_PORT}/metrics")
+
+# --------------------------------------------------
+# 2. 外部コマンドと正規表現
+# --------------------------------------------------
+YTDL = shutil.which("yt-dlp") or "/usr/local/bin/yt-dlp"
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+
+DISCORD_FILE_LIMIT = 8 * 1024 * 1024  # Discordに直接添付できるファイルサイズ上限
+COMPRESS_MAX_MB = 500  # !compress で指定できる目標サイズの上限(MB)
+PREVIEW_KEYFRAME_TIMEOUT = 8  # サムネイルが無い場合に先頭のフレームを切り出す時間の上限(秒)
+
+# メッセージからURLを取り出す正規表現（<URL> 形式の埋め込み抑止にも対応）
+URL_RE = re.compile(r"https?://[^\s<>|]+", re.I)
+
+# 対応プラットフォームの振り分け表（ホストで引き、パスからメディアIDを取り出す）
+# (プラットフォーム, ホスト（www. / m. などのサブドメインも一致）, メディアIDを取り出すパスの正規表現, IDを渡すクエリ名)
+URL_ROUTES = [
+    ("twitter", ("x.com", "twitter.com"), r"^/(?:\w+|i/web)/status(?:es)?/(\d+)", None),
+    ("instagram", ("instagram.com", "instagr.am"), r"^/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)", None),
+    ("tiktok", ("tiktok.com",), r"^/@[\w.-]+/(?:video|photo)/(\d+)", None),
+    ("youtube", ("youtube.com",), r"^/(?:shorts|live|embed)/([\w-]+)", "v"),
+    ("youtube", ("youtu.be",), r"^/([\w-]+)", None),
+]
+MEDIA_PLATFORMS = tuple(dict.fromkeys(platform for platform, *_ in URL_ROUTES))
+
+# リダイレクトを辿らないとメディアが分からない短縮URL（ホスト+パスの先頭）
+SHORT_LINK_RE = re.compile(r"^(?:t\.co/\w+|v[mt]\.tiktok\.com/\w+|tiktok\.com/t/\w+)", re.I)
+
+# 同じメディアを別物と扱わないよう取り除くクエリ（共有・追跡用）
+TRACKING_PARAMS = {"s", "t", "si", "pp", "feature", "igsh", "igshid", "_r", "_t", "is_from_webapp",
+                   "sender_device", "ref_src", "ref_url", "fbclid", "gclid"}
+
+# 画像URLを判定する正規表現
+IMAGE_RE = re.compile(
+    r"(https?://\S+\.(?:jpg|jpeg|png|gif|webp)(?:\?\S*)?$)", 
+    re.I
+)
+
+# --------------------------------------------------
+# 3. Google Drive 設定
+# --------------------------------------------------
+drive_credentials = None  # ワーカー毎のクライアント生成用に保持
+DRIVE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
+DRIVE_DISCOVERY_CACHE = os.path.join(DATA_DIR, "drive_v3_discovery.json")
+
+def setup_google_drive() -> bool:
+    """
+    Google Drive の認証情報を読み込む（ネットワークアクセスはしない）
+    APIクライアントは最初に使うワーカースレッドで生成し、アクセストークンは起動後のウォームアップで取得する
+    """
+    global drive_credentials
+    if not GOOGLE_SERVICE_ACCOUNT_JSON:
+        print("Google Drive サービスアカウントJSONが設定されていません")
+        return False
+    
+    try:
+        # サービスアカウント情報をJSONから読み込み
+        service_account_info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+        drive_credentials = Credentials.from_service_account_info(
+            service_account_info,
+            scopes=['https://www.googleapis.com/auth/drive']
+        )
+        print("Google Drive 認証情報読み込み完了")
+        return True
+    except Exception as e:
+        print(f"Google Drive 認証情報読み込みエラー: {e}")
+        return False
+
+# Google Drive 設定の読み込み
+drive_enabled = setup_google_drive()
+
+_drive_discovery = None
+_drive_discovery_lock = threading.Lock()
+
+def drive_discovery() -> dict:
+    """
+    Drive v3 のディスカバリー文書（パース済み）を取得
+    google-api-python-client 同梱の静的文書を使い、無い版では DATA_DIR のキャッシュ、最後の手段として取得して保存する
+    """
+    global _drive_discovery
+    with _drive_discovery_lock:
+        if _drive_discovery is None:
+            doc = discovery_cache.get_static_doc("drive", "v3")
+            if doc is None and os.path.isfile(DRIVE_DISCOVERY_CACHE):
+                with open(DRIVE_DISCOVERY_CACHE) as f:
+                    doc = f.read()
+            if doc is None:
+                resp, content = httplib2.Http(timeout=30).request(DRIVE_DISCOVERY_URL)
+                if resp.status != 200:
+                    raise RuntimeError(f"ディスカバリー文書の取得に失敗 ({resp.status})")
+                doc = content.decode()
+                with open(DRIVE_DISCOVERY_CACHE, "w") as f:
+                    f.write(doc)
+            _drive_discovery = json.loads(doc)
+        return _drive_discovery
+
+# アップロード用ワーカープール
+# httplib2.Http はスレッドセーフではないため、ワーカースレッド毎に専用のクライアントを持つ
+DRIVE_CHUNK_SIZE = max(1, DRIVE_CHUNK_MB) * 1024 * 1024  # 256KBの倍数である必要がある
+drive_executor = ThreadPoolExecutor(
+    max_workers=max(1, DRIVE_UPLOAD_WORKERS),
+    thread_name_prefix="drive-upload",
+)
+# 公開設定などの短いAPI呼び出しは、大きなアップロードの後ろで待たないよう別のスレッドで行う
+drive_api_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="drive-api")
+_drive_local = threading.local()
+
+def worker_drive_http() -> AuthorizedHttp:
+    """現在のワーカースレッド専用の認証済みHTTPクライアントを取得（なければ作成）"""
+    http = getattr(_drive_local, "http", None)
+    if http is None:
+        base = httplib2.Http(timeout=120)
+        # レジューマブルアップロードの308はリダイレクトではなく「継続」を意味する
+        base.redirect_codes = base.redirect_codes - {308}
+        http = AuthorizedHttp(drive_credentials, http=base)
+        _drive_local.http = http
+    return http
+
+def worker_drive_service():
+    """現在のワーカースレッド専用のDriveクライアントを取得（なければ作成）"""
+    service = getattr(_drive_local, "service", None)
+    if service is None:
+        service = build_from_document(drive_discovery(), http=worker_drive_http())
+        _drive_local.service = service
+    return service
+
+# --------------------------------------------------
+# 4. Cookie ファイルパスとプラットフォーム判定
+# --------------------------------------------------
+COOKIE_DIR = "/app/cookies"  # 無ければクッキー無しで動作する（作成はしない）
+
+COOKIE_PATHS = {
+    "instagram": Path(COOKIE_DIR) / "instagram_cookies.txt",
+    "twitter": Path(COOKIE_DIR) / "twitter_cookies.txt",
+    "tiktok": Path(COOKIE_DIR) / "tiktok_cookies.txt",
+    "youtube": Path(COOKIE_DIR) / "youtube_cookies.txt",
+}
+
+def media_key(url: str, platform: str) -> str:
+    """キャッシュ用の正規化キー（プラットフォーム:メディアID）を生成"""
+    route = route_url(url)
+    if route.media_id and route.platform == platform:
+        return route.key
+    return f"{platform}:{url}"
+
+# --------------------------------------------------
+# 4-1. URL→Google Drive キャッシュ
+# --------------------------------------------------
+class MediaCache:
+    """メディアキーとアップロード済みDriveファイルの対応を保存するSQLiteキャッシュ（TTL/LRU）"""
+
+    def __init__(self, db_path: str, ttl_seconds: float, max_entries: int):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS media_cache (
+                key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                link TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                items TEXT
+            )"""
+        )
+        try:
+            # 複数メディア投稿に対応する前に作成されたDBへの列追加
+            self.db.execute("ALTER TABLE media_cache ADD COLUMN items TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self.db.commit()
+
+    def get(self, key: str) -> dict | None:
+        row = self.db.execute(
+            "SELECT file_id, link, size, created_at, items FROM media_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return None
+        now = time.time()
+        if now - row[3] > self.ttl:
+            self.invalidate(key)
+            return None
+        self.db.execute("UPDATE media_cache SET last_used = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        return {
+            "file_id": row[0], "link": row[1], "size": row[2], "created_at": row[3],
+            "items": json.loads(row[4]) if row[4] else None,
+        }
+
+    def put(self, key: str, file_id: str, link: str, size: int, items: list[dict] | None = None):
+        """items: 複数メディア投稿の各ファイル [{"file_id", "link", "size"}, ...]"""
+        now = time.time()
+        self.db.execute(
+            """INSERT OR REPLACE INTO media_cache (key, file_id, link, size, created_at, last_used, items)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (key, file_id, link, size, now, now, json.dumps(items) if items else None),
+        )
+        self._evict(now)
+        self.db.commit()
+
+    def invalidate(self, key: str):
+        """キーと、その派生（サイズ指定の圧縮結果 "キー@25MB" など）を削除"""
+        variant = key + "@"
+        self.db.execute(
+            "DELETE FROM media_cache WHERE key = ? OR substr(key, 1, ?) = ?", (key, len(variant), variant)
+        )
+        self.db.commit()
+
+    def _evict(self, now: float):
+        """期限切れを削除し、上限を超えた分は最終利用が古い順に削除"""
+        self.db.execute("DELETE FROM media_cache WHERE created_at < ?", (now - self.ttl,))
+        self.db.execute(
+            """DELETE FROM media_cache WHERE key IN (
+                SELECT key FROM media_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,),
+        )
+
+Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
+media_cache = MediaCache(
+    os.path.join(DATA_DIR, "media_cache.sqlite3"),
+    CACHE_TTL_DAYS * 86400,
+    CACHE_MAX_ENTRIES,
+)
+
+# --------------------------------------------------
+# 4-2. ジョブジャーナル（再起動後の再開用）
+# --------------------------------------------------
+JOB_DIR = SCRATCH_DIR or os.path.join(DATA_DIR, "jobs")  # 再起動後も残るジョブ用作業ディレクトリ（唯一の作業領域）
+JOURNAL_DB = os.path.join(DATA_DIR, "jobs.sqlite3")
+if ROLE == "worker":
+    # 同じボリュームで複数のワーカーが動いても互いの作業ディレクトリ・ジャーナルに触れないよう分ける
+    JOB_DIR = os.path.join(JOB_DIR, f"worker-{WORKER_ID}")
+    JOURNAL_DB = os.path.join(DATA_DIR, f"jobs-{WORKER_ID}.sqlite3")
+Path(JOB_DIR).mkdir(parents=True, exist_ok=True)
+
+# 実行中ジョブのジャーナルID（スケジューラがタスク毎に設定）
+current_job_id: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_job_id", default=None)
+
+class JobJournal:
+    """未完了ジョブ（URL・段階・作業ディレクトリ・アップロードセッション）を永続化するSQLiteジャーナル"""
+
+    FIELDS = ("stage", "temp_path", "session_uri", "session_file", "upload_offset", "attempts")
+
+    def __init__(self, db_path: str):
+        self.lock = threading.Lock()  # アップロードスレッドからも更新される
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                channel_id INTEGER NOT NULL,
+                platform TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                stage TEXT NOT NULL DEFAULT 'queued',
+                temp_path TEXT,
+                session_uri TEXT,
+                session_file TEXT,
+                upload_offset INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.db.commit()
+
+    def add(self, kind: str, url: str, channel_id: int, platform: str, priority: int) -> int:
+        now = time.time()
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT INTO jobs (kind, url, channel_id, platform, priority, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, url, channel_id, platform, priority, now, now),
+            )
+            self.db.commit()
+            return cur.lastrowid
+
+    def get(self, job_id: int | None) -> dict | None:
+        if job_id is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id: int | None, **fields):
+        if job_id is None or not fields:
+            return
+        assert all(k in self.FIELDS for k in fields)
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        with self.lock:
+            self.db.execute(
+                f"UPDATE jobs SET {columns}, updated_at = ? WHERE id = ?",
+                (*fields.values(), time.time(), job_id),
+            )
+            self.db.commit()
+
+    def finish(self, job_id: int | None):
+        """完了したジョブを削除し、作業ディレクトリも片付ける"""
+        job = self.get(job_id)
+        if not job:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.commit()
+        if job["temp_path"]:
+            shutil.rmtree(job["temp_path"], ignore_errors=True)
+
+    def unfinished(self) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY priority, id").fetchall()
+        return [dict(r) for r in rows]
+
+    # 実行中ジョブ（コンテキスト）に対する操作
+    def current(self) -> dict | None:
+        return self.get(current_job_id.get())
+
+    def update_current(self, **fields):
+        self.update(current_job_id.get(), **fields)
+
+job_journal = JobJournal(JOURNAL_DB)
+
+def job_scratch_dir() -> str:
+    """ジョブの作業ディレクトリを取得。再開時は前回のディレクトリ（途中までのファイル）を再利用する"""
+    job = job_journal.current()
+    if job and job["temp_path"] and os.path.isdir(job["temp_path"]):
+        return job["temp_path"]
+    path = tempfile.mkdtemp(prefix="job-", dir=JOB_DIR)
+    job_journal.update_current(temp_path=path)
+    return path
+
+# --------------------------------------------------
+# 4-3. yt-dlp 実行バックエンド
+# --------------------------------------------------
+def ytdl_options(platform: str, out_tpl: str, compress: bool = False) -> dict:
+    """プラットフォーム別のyt-dlpオプション（YoutubeDLのパラメータ形式）"""
+    if compress:
+        # 再エンコードの元になる形式（目標サイズに合わせて後から縮めるため、720pまでの画質を確保）
+        opts = {"format": "bv*[height<=720][ext=mp4]+ba[ext=m4a]/b[height<=720][ext=mp4]/bv*[height<=720]+ba/b[height<=720]/b"}
+    elif platform == "instagram":
+        opts = {"format": "best[ext=mp4]/best", "writethumbnail": True}
+    elif platform == "tiktok":
+        opts = {"format": "best[ext=mp4]/best"}
+    elif platform == "youtube":
+        opts = {"format": "best[height<=1080][ext=mp4]/best[ext=mp4]/best"}
+    else:  # Twitter/X
+        opts = {"format_sort": ["vcodec:h264", "acodec:m4a", "ext:mp4"]}
+    opts["merge_output_format"] = "mp4"
+    opts["outtmpl"] = out_tpl
+    opts["playlistend"] = MULTI_ITEM_MAX
+    # HLS/DASHの断片を並行に取得（標準出力へのストリーミング時は順番に書き出す必要があるため使わない）
+    fragments = fragment_concurrency(platform)
+    if fragments > 1 and out_tpl != "-":
+        opts["concurrent_fragment_downloads"] = fragments
+    
+    # Cookieファイルがあれば追加
+    ck = cookie_pool.pick(platform) if platform in COOKIE_PATHS else None
+    if ck:
+        opts["cookiefile"] = str(ck)
+        print(f"Using cookie file: {ck}")
+    return opts
+
+PROGRESS_PREFIX = "[videodl-progress]"
+PROGRESS_TEMPLATE = (
+    "download:" + PROGRESS_PREFIX + " %(progress.downloaded_bytes)s %(progress.total_bytes)s"
+    " %(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
+)
+
+def parse_progress_line(line: str) -> tuple[int, int | None, float | None, float | None] | None:
+    """PROGRESS_TEMPLATE の出力行を (取得済みバイト, 合計バイト, 速度B/s, 残り秒) に変換。進捗行でなければNone"""
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    def num(value: str) -> float | None:
+        try:
+            return float(value)
+        except ValueError:  # "NA"
+            return None
+    fields = [num(v) for v in line[len(PROGRESS_PREFIX):].split()]
+    if len(fields) != 5 or fields[0] is None:
+        return None
+    downloaded, total, estimate, speed, eta = fields
+    total = total or estimate
+    return int(downloaded), int(total) if total else None, speed, eta
+
+def ytdl_command(opts: dict, url: str, info_path: str | None = None) -> list[str]:
+    """
+    YoutubeDLのパラメータをyt-dlpコマンドライン引数に変換（subprocessバックエンド用）
+    info_path: 事前取得したメタデータJSON（あれば情報抽出を省略）
+    """
+    cmd = [YTDL]
+    if "format" in opts:
+        cmd.extend(["-f", opts["format"]])
+    if "format_sort" in opts:
+        cmd.extend(["-S", ",".join(opts["format_sort"])])
+    if "merge_output_format" in opts:
+        cmd.extend(["--merge-output-format", opts["merge_output_format"]])
+    if opts.get("writethumbnail"):
+        cmd.append("--write-thumbnail")
+    if "cookiefile" in opts:
+        cmd.extend(["--cookies", opts["cookiefile"]])
+    if "playlistend" in opts:
+        cmd.extend(["--playlist-end", str(opts["playlistend"])])
+    if opts.get("concurrent_fragment_downloads", 1) > 1:
+        cmd.extend(["-N", str(opts["concurrent_fragment_downloads"])])
+    # 進捗は1行ずつ機械可読な形式で出力させる
+    cmd.extend(["--newline", "--progress-template", PROGRESS_TEMPLATE])
+    cmd.extend(["-o", opts["outtmpl"]])
+    if info_path:
+        cmd.extend(["--load-info-json", info_path])
+    else:
+        cmd.append(url)
+    return cmd
+
+def write_info_json(info: dict, directory: str) -> str:
+    """事前取得したメタデータを --load-info-json 用に書き出す"""
+    fd, path = tempfile.mkstemp(suffix=".info.json", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump(info, f)
+    return path
+
+class _YtdlErrorLogger:
+    """YoutubeDLのエラーメッセージを収集するロガー"""
+
+    def __init__(self):
+        self.errors = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+_worker_progress_queue = None
+
+def _ytdl_pool_init(progress_queue=None):
+    """常駐プロセスの初期化: yt-dlpと全抽出モジュールを事前に読み込む"""
+    global _worker_progress_queue
+    _worker_progress_queue = progress_queue
+    from yt_dlp.extractor import gen_extractor_classes
+    gen_extractor_classes()
+
+def _pool_progress_hook(token: int):
+    """常駐プロセスから親プロセスへ進捗を送るyt-dlpのprogress_hook（0.5秒毎に間引く）"""
+    last = 0.0
+
+    def hook(d: dict):
+        nonlocal last
+        now = time.monotonic()
+        if d.get("status") != "downloading" or now - last < 0.5:
+            return
+        last = now
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        _worker_progress_queue.put((token, d.get("downloaded_bytes") or 0, total, d.get("speed"), d.get("eta")))
+    return hook
+
+def _ytdl_pool_probe(url: str, opts: dict) -> tuple[int, str, dict | None]:
+    """常駐プロセス上でメタデータのみ取得。(終了コード, エラーメッセージ, メタデータ)を返す"""
+    import yt_dlp
+    logger = _YtdlErrorLogger()
+    params = dict(opts, quiet=True, no_warnings=True, noprogress=True, logger=logger)
+    try:
+        with yt_dlp.YoutubeDL(params) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return 0, "\n".join(logger.errors), ydl.sanitize_info(info)
+    except Exception as e:
+        return 1, "\n".join(logger.errors) or str(e), None
+
+def _ytdl_pool_download(url: str, opts: dict, info: dict | None = None,
+                        progress_token: int | None = None) -> tuple[int, str, dict]:
+    """
+    常駐プロセス上でダウンロードを実行。(終了コード, エラーメッセージ, 段階別所要時間)を返す
+    info: 事前取得したメタデータ（あれば情報抽出を省略）
+    progress_token: 進捗を親プロセスへ送る場合の識別子
+    """
+    import yt_dlp
+    logger = _YtdlErrorLogger()
+    params = dict(opts, quiet=True, no_warnings=True, noprogress=True, logger=logger)
+    if progress_token is not None and _worker_progress_queue is not None:
+        params["progress_hooks"] = [_pool_progress_hook(progress_token)]
+    timings = {}
+    try:
+        with yt_dlp.YoutubeDL(params) as ydl:
+            # 情報抽出とダウンロードを分けて計測する
+            if info is None:
+                start = time.perf_counter()
+                info = ydl.extract_info(url, download=False)
+                timings["ytdl_extract"] = time.perf_counter() - start
+            start = time.perf_counter()
+            ydl.process_ie_result(info, download=True)
+            timings["ytdl_download"] = time.perf_counter() - start
+    except Exception as e:
+        return 1, "\n".join(logger.errors) or str(e), timings
+    return 0, "\n".join(logger.errors), timings
+
+ytdl_pool = None
+ytdl_pool_warmup = []  # 常駐プロセスの起動・インポート完了を待つFuture（ウォームアップで待つ）
+ytdl_progress_queue = None
+progress_listeners: dict[int, tuple[asyncio.AbstractEventLoop, object]] = {}
+_progress_tokens = itertools.count(1)
+
+def _progress_listener_loop():
+    """常駐プロセスからの進捗を受け取り、登録されたコールバックをイベントループ上で呼び出す"""
+    while True:
+        token, *values = ytdl_progress_queue.get()
+        listener = progress_listeners.get(token)
+        if listener:
+            loop, callback = listener
+            loop.call_soon_threadsafe(callback, *values)
+
+def start_ytdl_pool():
+    """常駐yt-dlpプロセスプールを起動（スレッド生成前にforkするため起動時に呼び出す）"""
+    global ytdl_pool, ytdl_pool_warmup, ytdl_progress_queue
+    if YTDL_BACKEND != "pool":
+        return
+    try:
+        ctx = multiprocessing.get_context("fork")
+        ytdl_progress_queue = ctx.SimpleQueue()
+        ytdl_pool = ProcessPoolExecutor(
+            max_workers=max(1, YTDL_POOL_WORKERS),
+            mp_context=ctx,
+            initializer=_ytdl_pool_init,
+            initargs=(ytdl_progress_queue,),
+        )
+        # 全プロセスを起動してインポートを進めておく（完了は待たずにログインへ進む）
+        ytdl_pool_warmup = [ytdl_pool.submit(os.getpid) for _ in range(max(1, YTDL_POOL_WORKERS))]
+        threading.Thread(target=_progress_listener_loop, name="ytdl-progress", daemon=True).start()
+        print(f"yt-dlpプロセスプール起動開始 (workers={YTDL_POOL_WORKERS})")
+    except Exception as e:
+        print(f"yt-dlpプロセスプール起動エラー（subprocessを使用します）: {e}")
+        ytdl_pool = None
+
+def drop_ytdl_pool(pool: ProcessPoolExecutor, error: Exception):
+    """
+    異常終了したプロセスプールを破棄し、以降のジョブはsubprocessで実行する
+    スレッド起動後のforkは安全でないため、プールは作り直さない
+    """
+    global ytdl_pool
+    if ytdl_pool is pool:
+        ytdl_pool = None
+        print(f"yt-dlpプロセスプールが異常終了しました（以降はsubprocessを使用します）: {error}")
+        pool.shutdown(wait=False, cancel_futures=True)
+
+async def pump_lines(stream: asyncio.StreamReader, on_line):
+    """プロセス出力を1行ずつ読んでコールバックに渡す（出力全体をメモリに溜めない）"""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # 上限を超える長さの行は readline が読み捨て済み（続く行はそのまま読む）
+            continue
+        if not line:
+            return
+        on_line(line.decode(errors="replace").rstrip())
+
+def ytdl_output_handler(tail: deque | None, progress=None):
+    """yt-dlpの出力行を進捗と、エラー報告用の末尾行(tail)に振り分けるハンドラを作る"""
+    def on_line(line: str):
+        parsed = parse_progress_line(line)
+        if parsed:
+            if progress:
+                progress(*parsed)
+        elif line and tail is not None:
+            tail.append(line)
+    return on_line
+
+async def run_ytdl_subprocess(url: str, opts: dict, info: dict | None = None, progress=None) -> tuple[int, str]:
+    """yt-dlpを外部プロセスとして実行（フォールバック）"""
+    info_path = write_info_json(info, os.path.dirname(opts["outtmpl"])) if info else None
+    cmd = ytdl_command(opts, url, info_path)
+    print(f"Running command: {' '.join(cmd)}")
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # 標準出力は進捗のみ利用し、エラー報告には標準エラーの末尾だけを残す
+    tail = deque(maxlen=YTDL_STDERR_TAIL_LINES)
+    try:
+        await asyncio.gather(
+            pump_lines(proc.stdout, ytdl_output_handler(None, progress)),
+            pump_lines(proc.stderr, ytdl_output_handler(tail, progress)),
+        )
+        await proc.wait()
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    return proc.returncode, "\n".join(tail)
+
+async def run_ytdl(url: str, opts: dict, platform: str = "unknown", info: dict | None = None,
+                   progress=None) -> tuple[int, str]:
+    """
+    設定されたバックエンドでダウンロードを実行。(終了コード, エラーメッセージ)を返す
+    プラットフォーム別のレート制限に従い、レート制限・ログイン要求で失敗した場合は待機・クッキーを替えて再試行する
+    info: probe_media で取得済みのメタデータ（あれば情報抽出を省略）
+    progress: progress(downloaded_bytes, total_bytes, speed, eta) をイベントループ上で呼び出すコールバック
+    """
+    async def attempt(attempt_opts: dict) -> tuple[int, str, None]:
+        returncode, error_msg = await _run_ytdl_once(url, attempt_opts, platform, info, progress)
+        return returncode, error_msg, None
+    returncode, error_msg, _ = await with_platform_limits(url, platform, opts, attempt, charge=info is None)
+    return returncode, error_msg
+
+async def _run_ytdl_once(url: str, opts: dict, platform: str, info: dict | None, progress) -> tuple[int, str]:
+    want = opts.get("concurrent_fragment_downloads", 1)
+    if want <= 1:
+        return await _run_ytdl_backend(url, opts, platform, info, progress)
+    # 断片の同時取得数は、全ジョブ合計の上限から借りられた分だけ使う
+    async with fragment_connections.hold(want) as fragments:
+        if fragments != want:
+            opts = dict(opts, concurrent_fragment_downloads=fragments)
+        return await _run_ytdl_backend(url, opts, platform, info, progress)
+
+async def _run_ytdl_backend(url: str, opts: dict, platform: str, info: dict | None, progress) -> tuple[int, str]:
+    pool = ytdl_pool
+    if pool is not None:
+        loop = asyncio.get_running_loop()
+        token = next(_progress_tokens) if progress else None
+        if token is not None:
+            progress_listeners[token] = (loop, progress)
+        try:
+            STAGE_INFLIGHT.labels("ytdl").inc()
+            try:
+                returncode, error_msg, timings = await loop.run_in_executor(
+                    pool, _ytdl_pool_download, url, opts, info, token
+                )
+            finally:
+                STAGE_INFLIGHT.labels("ytdl").dec()
+                progress_listeners.pop(token, None)
+            for stage, seconds in timings.items():
+                STAGE_SECONDS.labels(stage, platform).observe(seconds)
+            if returncode != 0:
+                STAGE_FAILURES.labels("ytdl", platform).inc()
+            return returncode, error_msg
+        except BrokenProcessPool as e:
+            drop_ytdl_pool(pool, e)
+    with track_stage("ytdl", platform):
+        returncode, error_msg = await run_ytdl_subprocess(url, opts, info, progress)
+    if returncode != 0:
+        STAGE_FAILURES.labels("ytdl", platform).inc()
+    return returncode, error_msg
+
+# --------------------------------------------------
+# 4-4. 事前メタデータ取得（プリフライト）
+# --------------------------------------------------
+class ProbeCache:
+    """URL毎のメタデータを短時間保持するLRUキャッシュ（配信URLには期限があるためTTLは短め）"""
+
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def get(self, key: str) -> dict | None:
+        entry = self.entries.get(key)
+        if not entry or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, info: dict):
+        self.entries[key] = (time.monotonic() + self.ttl, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+probe_cache = ProbeCache(PROBE_CACHE_TTL)
+
+async def probe_media(url: str, platform: str, opts: dict, cache_key: str) -> tuple[str | None, dict | None]:
+    """
+    yt-dlpのメタデータ（形式一覧・サイズ・長さ）を取得。メディア本体はダウンロードしない
+    Returns: (エラーメッセージ, メタデータ)。成功時のエラーメッセージはNone
+    """
+    info = probe_cache.get(cache_key)
+    if info is not None:
+        return None, info
+    returncode, error_msg, info = await with_platform_limits(url, platform, opts, lambda o: _probe_once(url, platform, o))
+    if returncode != 0 or not info:
+        return error_msg or "Unknown error", None
+    probe_cache.put(cache_key, info)
+    return None, info
+
+async def _probe_once(url: str, platform: str, opts: dict) -> tuple[int, str, dict | None]:
+    with track_stage("ytdl_probe", platform):
+        result = None
+        pool = ytdl_pool
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(pool, _ytdl_pool_probe, url, opts)
+            except BrokenProcessPool as e:
+                drop_ytdl_pool(pool, e)
+        if result is not None:
+            returncode, error_msg, info = result
+        else:
+            cmd = ytdl_command(opts, url) + ["-J"]
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate()
+            returncode, error_msg = proc.returncode, stderr.decode(errors="replace")
+            info = json.loads(stdout) if returncode == 0 and stdout else None
+    if returncode != 0 or not info:
+        STAGE_FAILURES.labels("ytdl_probe", platform).inc()
+        return returncode or 1, error_msg, None
+    return 0, error_msg, info
+
+def format_size(fmt: dict, duration: float | None) -> int | None:
+    """形式のサイズ（不明ならビットレート×長さから推定）"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    if fmt.get("tbr") and duration:
+        return int(fmt["tbr"] * 1000 / 8 * duration)
+    return None
+
+def expected_size(info: dict) -> int | None:
+    """選択された形式（マージ時は映像+音声、複数投稿は合計）の予想サイズ"""
+    if info.get("entries"):
+        sizes = [expected_size(entry) for entry in info["entries"] if entry]
+        return sum(sizes) if sizes and all(sizes) else None
+    duration = info.get("duration")
+    if info.get("requested_formats"):
+        sizes = [format_size(f, duration) for f in info["requested_formats"]]
+        return sum(sizes) if all(sizes) else None
+    return format_size(info, duration)
+
+def fitting_format(info: dict, limit: int) -> tuple[str, int] | None:
+    """上限サイズに収まる映像+音声の単一形式のうち最大のもの。(format_id, サイズ)を返す"""
+    duration = info.get("duration")
+    candidates = []
+    for fmt in info.get("formats") or []:
+        if fmt.get("vcodec") == "none" or fmt.get("acodec") == "none":
+            continue
+        size = format_size(fmt, duration)
+        if size and size <= limit * 0.95:
+            candidates.append((size, fmt["format_id"]))
+    if not candidates:
+        return None
+    size, format_id = max(candidates)
+    return format_id, size
+
+class ThroughputEstimator:
+    """プラットフォーム毎の処理速度（ダウンロード〜アップロード完了）の指数移動平均"""
+
+    def __init__(self, default_bps: float = 2 * 1024 * 1024, alpha: float = 0.3):
+        self.default_bps = default_bps
+        self.alpha = alpha
+        self.rates: dict[str, float] = {}
+
+    def observe(self, platform: str, nbytes: int, seconds: float):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        prev = self.rates.get(platform)
+        self.rates[platform] = rate if prev is None else prev + self.alpha * (rate - prev)
+
+    def eta(self, platform: str, nbytes: int) -> float:
+        return nbytes / self.rates.get(platform, self.default_bps)
+
+throughput = ThroughputEstimator()
+
+# --------------------------------------------------
+# 4-5. 画像取得クライアント
+# --------------------------------------------------
+IMAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
+    'Referer': 'https://www.instagram.com/',
+}
+
+@dataclass
+class ImageFetch:
+    status: int
+    path: str | None = None
+    size: int = 0
+    md5: str | None = None
+
+class ImageFetcher:
+    """
+    ホスト毎にkeep-alive接続を使い回す非同期の画像取得
+    同じメッセージ内の画像は prefetch で先に並行取得しておき、ジョブ実行時に fetch で受け取る
+    取得しないまま終わるジョブ（キャッシュ済み・受け入れ不可）は discard で取り消す
+    先行取得もジョブと同じくリソースを予約してから行い、予算が無ければ行わない（ジョブ実行時に取得する）
+    """
+
+    def __init__(self, concurrency: int, per_host: int, chunk_size: int):
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.chunk_size = chunk_size
+        self.session: aiohttp.ClientSession | None = None
+        self.semaphore: asyncio.Semaphore | None = None
+        self.prefetched: dict[str, asyncio.Task] = {}
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        # イベントループ上で初めて使われた時に作成する
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency * 2,
+                limit_per_host=self.per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=IMAGE_HEADERS)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def _download(self, url: str, file_path: str) -> ImageFetch:
+        session = self._ensure_session()
+        async with self.semaphore:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return ImageFetch(response.status)
+                hasher = hashlib.md5()
+                size = 0
+                async with aiofiles.open(file_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await f.write(chunk)
+                        hasher.update(chunk)
+                        size += len(chunk)
+                return ImageFetch(200, file_path, size, hasher.hexdigest())
+
+    async def _prefetch(self, url: str, filename: str) -> tuple[ImageFetch, "Reservation"] | None:
+        reservation = await resource_governor.try_acquire(IMAGE_JOB_DISK, IMAGE_JOB_MEMORY)
+        if reservation is None:
+            return None
+        workdir = tempfile.mkdtemp(prefix="prefetch-", dir=JOB_DIR)
+        reservation.path = workdir
+        try:
+            result = await self._download(url, os.path.join(workdir, filename))
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            resource_governor.release(reservation)
+            raise
+        if result.path is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return result, reservation
+
+    def prefetch(self, url: str, filename: str):
+        """
+        ジョブの順番待ちの間に取得を始めておく
+        同時に取得するのは concurrency 件（IMAGE_FETCH_CONCURRENCY）まで、取得済みで未使用の画像は
+        リソースの予約の範囲まで（予算が無い分は取得せず、ジョブ実行時に取得する）
+        """
+        if url in self.prefetched:
+            return
+        self.prefetched[url] = asyncio.create_task(self._prefetch(url, filename))
+
+    async def fetch(self, url: str, file_path: str) -> ImageFetch:
+        """画像を file_path に保存。先行取得済みならその結果を移動して返す"""
+        task = self.prefetched.pop(url, None)
+        prefetched = await task if task is not None else None
+        if prefetched is None:
+            return await self._download(url, file_path)
+        result, reservation = prefetched
+        try:
+            if result.path:
+                prefetch_dir = os.path.dirname(result.path)
+                shutil.move(result.path, file_path)
+                shutil.rmtree(prefetch_dir, ignore_errors=True)
+                result.path = file_path
+            return result
+        finally:
+            # 移動後のファイルはジョブ自身の予約に含まれる
+            resource_governor.release(reservation)
+
+    def discard(self, url: str):
+        """使われなかった先行取得を取り消し、作業ディレクトリと予約を解放する"""
+        task = self.prefetched.pop(url, None)
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()  # 取得中の場合は _prefetch が作業ディレクトリと予約を解放する
+        elif not task.cancelled() and task.exception() is None and task.result() is not None:
+            result, reservation = task.result()
+            if result.path:
+                shutil.rmtree(os.path.dirname(result.path), ignore_errors=True)
+            resource_governor.release(reservation)
+
+    async def close(self):
+        for url in list(self.prefetched):
+            self.discard(url)
+        if self.session is not None:
+            await self.session.close()
+
+image_fetcher = ImageFetcher(IMAGE_FETCH_CONCURRENCY, IMAGE_CONN_PER_HOST, IMAGE_CHUNK_KB * 1024)
+
+def image_filename_for(url: str) -> str:
+    """URLから画像のファイル名を決める"""
+    filename = os.path.basename(urlparse(url).path)
+    if not filename or '.' not in filename:
+        filename = f"image_{int(time.time() * 1000)}.jpg"
+    return filename
+
+# --------------------------------------------------
+# 4-6. リソース管理（ディスク・メモリの受け入れ制御）
+# --------------------------------------------------
+RESOURCE_RESERVED = Gauge("videodl_resource_reserved_bytes", "受け入れたジョブが予約したディスク・メモリ(バイト)", ["resource"])
+
+class InsufficientResources(Exception):
+    """他のジョブが終わっても予算に収まらないジョブ"""
+
+def dir_size(path: str) -> int:
+    """ディレクトリ以下のファイルサイズ合計"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def process_tree_rss() -> int:
+    """自身と子孫プロセス（yt-dlp・ffmpeg・常駐プロセス）のRSS合計。/procが無い環境では0"""
+    parents: dict[int, int] = {}
+    rss: dict[int, int] = {}
+    try:
+        entries = list(os.scandir("/proc"))
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                parents[int(entry.name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry.name}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss[int(entry.name)] = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+    tree = {os.getpid()}
+    grew = True
+    while grew:
+        children = {pid for pid, ppid in parents.items() if ppid in tree} - tree
+        grew = bool(children)
+        tree |= children
+    return sum(rss.get(pid, 0) for pid in tree)
+
+def detect_memory_limit() -> int:
+    """cgroupのメモリ上限（無ければ搭載メモリ）の85%"""
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            value = f.read().strip()
+        if value != "max":
+            return int(int(value) * 0.85)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(int(line.split()[1]) * 1024 * 0.85)
+    except (OSError, ValueError):
+        pass
+    return 1024 * 1024 * 1024
+
+@dataclass
+class Reservation:
+    disk: int
+    memory: int
+    path: str | None = None  # 作業ディレクトリ（使用済みの分は予約から差し引く）
+
+class ResourceGovernor:
+    """
+    ジョブ開始前に想定ディスク・メモリ使用量を予約し、予算を超える場合は他のジョブが終わるまで待たせる
+    ディスクは実際の空き容量から予約の未使用分を差し引いて判定し、
+    メモリは予約の合計と現在のRSSの両方が上限に収まるかで判定する
+    """
+
+    def __init__(self, root: str, disk_reserve: int, memory_limit: int, poll_interval: float = 2.0):
+        self.root = root
+        self.disk_reserve = disk_reserve
+        self.memory_limit = memory_limit
+        self.poll_interval = poll_interval
+        self.reservations: list[Reservation] = []
+        self.baseline_rss = 0
+        self.changed: asyncio.Event | None = None
+        self.lock = asyncio.Lock()
+
+    def _fits(self, disk: int, memory: int, reservations: list[Reservation]) -> bool:
+        """作業ディレクトリの走査と /proc の読み込みを行うため、スレッドで呼び出す"""
+        pending = sum(max(0, r.disk - (dir_size(r.path) if r.path else 0)) for r in reservations)
+        disk_free = shutil.disk_usage(self.root).free - self.disk_reserve - pending
+        if disk > disk_free:
+            return False
+        rss = process_tree_rss()
+        if not reservations:
+            # 待機中のジョブが無い時点のRSSを基準（常駐プロセス等）とする
+            self.baseline_rss = rss
+        reserved = self.baseline_rss + sum(r.memory for r in reservations)
+        return max(reserved, rss) + memory <= self.memory_limit
+
+    async def _reserve(self, disk: int, memory: int) -> Reservation | None:
+        """予算に収まれば予約する（判定から予約までを直列にし、同時に判定したジョブが予算を超えないように）"""
+        async with self.lock:
+            if not await asyncio.to_thread(self._fits, disk, memory, list(self.reservations)):
+                return None
+            reservation = Reservation(disk, memory)
+            self.reservations.append(reservation)
+            self._update_metrics()
+            return reservation
+
+    async def acquire(self, disk: int, memory: int, platform: str = "unknown", on_wait=None) -> Reservation:
+        """
+        予算に収まるまで待ってから予約する。終わったら必ず release すること
+        on_wait: 待ち始めた時に一度だけ呼ぶコルーチン関数
+        """
+        if self.changed is None:
+            self.changed = asyncio.Event()
+        with track_stage("admission", platform):
+            return await self._wait_for_budget(disk, memory, on_wait)
+
+    async def try_acquire(self, disk: int, memory: int) -> Reservation | None:
+        """待たずに予約する（先行取得用）。予算に収まらなければNone"""
+        return await self._reserve(disk, memory)
+
+    async def _wait_for_budget(self, disk: int, memory: int, on_wait) -> Reservation:
+        waited = False
+        while (reservation := await self._reserve(disk, memory)) is None:
+            if not self.reservations:
+                raise InsufficientResources(
+                    f"空き容量・メモリが不足しています（必要: ディスク {disk / (1024 * 1024):.0f}MB・"
+                    f"メモリ {memory / (1024 * 1024):.0f}MB）"
+                )
+            if not waited and on_wait:
+                await on_wait()
+            waited = True
+            self.changed.clear()
+            try:
+                # 解放の通知か、一定時間毎の再確認（外部要因で空きが増える場合）
+                await asyncio.wait_for(self.changed.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        return reservation
+
+    def release(self, reservation: Reservation):
+        if reservation in self.reservations:
+            self.reservations.remove(reservation)
+            self._update_metrics()
+            if self.changed is not None:
+                self.changed.set()
+
+    def _update_metrics(self):
+        RESOURCE_RESERVED.labels("disk").set(sum(r.disk for r in self.reservations))
+        RESOURCE_RESERVED.labels("memory").set(sum(r.memory for r in self.reservations))
+
+resource_governor = ResourceGovernor(
+    JOB_DIR,
+    DISK_RESERVE_MB * 1024 * 1024,
+    MEMORY_LIMIT_MB * 1024 * 1024 if MEMORY_LIMIT_MB > 0 else detect_memory_limit(),
+)
+
+IMAGE_JOB_DISK = 20 * 1024 * 1024  # 画像ジョブの想定ディスク使用量
+IMAGE_JOB_MEMORY = 16 * 1024 * 1024  # 画像ジョブの想定メモリ使用量（ストリーミング書き込みのため小さい）
+
+def job_disk_estimate(size: int | None, merge: bool = True) -> int:
+    """ジョブのディスク使用量の見積もり（映像と音声を結合する場合は結合前後の両方が必要）"""
+    if not size:
+        return JOB_DISK_DEFAULT_MB * 1024 * 1024
+    return int(size * (2.2 if merge else 1.2))
+
+async def admit_job(channel, url: str, platform: str, disk: int, memory: int) -> Reservation | None:
+    """リソースを予約してジョブを開始できるようにする。予算に収まらないジョブは失敗を返信してNone"""
+    async def notify():
+        await channel.send(f"⏳ 空き容量・メモリ待ち: {url}")
+    try:
+        return await resource_governor.acquire(disk, memory, platform, on_wait=notify)
+    except InsufficientResources as e:
+        STAGE_FAILURES.labels("admission", platform).inc()
+        await deliver(channel, platform, "failed", f"❌ {e}: {url}")
+        print(f"✖ NOT ADMITTED: {url} - {e}")
+        return None
+
+def sweep_scratch_root():
+    """
+    前回までのプロセスが残した作業ディレクトリ・一時ファイルを削除（再開するジョブのものは残す）
+    ジョブの受け付けと並行してスレッドで実行するため、起動後に作成・更新されたものには触れない
+    """
+    keep = {job["temp_path"] for job in job_journal.unfinished() if job["temp_path"]}
+    removed = freed = 0
+    for entry in os.scandir(JOB_DIR):
+        if entry.path in keep or entry.name.startswith("worker-"):
+            # worker-* は同じボリュームで動く各ワーカーの作業領域（各ワーカーが自分で片付ける）
+            continue
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime >= PROCESS_START_WALL:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                size = dir_size(entry.path)
+                shutil.rmtree(entry.path)
+            else:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+        except OSError as e:
+            print(f"作業領域の削除エラー: {entry.path} - {e}")
+            continue
+        removed += 1
+        freed += size
+    if removed:
+        print(f"前回の作業ディレクトリを削除: {removed}件 ({freed / (1024 * 1024):.1f} MB)")
+
+# --------------------------------------------------
+# 4-7. プラットフォーム別レート制限とクッキーローテーション
+# --------------------------------------------------
+YTDL_ERRORS = Counter("videodl_ytdl_errors_total", "yt-dlpの失敗数（原因の分類別）", ["platform", "kind"])
+YTDL_RETRIES = Counter("videodl_ytdl_retries_total", "レート制限・ログイン要求で再試行したyt-dlpの実行数", ["platform"])
+
+# yt-dlpのエラー出力の分類（上から順に判定）
+YTDL_ERROR_PATTERNS = [
+    ("rate_limited", re.compile(r"HTTP Error 429|Too Many Requests|rate.?limit|try again later", re.I)),
+    ("login_required", re.compile(
+        r"login required|log ?in to|sign in to|requires authentication|--cookies|"
+        r"HTTP Error 401|HTTP Error 403|private", re.I)),
+    ("not_found", re.compile(r"HTTP Error 404|not found|does not exist|no video|unavailable|been removed|deleted", re.I)),
+]
+ERROR_REASONS = {
+    "rate_limited": "（レート制限中）",
+    "login_required": "（ログインが必要）",
+    "not_found": "（見つからないか削除済み）",
+}
+
+def classify_ytdl_error(error_msg: str) -> str:
+    """yt-dlpのエラー出力を rate_limited / login_required / not_found / other に分類"""
+    for kind, pattern in YTDL_ERROR_PATTERNS:
+        if pattern.search(error_msg or ""):
+            return kind
+    return "other"
+
+def parse_platform_rates(spec: str) -> dict[str, float]:
+    """"instagram=20,twitter=40" 形式の設定（1分あたりの回数）を辞書に変換"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            rates[name.strip().lower()] = float(value)
+        except ValueError:
+            print(f"⚠️ PLATFORM_RATE_PER_MIN の値が不正です: {item}")
+    return rates
+
+class PlatformLimiter:
+    """
+    プラットフォーム毎のトークンバケット
+    レート制限を受けると指数的に延びる待機時間（ジッター付き）の間、そのプラットフォームの実行を止める
+    """
+
+    def __init__(self, rates_per_min: dict[str, float], burst: int, backoff_base: float, backoff_max: float):
+        self.rates = {name: rate / 60 for name, rate in rates_per_min.items() if rate > 0}
+        self.burst = max(1, burst)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens: dict[str, float] = {}
+        self.updated: dict[str, float] = {}
+        self.strikes: dict[str, int] = {}
+        self.blocked_until: dict[str, float] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def blocked_for(self, platform: str) -> float:
+        """バックオフ中なら残り秒数"""
+        return max(0.0, self.blocked_until.get(platform, 0.0) - time.monotonic())
+
+    async def acquire(self, platform: str, charge: bool = True):
+        """
+        バックオフ明けとトークンを待つ（プラットフォーム毎に順番に払い出す）
+        charge: Falseならバックオフだけ守り、トークンは消費しない（抽出済みでCDNから取得するだけの場合）
+        """
+        lock = self.locks.setdefault(platform, asyncio.Lock())
+        async with lock:
+            while self.blocked_for(platform) > 0:
+                await asyncio.sleep(self.blocked_for(platform))
+            rate = self.rates.get(platform)
+            if rate is None or not charge:
+                return
+            now = time.monotonic()
+            tokens = self.tokens.get(platform, float(self.burst))
+            tokens = min(self.burst, tokens + (now - self.updated.get(platform, now)) * rate)
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / rate)
+                tokens = 1.0
+                now = time.monotonic()
+            self.tokens[platform] = tokens - 1
+            self.updated[platform] = now
+
+    def record(self, platform: str, outcome: str) -> float:
+        """結果を記録。レート制限ならバックオフを延ばして待機秒数を返す"""
+        if outcome == "ok":
+            self.strikes.pop(platform, None)
+            return 0.0
+        if outcome != "rate_limited":
+            return 0.0
+        strikes = self.strikes.get(platform, 0) + 1
+        self.strikes[platform] = strikes
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (strikes - 1)) * random.uniform(0.5, 1.5)
+        self.blocked_until[platform] = max(self.blocked_until.get(platform, 0.0), time.monotonic() + delay)
+        # トークンも使い切った扱いにして、明けた直後に集中しないようにする
+        self.tokens[platform] = 0.0
+        self.updated[platform] = time.monotonic() + delay
+        print(f"⚠️ {platform} がレート制限中のため {delay:.0f}秒 待機します（{strikes}回目）")
+        return delay
+
+@dataclass
+class CookieHealth:
+    failures: int = 0
+    cooldown_until: float = 0.0
+    last_used: float = 0.0
+
+class CookiePool:
+    """
+    COOKIE_DIR 内のプラットフォーム毎の複数のクッキーファイル（{platform}_cookies*.txt）を順番に使う
+    ログイン要求・レート制限を受けたクッキーはしばらく休ませ、成功したら状態を戻す
+    ファイル一覧はメモリに保持し、ディレクトリの更新時刻が変わった時だけ読み直す（ジョブ毎にディスクを見ない）
+    """
+    RESCAN_SEC = 10  # ディレクトリの更新時刻を確認する最小間隔(秒)
+
+    def __init__(self, cookie_dir: str, cooldown_base: float, cooldown_max: float):
+        self.cookie_dir = Path(cookie_dir)
+        self.cooldown_base = cooldown_base
+        self.cooldown_max = cooldown_max
+        self.health: dict[str, CookieHealth] = {}
+        self.inventory: dict[str, list[Path]] = {}
+        self.dir_mtime: float | None = None
+        self.checked_at = float("-inf")
+
+    def refresh(self, force: bool = False):
+        """クッキーファイルの一覧を必要なら読み直す"""
+        now = time.monotonic()
+        if not force and now - self.checked_at < self.RESCAN_SEC:
+            return
+        self.checked_at = now
+        try:
+            mtime = self.cookie_dir.stat().st_mtime
+        except OSError:
+            mtime = None
+        if not force and mtime == self.dir_mtime:
+            return
+        inventory: dict[str, list[Path]] = {}
+        if mtime is not None:
+            with os.scandir(self.cookie_dir) as it:
+                for entry in it:
+                    platform, sep, _ = entry.name.partition("_cookies")
+                    if sep and entry.name.endswith(".txt") and entry.is_file():
+                        inventory.setdefault(platform, []).append(Path(entry.path))
+        for paths in inventory.values():
+            paths.sort()
+        if inventory != self.inventory:
+            total = sum(len(paths) for paths in inventory.values())
+            print(f"クッキー一覧を更新: {total}件 " + ", ".join(f"{k}={len(v)}" for k, v in sorted(inventory.items())))
+        self.inventory = inventory
+        self.dir_mtime = mtime
+
+    def files(self, platform: str) -> list[Path]:
+        self.refresh()
+        return self.inventory.get(platform, [])
+
+    def pick(self, platform: str, exclude: str | None = None) -> Path | None:
+        """休止中でないクッキーのうち、失敗が少なく最後に使ってから長いもの。全て休止中なら最も早く明けるもの"""
+        candidates = [p for p in self.files(platform) if str(p) != exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healths = {p: self.health.setdefault(str(p), CookieHealth()) for p in candidates}
+        ready = [p for p in candidates if healths[p].cooldown_until <= now]
+        if ready:
+            chosen = min(ready, key=lambda p: (healths[p].failures, healths[p].last_used))
+        else:
+            chosen = min(candidates, key=lambda p: healths[p].cooldown_until)
+        healths[chosen].last_used = now
+        return chosen
+
+    def record(self, cookie: str | None, outcome: str):
+        if not cookie:
+            return
+        health = self.health.setdefault(cookie, CookieHealth())
+        if outcome == "ok":
+            health.failures = 0
+            health.cooldown_until = 0.0
+        elif outcome in ("rate_limited", "login_required"):
+            health.failures += 1
+            cooldown = min(self.cooldown_max, self.cooldown_base * 2 ** (health.failures - 1))
+            health.cooldown_until = time.monotonic() + cooldown
+            print(f"⚠️ クッキーを一時休止: {Path(cookie).name}（{outcome}, {cooldown:.0f}秒）")
+
+platform_limiter = PlatformLimiter(
+    parse_platform_rates(PLATFORM_RATE_PER_MIN), RATE_BURST, BACKOFF_BASE_SEC, BACKOFF_MAX_SEC
+)
+cookie_pool = CookiePool(COOKIE_DIR, BACKOFF_BASE_SEC, BACKOFF_MAX_SEC)
+
+async def with_platform_limits(url: str, platform: str, opts: dict, attempt,
+                               charge: bool = True) -> tuple[int, str, object]:
+    """
+    レート制限に従って attempt(opts) -> (終了コード, エラーメッセージ, 結果) を実行する
+    レート制限ならバックオフ後に、ログイン要求なら別のクッキーがある場合に再試行する
+    charge: 情報抽出を伴う（トークンを消費する）か
+    """
+    for retry in range(RATE_RETRY_MAX + 1):
+        await platform_limiter.acquire(platform, charge)
+        returncode, error_msg, result = await attempt(opts)
+        outcome = "ok" if returncode == 0 else classify_ytdl_error(error_msg)
+        if outcome != "ok":
+            YTDL_ERRORS.labels(platform, outcome).inc()
+        platform_limiter.record(platform, outcome)
+        cookie = opts.get("cookiefile")
+        cookie_pool.record(cookie, outcome)
+        if outcome not in ("rate_limited", "login_required") or retry == RATE_RETRY_MAX:
+            break
+        # 別のクッキーに切り替える（ログイン要求で他に候補が無ければ諦める）
+        alternative = cookie_pool.pick(platform, exclude=cookie) if platform in COOKIE_PATHS else None
+        if alternative:
+            opts = dict(opts, cookiefile=str(alternative))
+            print(f"クッキーを切り替えて再試行: {alternative.name}")
+        elif outcome == "login_required":
+            break
+        YTDL_RETRIES.labels(platform).inc()
+        print(f"再試行 ({retry + 1}/{RATE_RETRY_MAX}): {url} - {outcome}")
+    return returncode, error_msg, result
+
+def failure_reason(error_msg: str) -> str:
+    """失敗メッセージに添える原因（分類できない場合は空）"""
+    return ERROR_REASONS.get(classify_ytdl_error(error_msg), "")
+
+# --------------------------------------------------
+# 4-8. URLの振り分け（正規化・短縮URLの展開）
+# --------------------------------------------------
+@dataclass(frozen=True)
+class Route:
+    """URLの振り分け結果"""
+    url: str  # 追跡パラメータを除いた（短縮URLは展開した）URL。画像・未対応のURLは元のまま
+    platform: str  # MEDIA_PLATFORMS のいずれか / "image" / "unknown"
+    media_id: str | None = None
+    short: bool = False  # 展開が必要な短縮URL
+
+    @property
+    def key(self) -> str:
+        """同じメディアを同一視するためのキー（MediaCacheのキーと同じ形式）"""
+        return f"{self.platform}:{self.media_id or self.url}"
+
+# ホスト → [(プラットフォーム, パスの正規表現, IDを渡すクエリ名)]
+ROUTE_INDEX: dict[str, list[tuple[str, re.Pattern, str | None]]] = {}
+for _platform, _hosts, _pattern, _query_id in URL_ROUTES:
+    for _host in _hosts:
+        ROUTE_INDEX.setdefault(_host, []).append((_platform, re.compile(_pattern), _query_id))
+
+def host_routes(host: str) -> list[tuple[str, re.Pattern, str | None]]:
+    """サブドメインを順に外しながら振り分け表を引く（www.x.com → x.com）"""
+    labels = host.split(".")
+    for i in range(len(labels) - 1):
+        routes = ROUTE_INDEX.get(".".join(labels[i:]))
+        if routes:
+            return routes
+    return []
+
+def strip_tracking(parts) -> str:
+    """追跡・共有用のクエリとフラグメントを除いたURL"""
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+@lru_cache(maxsize=4096)
+def route_url(url: str) -> Route:
+    """URLを1回だけ解析し、ホストで振り分け表を引いてプラットフォームとメディアIDを求める（通信なし）"""
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+    except ValueError:
+        return Route(url, "unknown")
+    routes = host_routes(host)
+    for platform, pattern, query_id in routes:
+        m = pattern.match(parts.path)
+        media_id = m.group(1) if m else None
+        if media_id is None and query_id:
+            media_id = dict(parse_qsl(parts.query)).get(query_id)
+            if media_id:
+                # watch?v=ID&list=... は再生リストごと取得されないようIDだけを残す
+                url = urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode({query_id: media_id}), ""))
+                return Route(url, platform, media_id)
+        if media_id:
+            return Route(strip_tracking(parts), platform, media_id)
+    if SHORT_LINK_RE.match(host.removeprefix("www.") + parts.path):
+        return Route(url, routes[0][0] if routes else "unknown", short=True)
+    if is_image_url(url):
+        return Route(url, "image")
+    return Route(url, "unknown")
+
+def extract_urls(text: str) -> list[str]:
+    """メッセージ本文からURLを取り出す（末尾の句読点・対応の無い閉じ括弧は除く）"""
+    urls = []
+    for url in URL_RE.findall(text):
+        url = url.rstrip(".,!?;:'\"")
+        if url.endswith(")") and "(" not in url:
+            url = url[:-1]
+        urls.append(url)
+    return urls
+
+class UrlRouter:
+    """
+    短縮URL（t.co・vm.tiktok.com など）をリダイレクトを辿って展開し、振り分け結果を返す
+    展開結果はTTL付きでキャッシュし、同じURLの同時展開は1回にまとめる
+    """
+
+    MAX_HOPS = 5
+
+    def __init__(self, ttl: float):
+        self.cache = ProbeCache(ttl, max_entries=4096)
+        self.pending: dict[str, asyncio.Task] = {}
+        self.session: aiohttp.ClientSession | None = None
+
+    async def resolve(self, url: str) -> Route:
+        route = route_url(url)
+        if not route.short:
+            return route
+        resolved = self.cache.get(url)
+        if resolved is None:
+            task = self.pending.get(url)
+            if task is None:
+                task = self.pending[url] = asyncio.create_task(self._follow(url))
+                task.add_done_callback(lambda _: self.pending.pop(url, None))
+            resolved = await task
+        if not resolved:
+            # 展開できなければ元のURLのまま（プラットフォームが分かればyt-dlpに任せる）
+            return route
+        target = route_url(resolved)
+        return target if target.platform != "unknown" or route.platform == "unknown" else route
+
+    async def _follow(self, url: str) -> str | None:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        current = url
+        try:
+            with track_stage("resolve", route_url(url).platform):
+                for _ in range(self.MAX_HOPS):
+                    # Locationだけを見る（展開先のページ本体は取得しない）
+                    async with self.session.get(current, allow_redirects=False) as response:
+                        location = response.headers.get("Location")
+                    if response.status not in (301, 302, 303, 307, 308) or not location:
+                        break
+                    current = urljoin(current, location)
+                    if not route_url(current).short:
+                        break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"短縮URLの展開エラー: {url} - {e}")
+            return None
+        if current == url:
+            return None
+        self.cache.put(url, current)
+        print(f"短縮URLを展開: {url} → {current}")
+        return current
+
+    async def route_all(self, urls: list[str]) -> list[Route]:
+        """メッセージ内のURLをまとめて振り分け（短縮URLは並行に展開）、同じメディアは1つにまとめる"""
+        routes = await asyncio.gather(*(self.resolve(url) for url in urls))
+        unique: dict[str, Route] = {}
+        for route in routes:
+            unique.setdefault(route.key, route)
+        return list(unique.values())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+url_router = UrlRouter(SHORT_LINK_CACHE_SEC)
+
+# --------------------------------------------------
+# 4-9. 目標サイズへの再エンコード（!compress）
+# --------------------------------------------------
+COMPRESS_SAFETY = 0.94  # コンテナのオーバーヘッドとレート制御の誤差を見込んだ余裕
+COMPRESS_MIN_VIDEO_KBPS = 60  # これ未満の映像ビットレートでは視聴に耐えないため圧縮しない
+# 映像ビットレート(kbps)に見合う解像度（ビットレートに対して解像度が高すぎるとブロックノイズだらけになる）
+COMPRESS_HEIGHT_LADDER = ((1200, 720), (700, 540), (400, 480), (200, 360), (0, 240))
+
+# 同時に動かすffmpegプロセス数（ジョブをまたいでCPUコア数まで）
+transcode_slots = asyncio.Semaphore(max(1, os.cpu_count() or 1))
+
+@dataclass
+class EncodePlan:
+    video_kbps: int
+    audio_kbps: int
+    height: int
+
+def plan_encode(target: int, duration: float, source_height: int | None = None) -> EncodePlan | None:
+    """目標サイズ(バイト)と長さ(秒)から映像・音声のビットレートと解像度を決める。収まらない場合はNone"""
+    total_kbps = target * 8 * COMPRESS_SAFETY / duration / 1000
+    audio_kbps = 96 if total_kbps >= 1000 else 64 if total_kbps >= 300 else 32
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < COMPRESS_MIN_VIDEO_KBPS:
+        return None
+    height = next(h for kbps, h in COMPRESS_HEIGHT_LADDER if video_kbps >= kbps)
+    if source_height:
+        height = min(height, source_height - source_height % 2)
+    return EncodePlan(video_kbps, audio_kbps, height)
+
+def compress_cache_key(key: str, target_mb: float | None) -> str:
+    """圧縮結果のキャッシュキー（目標サイズを指定した場合は "@25MB" のように区別する）"""
+    return f"compress:{key}" if target_mb is None else f"compress:{key}@{target_mb:g}MB"
+
+def encode_args(plan: EncodePlan, threads: int) -> list[str]:
+    """1パスで目標ビットレートを超えないようにするx264/AACの設定（maxrateで上限を抑える）"""
+    return [
+        "-vf", f"scale=-2:{plan.height}",
+        "-c:v", "libx264", "-preset", COMPRESS_PRESET, "-pix_fmt", "yuv420p",
+        "-b:v", f"{plan.video_kbps}k", "-maxrate", f"{plan.video_kbps}k", "-bufsize", f"{plan.video_kbps * 2}k",
+        "-c:a", "aac", "-b:a", f"{plan.audio_kbps}k", "-ac", "2",
+        "-threads", str(threads),
+    ]
+
+async def probe_video(path: Path) -> tuple[float | None, int | None]:
+    """ffprobeで動画の長さ(秒)と高さを取得"""
+    proc = await asyncio.create_subprocess_exec(
+        FFPROBE, "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=height:format=duration",
+        "-of", "json", str(path),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await proc.communicate()
+    try:
+        probed = json.loads(stdout)
+        duration = float(probed["format"]["duration"])
+    except (ValueError, KeyError, TypeError):
+        return None, None
+    streams = probed.get("streams") or [{}]
+    return duration, streams[0].get("height")
+
+async def run_ffmpeg(args: list[str], on_time=None, slots: asyncio.Semaphore = transcode_slots) -> tuple[int, str]:
+    """ffmpegを実行して (終了コード, エラー出力) を返す。on_time(処理済み秒数) で進捗を通知"""
+    def on_line(line: str):
+        if on_time and line.startswith("out_time_us="):
+            try:
+                on_time(int(line.split("=", 1)[1]) / 1_000_000)
+            except ValueError:
+                pass  # 先頭は N/A
+    tail = deque(maxlen=YTDL_STDERR_TAIL_LINES)
+    async with slots:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG, "-y", "-v", "error", "-nostats", "-progress", "pipe:1", *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            await asyncio.gather(pump_lines(proc.stdout, on_line), pump_lines(proc.stderr, tail.append))
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    return proc.returncode, "\n".join(tail)
+
+def compress_segments(duration: float) -> int:
+    """再エンコードを分割する数。短い動画・1コアでは分割しない"""
+    if duration < COMPRESS_SEGMENT_MIN_SEC:
+        return 1
+    return max(1, COMPRESS_SEGMENTS or min(4, os.cpu_count() or 1))
+
+async def transcode(source: Path, output: Path, plan: EncodePlan, duration: float, progress=None) -> tuple[int, str]:
+    """
+    sourceを plan のビットレートで再エンコードする
+    長い動画は時間で分割して並列にエンコードし、最後に無劣化で連結する
+    progress: progress(処理済み秒数, 全体の秒数)
+    """
+    segments = compress_segments(duration)
+    threads = max(1, (os.cpu_count() or 1) // segments)
+    done = [0.0] * segments
+
+    def report(i: int):
+        def on_time(sec: float):
+            done[i] = sec
+            if progress:
+                progress(sum(done), duration)
+        return on_time
+
+    if segments == 1:
+        return await run_ffmpeg(
+            ["-i", str(source), *encode_args(plan, threads), "-movflags", "+faststart", str(output)], report(0)
+        )
+
+    length = duration / segments
+    parts = [output.with_name(f"{output.stem}.part{i}.mp4") for i in range(segments)]
+    concat_list = output.with_name(f"{output.stem}.txt")
+    try:
+        results = await asyncio.gather(*(
+            run_ffmpeg(
+                # 最後の区間は長さを指定せず末尾まで（丸め誤差でフレームを落とさない）
+                ["-ss", f"{i * length:.3f}", *(["-t", f"{length:.3f}"] if i < segments - 1 else []),
+                 "-i", str(source), *encode_args(plan, threads), str(part)],
+                report(i),
+            )
+            for i, part in enumerate(parts)
+        ))
+        failed = next((r for r in results if r[0] != 0), None)
+        if failed:
+            return failed
+        concat_list.write_text("".join(f"file '{part.name}'\n" for part in parts))
+        return await run_ffmpeg(
+            ["-f", "concat", "-safe", "0", "-i", str(concat_list), "-c", "copy", "-movflags", "+faststart", str(output)]
+        )
+    finally:
+        for part in (*parts, concat_list):
+            part.unlink(missing_ok=True)
+
+async def compress_to_target(source: Path, target: int, platform: str, duration: float | None = None,
+                             progress=None) -> tuple[str | None, Path | None]:
+    """
+    ダウンロード済みのsourceを目標サイズ(バイト)に収まるよう再エンコードする
+    万一収まらなかった場合は、同じsourceからビットレートを下げてもう一度だけ試す（再ダウンロードはしない）
+    Returns: (エラーメッセージ, 出力ファイル)
+    """
+    probed_duration, height = await probe_video(source)
+    duration = probed_duration or duration
+    if not duration:
+        return "動画の長さを取得できませんでした", None
+    plan = plan_encode(target, duration, height)
+    if plan is None:
+        return f"{target / (1024 * 1024):g}MBに収めるには動画が長すぎます（{duration:.0f}秒）", None
+    output = source.with_name(f"compressed_{source.stem}.mp4")
+    for attempt in range(2):
+        print(f"Transcoding: {source.name} → {plan.video_kbps}k/{plan.audio_kbps}k {plan.height}p "
+              f"({compress_segments(duration)} segment(s))")
+        with track_stage("transcode", platform):
+            returncode, error_msg = await transcode(source, output, plan, duration, progress)
+        if returncode != 0:
+            return f"ffmpegエラー: {error_msg}", None
+        actual = output.stat().st_size
+        if actual <= target:
+            return None, output
+        print(f"⚠️ 目標サイズを超過 ({actual} > {target} bytes)。ビットレートを下げて再エンコード")
+        plan.video_kbps = int(plan.video_kbps * target / actual * COMPRESS_SAFETY)
+        if plan.video_kbps < COMPRESS_MIN_VIDEO_KBPS:
+            break
+    return "目標サイズに収まりませんでした", None
+
+# --------------------------------------------------
+# 4-10. faststart リマックス
+# --------------------------------------------------
+# moov が末尾にあるMP4は、Driveのプレビュー・Discordのプレーヤーが大半を取得するまで再生を始められない
+FASTSTART_SUFFIXES = (".mp4", ".m4v", ".mov")
+
+# 再エンコードとは別枠（数秒で終わるリマックスが長い再エンコードの後ろで待たないように）
+remux_slots = asyncio.Semaphore(max(1, REMUX_CONCURRENCY))
+
+def needs_faststart(path: Path) -> bool:
+    """
+    トップレベルのボックスを順に読み、moov より前に mdat があれば True（ファイルを読むためスレッドで呼び出す）
+    サイズが不正なボックス（ヘッダより小さい）があれば壊れたファイルとして False
+    """
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = int.from_bytes(header[:4], "big"), header[4:8]
+                if kind == b"moov":
+                    return False
+                if kind == b"mdat":
+                    return True
+                header_size = 8
+                if size == 1:
+                    largesize = f.read(8)
+                    if len(largesize) < 8:
+                        return False
+                    size, header_size = int.from_bytes(largesize, "big"), 16
+                if size < header_size:
+                    # 0（末尾まで）・不正な値のどちらでも、これ以上読み進められない
+                    return False
+                f.seek(size - header_size, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def mdat_before_moov(head: bytes) -> bool | None:
+    """
+    ストリーミング中の先頭のバイト列からトップレベルのボックスを読む
+    mdat が moov より前なら True・後なら False・判定できなければ（MP4でない等）None
+    """
+    pos = 0
+    while pos + 8 <= len(head):
+        size, kind = int.from_bytes(head[pos:pos + 4], "big"), head[pos + 4:pos + 8]
+        if kind == b"moov":
+            return False
+        if kind == b"mdat":
+            return True
+        if size == 1 and pos + 16 <= len(head):
+            size = int.from_bytes(head[pos + 8:pos + 16], "big")
+        if size < 8:
+            return None
+        pos += size
+    return None
+
+async def faststart_remux(path: Path, platform: str) -> Path:
+    """
+    再エンコードせずに moov を先頭へ移し、映像・音声以外のトラック（字幕・データ）を取り除く
+    既に先頭にある場合・失敗した場合は元のファイルをそのまま使う（同じパスを返す）
+    """
+    if not FASTSTART_REMUX or path.suffix.lower() not in FASTSTART_SUFFIXES:
+        return path
+    if not await asyncio.to_thread(needs_faststart, path):
+        return path
+    # 作業中のファイルは動画の拡張子にしない（中断後の再開時にダウンロード結果として拾わないように）
+    output = path.with_name(f"{path.name}.remux")
+    start = time.monotonic()
+    try:
+        with track_stage("remux", platform):
+            returncode, error_msg = await run_ffmpeg(
+                ["-i", str(path), "-map", "0:v?", "-map", "0:a?", "-map_metadata", "0",
+                 "-c", "copy", "-movflags", "+faststart",
+                 "-f", "mov" if path.suffix.lower() == ".mov" else "mp4", str(output)],
+                slots=remux_slots,
+            )
+            if returncode != 0:
+                raise RuntimeError(error_msg.splitlines()[-1] if error_msg else f"ffmpeg rc={returncode}")
+        os.replace(output, path)
+        print(f"Faststart remux: {path.name} ({time.monotonic() - start:.1f}s)")
+    except Exception as e:
+        print(f"⚠️ リマックス失敗（元のファイルを使用）: {path.name} - {e}")
+    finally:
+        output.unlink(missing_ok=True)
+    return path
+
+# --------------------------------------------------
+# 5. Google Drive アップロード関数
+# --------------------------------------------------
+def _query_resumable_offset_blocking(session_uri: str, total: int) -> tuple[int | None, dict | None]:
+    """
+    レジューマブルセッションの受信済みバイト数を問い合わせる
+    Returns: (次に送るオフセット, 完了済みならファイル情報)。セッションが無効ならオフセットはNone
+    """
+    resp, content = worker_drive_http().request(
+        session_uri,
+        "PUT",
+        body=b"",
+        headers={"Content-Length": "0", "Content-Range": f"bytes */{total}"},
+    )
+    if resp.status == 308:
+        received = resp.get("range")
+        return (int(received.rsplit("-", 1)[1]) + 1 if received else 0), None
+    if resp.status in (200, 201):
+        return total, json.loads(content)
+    return None, None
+
+def _upload_to_drive_blocking(file_path: str, drive_filename: str, report, platform: str = "unknown",
+                              resume_uri: str | None = None, on_session=None, parent: str | None = None) -> str:
+    """
+    ワーカースレッド上で実行されるアップロード本体。file_idを返す
+    resume_uri: 前回のセッションURI（あれば確認済みのオフセットから再開）
+    on_session: on_session(session_uri, offset) をチャンク毎に呼び出す（ジャーナル記録用）
+    parent: 保存先フォルダ（省略時は GOOGLE_DRIVE_FOLDER_ID）
+    """
+    service = worker_drive_service()
+    
+    # ファイルメタデータ
+    parent = parent or GOOGLE_DRIVE_FOLDER_ID
+    file_metadata = {
+        'name': drive_filename,
+        'parents': [parent] if parent else []
+    }
+    
+    # チャンク単位でアップロードし、進捗を呼び出し元へ通知
+    media = MediaFileUpload(file_path, chunksize=DRIVE_CHUNK_SIZE, resumable=True)
+    request = service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id'
+    )
+    total = media.size()
+    file = None
+    if resume_uri:
+        offset, file = _query_resumable_offset_blocking(resume_uri, total)
+        if offset is not None:
+            request.resumable_uri = resume_uri
+            request.resumable_progress = offset
+            print(f"アップロードを再開: {drive_filename} ({offset}/{total} bytes)")
+        else:
+            print(f"アップロードセッションが無効のため最初から送信: {drive_filename}")
+    while file is None:
+        status, file = request.next_chunk(num_retries=3)
+        if status:
+            report(status.resumable_progress, total)
+            if on_session:
+                on_session(request.resumable_uri, status.resumable_progress)
+    report(total, total)
+    
+    return file.get('id')
+
+def _grant_public_read_blocking(file_id: str, platform: str = "unknown"):
+    """ファイルを誰でもアクセス可能に設定"""
+    with track_stage("drive_permission", platform):
+        worker_drive_service().permissions().create(
+            fileId=file_id,
+            body={
+                'role': 'reader',
+                'type': 'anyone'
+            }
+        ).execute(num_retries=3)
+
+def _grant_public_read_batch_blocking(file_ids: list[str], platform: str = "unknown") -> dict[str, Exception]:
+    """複数ファイルの公開設定を1回のバッチリクエストで行い、失敗した項目の {file_id: 例外} を返す"""
+    service = worker_drive_service()
+    errors: dict[str, Exception] = {}
+    
+    def callback(request_id: str, response, exception):
+        if exception is not None:
+            errors[file_ids[int(request_id)]] = exception
+    
+    batch = service.new_batch_http_request(callback=callback)
+    for n, file_id in enumerate(file_ids):
+        batch.add(
+            service.permissions().create(fileId=file_id, body={'role': 'reader', 'type': 'anyone'}),
+            request_id=str(n),
+        )
+    with track_stage("drive_permission", platform):
+        batch.execute(http=worker_drive_http())
+    return errors
+
+class DrivePermissionBatcher:
+    """
+    ファイルの公開設定（permissions.create）をまとめて、Driveのバッチリクエスト1回で送る
+    最初の1件は window 秒だけ待ってから送り、送信中に届いた分は次のバッチにまとめる（空いていれば待たない）
+    実行中のジョブが全て公開待ちになった場合は、これ以上増えないため window を待たずに送る
+    バッチ内で失敗した項目は個別に再試行する
+    """
+
+    MAX_BATCH = 100  # Driveのバッチリクエストに含められる上限
+
+    def __init__(self, window: float):
+        self.window = window
+        self.pending: list[tuple[str, str, asyncio.Future]] = []
+        self.sender: asyncio.Task | None = None
+        self.full = asyncio.Event()
+
+    async def grant(self, file_id: str, platform: str):
+        """file_id を誰でも閲覧可能にする（バッチの送信完了まで待つ）"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((file_id, platform, future))
+        if len(self.pending) >= scheduler.active:
+            self.full.set()
+        if self.sender is None:
+            self.sender = asyncio.create_task(self._run())
+        await future
+
+    async def _run(self):
+        try:
+            if self.window > 0 and not self.full.is_set():
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            self.full.clear()
+            while self.pending:
+                items, self.pending = self.pending[:self.MAX_BATCH], self.pending[self.MAX_BATCH:]
+                await self._send(items)
+        finally:
+            self.sender = None
+
+    async def _send(self, items: list[tuple[str, str, asyncio.Future]]):
+        platforms = {platform for _, platform, _ in items}
+        failed = await self.grant_all(
+            [file_id for file_id, _, _ in items], platforms.pop() if len(platforms) == 1 else "mixed"
+        )
+        for file_id, _, future in items:
+            if future.done():
+                continue
+            if file_id in failed:
+                future.set_exception(failed[file_id])
+            else:
+                future.set_result(None)
+
+    async def grant_all(self, file_ids: list[str], platform: str) -> dict[str, Exception]:
+        """
+        file_ids をすぐに（キューを通さず）まとめて公開し、失敗した {file_id: 例外} を返す
+        2件以上ならバッチリクエストを使い、バッチで失敗した項目（バッチ全体の失敗も含む）は個別に再試行する
+        """
+        loop = asyncio.get_running_loop()
+        errors = None  # None: バッチを使わなかった
+        if len(file_ids) > 1:
+            try:
+                errors = await loop.run_in_executor(drive_api_executor, _grant_public_read_batch_blocking, file_ids, platform)
+            except Exception as e:
+                print(f"公開設定のバッチリクエストエラー（個別に再試行）: {e}")
+        failed = {}
+        for file_id in file_ids:
+            if errors is None or file_id in errors:
+                try:
+                    await loop.run_in_executor(drive_api_executor, _grant_public_read_blocking, file_id, platform)
+                except Exception as e:
+                    failed[file_id] = e
+        return failed
+
+drive_permissions = DrivePermissionBatcher(DRIVE_BATCH_WINDOW_SEC)
+
+async def grant_public_read(file_id: str, platform: str):
+    """アップロードしたファイル・フォルダを公開（保存先フォルダが共有済みなら継承されるため省略）"""
+    if not DRIVE_FOLDER_IS_SHARED:
+        await drive_permissions.grant(file_id, platform)
+
+async def grant_public_read_all(file_ids: list[str], platform: str) -> dict[str, Exception]:
+    """複数メディア投稿の全ファイルを1回のバッチで公開し、失敗した {file_id: 例外} を返す"""
+    if DRIVE_FOLDER_IS_SHARED or not file_ids:
+        return {}
+    return await drive_permissions.grant_all(file_ids, platform)
+
+def _create_drive_folder_blocking(name: str, platform: str = "unknown") -> str:
+    """保存先フォルダの下にサブフォルダを作成し、folder_idを返す（公開は grant_public_read で行う）"""
+    folder = worker_drive_service().files().create(
+        body={
+            'name': name,
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [GOOGLE_DRIVE_FOLDER_ID] if GOOGLE_DRIVE_FOLDER_ID else []
+        },
+        fields='id'
+    ).execute(num_retries=3)
+    return folder['id']
+
+def drive_filename_for(filename: str, platform: str) -> str:
+    """ファイル名にプラットフォームと日時を追加"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"[{platform.upper()}]_{timestamp}_{filename}"
+
+def shareable_link_for(file_id: str) -> str:
+    """共有可能なリンクを生成"""
+    return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
+
+def file_md5(file_path: str) -> str:
+    """ファイルのMD5を計算（Driveのmd5Checksumと比較するため）"""
+    hasher = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+async def upload_to_drive(file_path: str, filename: str, platform: str, progress=None, md5: str | None = None,
+                          parent: str | None = None, grant: bool = True) -> tuple[str, str]:
+    """
+    ファイルをGoogle Driveにアップロードして共有リンクを返す
+    アップロードはワーカープール上で実行され、イベントループをブロックしない
+    同じ内容のファイルが保存先フォルダに既にある場合は、アップロードせずにそれを再利用する
+    progress: progress(uploaded_bytes, total_bytes) をイベントループ上で呼び出すコールバック
+    md5: 書き込み時に計算済みのMD5（省略時はここで計算）
+    parent: 保存先フォルダ（複数メディア投稿のサブフォルダ等）
+    grant: アップロード後に公開する（呼び出し元でまとめて公開する場合はFalse）
+    Returns: (file_id, shareable_link)
+    """
+    if not drive_enabled:
+        raise Exception("Google Drive APIが初期化されていません")
+    
+    loop = asyncio.get_running_loop()
+    
+    if drive_hash_index.enabled:
+        try:
+            if md5 is None:
+                md5 = await loop.run_in_executor(None, file_md5, file_path)
+            existing = await drive_hash_index.lookup(md5)
+            if existing:
+                # 既存のファイルが公開されているとは限らない（保存先フォルダ直下にあるためサブフォルダの共有も継承しない）
+                if grant or parent:
+                    await grant_public_read(existing, platform)
+                print(f"同一内容のファイルがDriveに存在するため再利用: {filename} -> {existing}")
+                return existing, shareable_link_for(existing)
+        except Exception as e:
+            print(f"Driveハッシュ索引の確認エラー（通常どおりアップロード）: {e}")
+    
+    def report(uploaded: int, total: int):
+        if progress:
+            loop.call_soon_threadsafe(progress, uploaded, total)
+    
+    # 再起動前に同じファイルのアップロードが途中まで進んでいれば、そのセッションを引き継ぐ
+    job_id = current_job_id.get()
+    job = job_journal.get(job_id)
+    resume_uri = job["session_uri"] if job and job["session_file"] == file_path else None
+    
+    def on_session(session_uri: str, offset: int):
+        job_journal.update(job_id, session_uri=session_uri, session_file=file_path, upload_offset=offset)
+    
+    try:
+        drive_filename = drive_filename_for(filename, platform)
+        
+        with track_stage("drive_upload", platform):
+            file_id = await loop.run_in_executor(
+                drive_executor, _upload_to_drive_blocking, file_path, drive_filename, report, platform,
+                resume_uri, on_session if job_id is not None else None, parent,
+            )
+        TRANSFER_BYTES.labels("upload", platform).inc(os.path.getsize(file_path))
+        # 公開済みのサブフォルダ内のファイルはフォルダの共有設定を継承する
+        if grant and not parent:
+            await grant_public_read(file_id, platform)
+        
+        shareable_link = shareable_link_for(file_id)
+        if md5:
+            drive_hash_index.add(md5, file_id)
+        
+        print(f"Google Driveにアップロード完了: {drive_filename}")
+        return file_id, shareable_link
+        
+    except Exception as e:
+        print(f"Google Driveアップロードエラー: {e}")
+        raise
+
+def _drive_file_exists_blocking(file_id: str) -> bool:
+    """Drive上のファイルが存在し、ゴミ箱に入っていないか確認"""
+    try:
+        meta = worker_drive_service().files().get(fileId=file_id, fields='id,trashed').execute()
+        return not meta.get('trashed', False)
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+
+async def lookup_cached_upload(key: str) -> dict | None:
+    """キャッシュを確認し、Drive側で削除済みのエントリは無効化する"""
+    if not drive_enabled:
+        return None
+    entry = media_cache.get(key)
+    if not entry:
+        return None
+    try:
+        loop = asyncio.get_running_loop()
+        exists = await loop.run_in_executor(drive_api_executor, _drive_file_exists_blocking, entry["file_id"])
+    except Exception as e:
+        print(f"キャッシュ確認エラー（キャッシュを使用します）: {e}")
+        return entry
+    if not exists:
+        print(f"Drive上のファイルが削除されているためキャッシュを無効化: {key}")
+        media_cache.invalidate(key)
+        return None
+    return entry
+
+async def deliver(channel, platform: str, via: str, *args, **kwargs):
+    """結果をチャンネルへ返信し、送信時間と返信経路を記録"""
+    with track_stage("discord_send", platform):
+        message = await channel.send(*args, **kwargs)
+    DELIVERIES.labels(platform, via).inc()
+    return message
+
+async def send_cached_upload(channel, url: str, entry: dict, platform: str):
+    """キャッシュ済みの共有リンクを返信"""
+    if entry.get("items"):
+        # サブフォルダにまとめた場合は file_id/link がフォルダを指す
+        item_ids = {item["file_id"] for item in entry["items"]}
+        folder_link = None if entry["file_id"] in item_ids else entry["link"]
+        embed = multi_upload_embed(platform, url, entry["items"], folder_link, cached=True)
+        await deliver(channel, platform, "cache", embed=embed)
+        print(f"✔ Cache hit: {url}")
+        return
+    file_size_mb = entry["size"] / (1024 * 1024)
+    embed = discord.Embed(
+        title=f"♻️ {platform.upper()} アップロード済みのファイルがあります",
+        description=f"**元URL:** {url}\n**ファイルサイズ:** {file_size_mb:.2f} MB",
+        color=0x00ff00
+    )
+    embed.add_field(name="Google Drive リンク", value=f"[ファイルを開く]({entry['link']})", inline=False)
+    embed.add_field(name="ダウンロード", value=f"[直接ダウンロード](https://drive.google.com/uc?id={entry['file_id']})", inline=False)
+    embed.set_footer(text=f"プラットフォーム: {platform.upper()}（キャッシュ）")
+    await deliver(channel, platform, "cache", embed=embed)
+    print(f"✔ Cache hit: {url}")
+
+def media_upload_embed(platform: str, url: str, file_size_mb: float, file_id: str, shareable_link: str) -> discord.Embed:
+    """メディアアップロード完了の埋め込みメッセージを作成"""
+    embed = discord.Embed(
+        title=f"✅ {platform.upper()} メディアダウンロード＆アップロード完了",
+        description=f"**元URL:** {url}\n**ファイルサイズ:** {file_size_mb:.2f} MB",
+        color=0x00ff00
+    )
+    embed.add_field(
+        name="Google Drive リンク", 
+        value=f"[ファイルを開く]({shareable_link})", 
+        inline=False
+    )
+    embed.add_field(
+        name="ダウンロード", 
+        value=f"[直接ダウンロード](https://drive.google.com/uc?id={file_id})", 
+        inline=False
+    )
+    embed.set_footer(text=f"プラットフォーム: {platform.upper()}")
+    return embed
+
+def multi_upload_embed(platform: str, url: str, items: list[dict], folder_link: str | None = None,
+                       failed: list[str] | None = None, cached: bool = False) -> discord.Embed:
+    """
+    複数メディア投稿の各ファイルを1つにまとめた埋め込みメッセージを作成
+    items: [{"file_id", "link", "size"}, ...]（投稿内の順）
+    failed: アップロードできなかったファイル名
+    cached: キャッシュからの返信
+    """
+    total_mb = sum(item["size"] for item in items) / (1024 * 1024)
+    lines = [f"**元URL:** {url}", f"**合計サイズ:** {total_mb:.2f} MB（{len(items)}件）", ""]
+    for n, item in enumerate(items, 1):
+        lines.append(
+            f"**{n}.** [ファイルを開く]({item['link']}) ・ "
+            f"[直接ダウンロード](https://drive.google.com/uc?id={item['file_id']}) "
+            f"({item['size'] / (1024 * 1024):.2f} MB)"
+        )
+    if cached:
+        title = f"♻️ {platform.upper()} アップロード済みのファイルがあります（{len(items)}件）"
+    else:
+        title = f"✅ {platform.upper()} メディアダウンロード＆アップロード完了（{len(items)}件）"
+    embed = discord.Embed(title=title, description="\n".join(lines), color=0x00ff00)
+    if folder_link:
+        embed.add_field(name="Google Drive フォルダ", value=f"[フォルダを開く]({folder_link})", inline=False)
+    if failed:
+        embed.add_field(name="⚠️ アップロード失敗", value="\n".join(failed)[:1024], inline=False)
+    embed.set_footer(text=f"プラットフォーム: {platform.upper()}" + ("（キャッシュ）" if cached else ""))
+    return embed
+
+# --------------------------------------------------
+# 5-1. ストリーミングアップロード（一時ファイルなし）
+# --------------------------------------------------
+DRIVE_RESUMABLE_URL = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id"
+
+# マージ不要な単一ファイル（HTTP直接配信のmp4）のみストリーミング可能
+STREAM_FORMATS = {
+    'instagram': "best[ext=mp4][protocol^=http]",
+    'tiktok': "best[ext=mp4][protocol^=http]",
+    'youtube': "best[height<=1080][ext=mp4][protocol^=http]",
+    'twitter': "best[ext=mp4][protocol^=http]",
+}
+
+def _start_resumable_session_blocking(drive_filename: str, mimetype: str) -> str:
+    """レジューマブルアップロードのセッションを開始し、セッションURIを返す"""
+    metadata = {
+        'name': drive_filename,
+        'parents': [GOOGLE_DRIVE_FOLDER_ID] if GOOGLE_DRIVE_FOLDER_ID else []
+    }
+    resp, content = worker_drive_http().request(
+        DRIVE_RESUMABLE_URL,
+        "POST",
+        body=json.dumps(metadata),
+        headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mimetype,
+        },
+    )
+    if resp.status != 200 or "location" not in resp:
+        raise Exception(f"レジューマブルセッション開始失敗 (status={resp.status})")
+    return resp["location"]
+
+def _put_chunk_blocking(session_uri: str, data: bytes, offset: int, total: int | None) -> dict | None:
+    """チャンクを送信。完了時はファイル情報、継続時はNoneを返す"""
+    end = offset + len(data) - 1
+    size = str(total) if total is not None else "*"
+    resp, content = worker_drive_http().request(
+        session_uri,
+        "PUT",
+        body=data,
+        headers={
+            "Content-Length": str(len(data)),
+            "Content-Range": f"bytes {offset}-{end}/{size}",
+        },
+    )
+    if resp.status == 308:
+        return None
+    if resp.status in (200, 201):
+        return json.loads(content)
+    raise Exception(f"チャンク送信失敗 (status={resp.status}, offset={offset})")
+
+async def _read_chunk(stream: asyncio.StreamReader, size: int) -> bytes:
+    """EOFまたは指定サイズに達するまで読み込む"""
+    buf = bytearray()
+    while len(buf) < size:
+        data = await stream.read(size - len(buf))
+        if not data:
+            break
+        buf.extend(data)
+    return bytes(buf)
+
+async def stream_to_drive(url: str, platform: str, filename: str, progress=None,
+                         info: dict | None = None, download_progress=None) -> tuple[str, str, int] | None:
+    """
+    yt-dlpの標準出力を一時ファイルを介さずDriveのレジューマブルアップロードへ流す
+    ダウンロードとアップロードは有界バッファを挟んで並行に進む
+    progress: progress(uploaded_bytes, total_bytes) アップロード済みバイト数の通知（合計は完了時まで不明）
+    info: 事前取得したメタデータ（あれば情報抽出を省略）
+    download_progress: yt-dlpの進捗 (downloaded_bytes, total_bytes, speed, eta) の通知
+    Returns: (file_id, shareable_link, size)。ストリーミングできなかった場合はNone
+    """
+    opts = ytdl_options(platform, "-")
+    for k in ("format_sort", "merge_output_format", "writethumbnail"):
+        opts.pop(k, None)
+    opts["format"] = STREAM_FORMATS[platform]
+    info_path = write_info_json(info, JOB_DIR) if info else None
+    await platform_limiter.acquire(platform, charge=info is None)
+    try:
+        return await _stream_to_drive(
+            url, platform, filename, progress, download_progress, ytdl_command(opts, url, info_path)
+        )
+    finally:
+        if info_path:
+            os.remove(info_path)
+
+async def _stream_to_drive(url: str, platform: str, filename: str, progress, download_progress,
+                           cmd: list[str]) -> tuple[str, str, int] | None:
+    print(f"Streaming command: {' '.join(cmd)}")
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=DRIVE_CHUNK_SIZE,
+    )
+    # 標準出力は動画データなので、進捗とエラーは標準エラーから読む
+    stderr_tail = deque(maxlen=YTDL_STDERR_TAIL_LINES)
+    stderr_task = asyncio.create_task(pump_lines(proc.stderr, ytdl_output_handler(stderr_tail, download_progress)))
+    buffer: asyncio.Queue[bytes] = asyncio.Queue(maxsize=max(1, STREAM_BUFFER_CHUNKS))
+    
+    async def produce():
+        while True:
+            data = await _read_chunk(proc.stdout, DRIVE_CHUNK_SIZE)
+            await buffer.put(data)
+            if len(data) < DRIVE_CHUNK_SIZE:
+                return
+    
+    producer = asyncio.create_task(produce())
+    loop = asyncio.get_running_loop()
+    hasher = hashlib.md5()
+    STAGE_INFLIGHT.labels("stream").inc()
+    start = time.perf_counter()
+    try:
+        current = await buffer.get()
+        if not current:
+            await proc.wait()
+            await stderr_task
+            error_tail = "\n".join(stderr_tail)[-500:]
+            print(f"ストリーミング不可（出力なし）: {url} - {error_tail}")
+            return None
+        if FASTSTART_REMUX and mdat_before_moov(current):
+            # 索引が末尾にあるファイルはストリーミングではリマックスできないため、一時ファイル経由に切り替える
+            print(f"moovが末尾にあるためストリーミングを中止（一時ファイル経由でリマックス）: {url}")
+            return None
+        
+        session_uri = await loop.run_in_executor(
+            drive_executor, _start_resumable_session_blocking,
+            drive_filename_for(filename, platform), "video/mp4",
+        )
+        offset = 0
+        while True:
+            # 最終チャンクかどうかを判定するため次のチャンクを先読みする
+            nxt = b""
+            if len(current) == DRIVE_CHUNK_SIZE:
+                nxt = await buffer.get()
+            last = not nxt
+            total = None
+            if last:
+                # yt-dlpが正常終了した場合のみアップロードを確定する
+                if await proc.wait() != 0:
+                    STAGE_FAILURES.labels("stream", platform).inc()
+                    await stderr_task
+                    error_tail = "\n".join(stderr_tail)[-500:]
+                    print(f"ストリーミング中にyt-dlpが失敗: {url} - {error_tail}")
+                    return None
+                total = offset + len(current)
+            hasher.update(current)
+            result = await loop.run_in_executor(
+                drive_executor, _put_chunk_blocking, session_uri, current, offset, total
+            )
+            offset += len(current)
+            TRANSFER_BYTES.labels("download", platform).inc(len(current))
+            TRANSFER_BYTES.labels("upload", platform).inc(len(current))
+            if progress:
+                progress(offset, total)
+            if last:
+                break
+            current = nxt
+        
+        STAGE_SECONDS.labels("stream", platform).observe(time.perf_counter() - start)
+        file_id = result['id']
+        md5 = hasher.hexdigest()
+        if drive_hash_index.enabled:
+            # 送信前に内容が分からないため、重複していた場合は新しい方を削除して既存を再利用
+            existing = await drive_hash_index.lookup(md5)
+            if existing and existing != file_id:
+                await loop.run_in_executor(drive_api_executor, _delete_drive_file_blocking, file_id)
+                await grant_public_read(existing, platform)
+                print(f"同一内容のファイルがDriveに存在するため再利用: {filename} -> {existing}")
+                return existing, shareable_link_for(existing), offset
+        await grant_public_read(file_id, platform)
+        drive_hash_index.add(md5, file_id)
+        print(f"Google Driveにストリーミングアップロード完了: {filename} ({offset} bytes)")
+        return file_id, shareable_link_for(file_id), offset
+    except Exception:
+        STAGE_FAILURES.labels("stream", platform).inc()
+        raise
+    finally:
+        STAGE_INFLIGHT.labels("stream").dec()
+        producer.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
+
+# --------------------------------------------------
+# 5-2. Drive 内容ハッシュ索引
+# --------------------------------------------------
+def _delete_drive_file_blocking(file_id: str):
+    worker_drive_service().files().delete(fileId=file_id).execute(num_retries=3)
+
+class DriveHashIndex:
+    """保存先フォルダ内のファイルの md5Checksum → file_id 索引。初回に一括構築し、以降は変更APIで差分更新"""
+
+    def __init__(self, folder_id: str, refresh_interval: float):
+        self.folder_id = folder_id
+        self.refresh_interval = refresh_interval
+        self.by_md5: dict[str, str] = {}
+        self.md5_by_id: dict[str, str] = {}
+        self.page_token = None
+        self.last_refresh = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return DRIVE_HASH_DEDUP and bool(self.folder_id) and drive_enabled
+
+    def add(self, md5: str, file_id: str):
+        self.by_md5[md5] = file_id
+        self.md5_by_id[file_id] = md5
+
+    def remove(self, file_id: str):
+        md5 = self.md5_by_id.pop(file_id, None)
+        if md5 and self.by_md5.get(md5) == file_id:
+            del self.by_md5[md5]
+
+    def _build_blocking(self):
+        """フォルダ内の全ファイルを一覧して索引を構築"""
+        service = worker_drive_service()
+        self.page_token = service.changes().getStartPageToken().execute()['startPageToken']
+        page = None
+        while True:
+            resp = service.files().list(
+                q=f"'{self.folder_id}' in parents and trashed = false",
+                fields="nextPageToken, files(id, md5Checksum)",
+                pageSize=1000,
+                pageToken=page,
+            ).execute(num_retries=3)
+            for f in resp.get('files', []):
+                if f.get('md5Checksum'):
+                    self.add(f['md5Checksum'], f['id'])
+            page = resp.get('nextPageToken')
+            if not page:
+                break
+        print(f"Driveハッシュ索引構築完了: {len(self.by_md5)} 件")
+
+    def _refresh_blocking(self):
+        """前回以降の変更（追加・削除・ゴミ箱移動）を反映"""
+        service = worker_drive_service()
+        while self.page_token:
+            resp = service.changes().list(
+                pageToken=self.page_token,
+                fields="nextPageToken, newStartPageToken, changes(removed, fileId, file(id, md5Checksum, trashed, parents))",
+                pageSize=1000,
+            ).execute(num_retries=3)
+            for change in resp.get('changes', []):
+                f = change.get('file') or {}
+                if change.get('removed') or f.get('trashed') or self.folder_id not in f.get('parents', []):
+                    self.remove(change['fileId'])
+                elif f.get('md5Checksum'):
+                    self.add(f['md5Checksum'], f['id'])
+            if 'newStartPageToken' in resp:
+                self.page_token = resp['newStartPageToken']
+                break
+            self.page_token = resp.get('nextPageToken')
+
+    async def lookup(self, md5: str) -> str | None:
+        """MD5が一致するファイルのIDを返す（必要に応じて索引を構築・更新）"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = time.monotonic()
+            if self.page_token is None:
+                await loop.run_in_executor(drive_api_executor, self._build_blocking)
+                self.last_refresh = now
+            elif now - self.last_refresh > self.refresh_interval:
+                await loop.run_in_executor(drive_api_executor, self._refresh_blocking)
+                self.last_refresh = now
+        return self.by_md5.get(md5)
+
+drive_hash_index = DriveHashIndex(GOOGLE_DRIVE_FOLDER_ID, DRIVE_INDEX_REFRESH_SEC)
+
+# --------------------------------------------------
+# 5-3. 進捗メッセージとプレビュー返信
+# --------------------------------------------------
+def format_duration(seconds: float) -> str:
+    """再生時間を 1:05 / 1:02:03 の形式にする"""
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+def preview_title(info: dict) -> str | None:
+    """プレビュー・結果に表示するタイトル（再生時間付き）"""
+    entries = [entry for entry in info.get("entries") or [] if entry]
+    title = info.get("title") or (entries[0].get("title") if entries else None)
+    if not title:
+        return None
+    duration = info.get("duration") or (entries[0].get("duration") if len(entries) == 1 else None)
+    if duration:
+        title = f"{title}（{format_duration(duration)}）"
+    return title[:256]
+
+def preview_thumbnail(info: dict) -> str | None:
+    """プラットフォームが提供するサムネイルのURL（複数メディア投稿は先頭の項目）"""
+    entries = [entry for entry in info.get("entries") or [] if entry]
+    for item in (info, *entries[:1]):
+        if item.get("thumbnail"):
+            return item["thumbnail"]
+        thumbnails = [t for t in item.get("thumbnails") or [] if t.get("url")]
+        if thumbnails:
+            return thumbnails[-1]["url"]  # yt-dlpは品質の低い順に並べる
+    return None
+
+async def grab_keyframe(info: dict) -> bytes | None:
+    """
+    サムネイルが無い場合に、メディアURLの先頭（HLS/DASHは最初の断片）から低解像度のフレームを切り出す
+    失敗・時間切れの場合はNone（プレビューは画像なしで返信する）
+    """
+    source = info.get("url")
+    if not source:
+        source = next((f.get("url") for f in info.get("requested_formats") or [] if f.get("vcodec") != "none"), None)
+    if not source:
+        return None
+    headers = "".join(f"{k}: {v}\r\n" for k, v in (info.get("http_headers") or {}).items())
+    args = [FFMPEG, "-v", "error", "-nostdin"]
+    if headers:
+        args += ["-headers", headers]
+    args += ["-i", source, "-frames:v", "1", "-vf", "scale=320:-2", "-q:v", "5", "-f", "image2", "-c:v", "mjpeg", "pipe:1"]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError as e:
+        print(f"プレビュー用フレームの切り出しエラー: {e}")
+        return None
+    try:
+        data, _ = await asyncio.wait_for(proc.communicate(), PREVIEW_KEYFRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"プレビュー用フレームの切り出しが時間切れ: {info.get('webpage_url') or source}")
+        return None
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    return data if proc.returncode == 0 and data else None
+
+def preview_embed(platform: str, url: str, info: dict, notes: list[str]) -> discord.Embed:
+    """ダウンロード開始前に返信するプレビュー（完了後に同じメッセージを結果に書き換える）"""
+    lines = [f"**元URL:** {url}"]
+    entries = [entry for entry in info.get("entries") or [] if entry]
+    if len(entries) > 1:
+        lines.append(f"**項目数:** {len(entries)}")
+    lines.extend(notes)
+    embed = discord.Embed(
+        title=f"⏬ {platform.upper()} ダウンロードを開始します",
+        description="\n".join(lines),
+        color=0x5865f2
+    )
+    title = preview_title(info)
+    if title:
+        embed.set_author(name=title)
+    thumbnail = preview_thumbnail(info)
+    if thumbnail:
+        embed.set_thumbnail(url=thumbnail)
+    embed.set_footer(text=f"プラットフォーム: {platform.upper()}")
+    return embed
+
+def _format_progress(label: str, done: int, total: int | None, speed: float | None = None, eta: float | None = None) -> str:
+    mb = 1024 * 1024
+    text = f"🔄 {label}"
+    if total:
+        text += f" {done * 100 / total:.0f}% ({done / mb:.1f}/{total / mb:.1f}MB)"
+    else:
+        text += f" {done / mb:.1f}MB"
+    if speed:
+        text += f" {speed / mb:.1f}MB/s"
+    if eta:
+        text += f" 残り約{eta:.0f}秒"
+    return text
+
+class ProgressReporter:
+    """
+    1つのジョブの進捗を1つのステータスメッセージに表示する
+    更新は最新の内容だけを保持し、PROGRESS_EDIT_SEC 以上の間隔でまとめて編集する（編集のレート制限対策）
+    最初の表示も同じ間隔だけ遅らせるため、すぐに終わるジョブではメッセージを出さない
+    プレビューを返信した場合はそのメッセージに進捗を表示し、結果は send() で同じメッセージに書き換える
+    """
+
+    def __init__(self, channel, url: str, interval: float = PROGRESS_EDIT_SEC):
+        self.channel = channel
+        self.url = url
+        self.interval = interval
+        self.message = None
+        self.text = None
+        self.shown = None
+        self.last_edit = time.monotonic()
+        self.task: asyncio.Task | None = None
+        self.parts: dict[tuple[str, int], tuple[int, int | None, float | None]] = {}
+        self.sending = False
+        self.closed = False
+        self.preview_author: str | None = None
+        self.preview_thumbnail: str | None = None
+
+    def _adopt_notice(self):
+        """待機中の通知メッセージがあれば、新しく送信せずにそれを表示に使う"""
+        job = current_job.get()
+        if self.message is None and job is not None and job.notice is not None and job.channel is self.channel:
+            self.message, job.notice = job.notice, None
+
+    async def preview(self, platform: str, info: dict, notes: list[str] = ()):
+        """メタデータ取得直後にタイトル・再生時間・サムネイル（無ければ先頭のフレーム）を返信"""
+        if self.closed:
+            return
+        if self.sending:
+            # 進捗メッセージの最初の送信と重ならないよう完了を待つ
+            await asyncio.gather(self.task, return_exceptions=True)
+        self._adopt_notice()
+        embed = preview_embed(platform, self.url, info, list(notes))
+        try:
+            with track_stage("preview", platform):
+                if self.message is not None:
+                    # 待機中・進捗のメッセージをプレビューに書き換える（添付は付けられないためフレームは切り出さない）
+                    await self.message.edit(content="", embed=embed)
+                else:
+                    file = None
+                    # まとめ返信では添付を付けられないため切り出さない
+                    if embed.thumbnail.url is None and not isinstance(self.channel, GroupMember):
+                        frame = await grab_keyframe(info)
+                        if frame:
+                            file = discord.File(io.BytesIO(frame), filename="preview.jpg")
+                            embed.set_thumbnail(url="attachment://preview.jpg")
+                    self.message = await self.channel.send(embed=embed, **({"file": file} if file else {}))
+        except discord.HTTPException as e:
+            print(f"プレビューの送信エラー: {e}")
+            return
+        self.preview_author = embed.author.name
+        self.preview_thumbnail = embed.thumbnail.url
+        self.shown = None
+        self.last_edit = time.monotonic()
+
+    async def send(self, content: str | None = None, *, embed: discord.Embed | None = None, **kwargs):
+        """
+        結果の返信（channel.send と同じ呼び出し方）
+        表示中のプレビュー・進捗メッセージがあればそれを結果に書き換え、リンク1つにつき1メッセージにする
+        添付ファイルは編集では付けられないため新しく送信する（表示中のメッセージは close() で削除）
+        """
+        self._adopt_notice()
+        if self.message is None or kwargs.get("file") or kwargs.get("files"):
+            return await self.channel.send(content, embed=embed, **kwargs)
+        await self._stop()
+        message, self.message = self.message, None
+        try:
+            if embed is None:
+                # 失敗の通知などはプレビューを残して本文だけ書き換える
+                return await message.edit(content=content)
+            if self.preview_author and not embed.author.name:
+                embed.set_author(name=self.preview_author)
+            if self.preview_thumbnail and not embed.thumbnail.url:
+                embed.set_thumbnail(url=self.preview_thumbnail)
+            return await message.edit(content="", embed=embed)
+        except discord.HTTPException as e:
+            print(f"結果の書き換えエラー（新しく送信します）: {e}")
+            self.message = message
+            return await self.channel.send(content, embed=embed, **kwargs)
+
+    def download(self, downloaded: int, total: int | None, speed: float | None = None, eta: float | None = None):
+        self._set(_format_progress("ダウンロード中", downloaded, total, speed, eta))
+
+    def upload(self, uploaded: int, total: int | None):
+        self._set(_format_progress("Google Driveへアップロード中", uploaded, total))
+
+    def transcode(self, done_sec: float, total_sec: float):
+        self._set(f"🔄 圧縮中 {min(100.0, done_sec * 100 / total_sec):.0f}%")
+
+    def download_part(self, part: int):
+        """複数メディア投稿の各ダウンロードの進捗を合算して表示するコールバックを返す"""
+        def report(downloaded: int, total: int | None, speed: float | None = None, eta: float | None = None):
+            done, total, speed = self._combine("download", part, downloaded, total, speed)
+            eta = (total - done) / speed if total and speed else None
+            self.download(done, total, speed, eta)
+        return report
+
+    def upload_part(self, part: int):
+        """複数メディア投稿の各アップロードの進捗を合算して表示するコールバックを返す"""
+        def report(uploaded: int, total: int | None):
+            done, total, _ = self._combine("upload", part, uploaded, total, None)
+            self.upload(done, total)
+        return report
+
+    def _combine(self, kind: str, part: int, done: int, total: int | None, speed: float | None):
+        finished = total is not None and done >= total
+        self.parts[(kind, part)] = (done, total, None if finished else speed)
+        parts = [v for (k, _), v in self.parts.items() if k == kind]
+        totals = [v[1] for v in parts]
+        return (
+            sum(v[0] for v in parts),
+            sum(totals) if all(totals) else None,
+            sum(v[2] or 0 for v in parts) or None,
+        )
+
+    def _set(self, text: str):
+        if self.closed or self.interval <= 0:
+            return
+        self.text = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while not self.closed and self.text != self.shown:
+            wait = self.last_edit + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            text = self.text
+            content = f"{text}: {self.url}"
+            self.sending = True
+            self._adopt_notice()
+            try:
+                if self.message is None:
+                    self.message = await self.channel.send(content)
+                else:
+                    await self.message.edit(content=content)
+            except discord.HTTPException as e:
+                print(f"進捗メッセージの更新エラー: {e}")
+            finally:
+                self.sending = False
+            self.shown = text
+            self.last_edit = time.monotonic()
+
+    async def _stop(self):
+        self.closed = True
+        if self.task is not None and not self.task.done():
+            # 送信中に中断すると削除できないメッセージが残るため、送信中なら完了を待つ
+            if self.sending:
+                await asyncio.gather(self.task, return_exceptions=True)
+            else:
+                self.task.cancel()
+
+    async def close(self):
+        """結果を別のメッセージで送信した（または中断した）場合は、進捗メッセージを削除する"""
+        await self._stop()
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except discord.HTTPException:
+                pass
+
+# --------------------------------------------------
+# 5-4. 複数リンクのまとめ返信
+# --------------------------------------------------
+def summarize_reply(url: str, content: str | None, embed: discord.Embed | None) -> str:
+    """1リンク分の返信（本文・埋め込み）をまとめ返信の1項目用の短い文字列にする"""
+    lines = []
+    if content:
+        lines.append(content.replace(f": {url}", ""))
+    if embed is not None:
+        head = embed.title or ""
+        if embed.author.name:
+            head += f" — {embed.author.name}"
+        lines.append(head)
+        lines.extend(line for line in (embed.description or "").splitlines() if url not in line)
+        if embed.fields:
+            lines.append("・".join(f.value for f in embed.fields))
+    return "\n".join(line for line in lines if line)
+
+class GroupedMessage:
+    """
+    まとめ返信の中の1リンク分の表示（discord.Message の edit/delete と同じ呼び出し方）
+    まとめ返信を送れなくなった場合は個別のメッセージ（real）として送信し、以降の編集はそちらに反映する
+    """
+
+    def __init__(self, member: "GroupMember", content: str | None, embed: discord.Embed | None, real=None):
+        self.member = member
+        self.content = content
+        self.embed = embed
+        self.real = real
+
+    async def edit(self, content: str | None = None, embed: discord.Embed | None = None, **kwargs):
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        if self.member.group.detached:
+            await self.send_separately(content, embed)
+        else:
+            self.member.group.changed()
+        return self
+
+    async def send_separately(self, content: str | None = None, embed: discord.Embed | None = None):
+        """個別のメッセージとして送信（送信済みなら変更分を編集）する"""
+        if self.real is not None:
+            kwargs = {k: v for k, v in (("content", content), ("embed", embed)) if v is not None}
+            if kwargs:
+                await self.real.edit(**kwargs)
+        elif self.content or self.embed:
+            self.real = await self.member.group.channel.send(self.content, embed=self.embed)
+
+    async def delete(self):
+        if self.real is not None and self.member.group.detached:
+            await self.real.delete()
+        if self in self.member.messages:
+            self.member.messages.remove(self)
+            self.member.group.changed()
+
+class GroupMember:
+    """ReplyGroup の1リンク分のチャンネル。ハンドラには通常のチャンネルとして渡す"""
+
+    def __init__(self, group: "ReplyGroup", url: str):
+        self.group = group
+        self.url = url
+        self.id = group.channel.id  # ジャーナルには実際のチャンネルを記録する（再起動後は個別に返信）
+        self.messages: list[GroupedMessage] = []
+
+    async def send(self, content: str | None = None, *, embed: discord.Embed | None = None, **kwargs):
+        if kwargs.get("file") or kwargs.get("files") or self.group.detached:
+            # 添付ファイルはまとめられないため、そのまま送信してまとめ返信には送信済みと表示する
+            message = await self.group.channel.send(content, embed=embed, **kwargs)
+            self.messages.append(GroupedMessage(self, "📎 別のメッセージで送信しました", None, real=message))
+            self.group.changed()
+            return message
+        message = GroupedMessage(self, content, embed)
+        self.messages.append(message)
+        self.group.changed()
+        return message
+
+    def render(self) -> str:
+        text = "\n".join(summarize_reply(self.url, m.content, m.embed) for m in self.messages)
+        return text or "⏳ 受付済み"
+
+class ReplyPager(discord.ui.View):
+    """まとめ返信のページ送りボタン"""
+
+    def __init__(self):
+        super().__init__(timeout=3600)
+        self.pages: list[discord.Embed] = []
+        self.page = 0
+
+    async def _show(self, interaction: discord.Interaction, step: int):
+        self.page = (self.page + step) % len(self.pages)
+        await interaction.response.edit_message(embed=self.pages[self.page], view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, -1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, 1)
+
+class ReplyGroup:
+    """
+    1つのメッセージに含まれる複数リンクへの返信（待機・プレビュー・進捗・結果）を1つの埋め込みメッセージにまとめる
+    各リンクの送信・編集は window 秒の間ためてから1回の送信・編集で反映する（レート制限対策）
+    リンクが多い場合はページに分け、ボタンで切り替える
+    送信・編集に続けて失敗した場合は、結果を失わないようリンク毎の個別の返信に切り替える
+    """
+
+    LINKS_PER_PAGE = 10
+    PAGE_CHARS = 5900  # 1ページの文字数の上限（埋め込み全体の上限6000文字にタイトル・フッターの余裕を残す）
+    FIELD_CHARS = 1024  # 埋め込みの項目の値の上限
+    MAX_FAILURES = 2
+
+    def __init__(self, channel, urls: list[str], window: float):
+        self.channel = channel
+        self.window = window
+        self.members = {url: GroupMember(self, url) for url in urls}
+        self.message = None
+        self.pager: ReplyPager | None = None
+        self.task: asyncio.Task | None = None
+        self.version = 0
+        self.failures = 0
+        self.detached = False
+
+    def member(self, url: str) -> GroupMember:
+        return self.members[url]
+
+    def changed(self):
+        self.version += 1
+        if not self.detached and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._flush())
+
+    @staticmethod
+    def fit_lines(text: str, limit: int) -> str:
+        """行単位で limit 文字に収める（行の途中で切るとMarkdownのリンクが壊れるため）"""
+        if len(text) <= limit:
+            return text
+        kept = []
+        used = 1  # 末尾の「…」
+        for line in text.splitlines():
+            if used + len(line) + 1 > limit:
+                break
+            kept.append(line)
+            used += len(line) + 1
+        return "\n".join(kept + ["…"])
+
+    def pages(self) -> list[discord.Embed]:
+        members = list(self.members.values())
+        title = f"📥 {len(members)}件のリンク"
+        # 各ページの項目（名前・値）を、件数と埋め込み全体の文字数の両方に収まるように分ける
+        chunks: list[list[tuple[str, str]]] = [[]]
+        used = len(title)
+        for i, member in enumerate(members, start=1):
+            field = (f"{i}. {member.url}"[:256], self.fit_lines(member.render(), self.FIELD_CHARS))
+            size = len(field[0]) + len(field[1])
+            if chunks[-1] and (len(chunks[-1]) >= self.LINKS_PER_PAGE or used + size > self.PAGE_CHARS):
+                chunks.append([])
+                used = len(title)
+            chunks[-1].append(field)
+            used += size
+        pages = []
+        for n, chunk in enumerate(chunks):
+            embed = discord.Embed(title=title, color=0x5865f2)
+            for name, value in chunk:
+                embed.add_field(name=name, value=value, inline=False)
+            if len(chunks) > 1:
+                embed.set_footer(text=f"ページ {n + 1}/{len(chunks)}")
+            pages.append(embed)
+        return pages
+
+    async def detach(self):
+        """まとめ返信をやめ、各リンクのこれまでの表示を個別のメッセージとして送信する"""
+        self.detached = True
+        print(f"⚠️ まとめ返信を送信できないため、リンク毎に返信します（{len(self.members)}件）")
+        for member in self.members.values():
+            for message in list(member.messages):
+                try:
+                    await message.send_separately()
+                except discord.HTTPException as e:
+                    print(f"個別返信の送信エラー: {member.url} - {e}")
+
+    async def _flush(self):
+        """変更が落ち着くまで window 秒ごとにまとめて反映する"""
+        while True:
+            await asyncio.sleep(self.window)
+            version = self.version
+            pages = self.pages()
+            try:
+                with track_stage("discord_send", "group"):
+                    kwargs = {}
+                    if len(pages) > 1 and self.pager is None:
+                        # 表示が伸びてページが増えた場合も切り替えボタンを付ける
+                        self.pager = ReplyPager()
+                    if self.pager is not None:
+                        self.pager.pages = pages
+                        self.pager.page = min(self.pager.page, len(pages) - 1)
+                        kwargs["view"] = self.pager
+                    page = pages[self.pager.page if self.pager is not None else 0]
+                    if self.message is None:
+                        self.message = await self.channel.send(embed=page, **kwargs)
+                    else:
+                        await self.message.edit(embed=page, **kwargs)
+                self.failures = 0
+            except discord.HTTPException as e:
+                print(f"まとめ返信の更新エラー: {e}")
+                self.failures += 1
+                if self.failures >= self.MAX_FAILURES:
+                    await self.detach()
+                    return
+                continue  # 変更が無くても、失敗した内容をもう一度送る
+            if self.version == version:
+                return
+
+# --------------------------------------------------
+# 6. Discord Bot 初期化
+# --------------------------------------------------
+intents = discord.Intents.default()
+intents.message_content = True
+bot = commands.Bot(command_prefix="!", intents=intents)
+
+# 監視対象チャンネルのリスト
+MONITORED_CHANNELS = [CHANNEL_1, CHANNEL_2]
+
+# --------------------------------------------------
+# 6-1. ジョブスケジューラ
+# --------------------------------------------------
+PRIORITY_MANUAL = 0   # !download などの明示的なコマンド
+PRIORITY_AUTO = 10    # 自動検出したリンク
+
+def parse_platform_limits(spec: str, setting: str = "PLATFORM_CONCURRENCY") -> dict[str, int]:
+    """"instagram=2,twitter=2" 形式の設定を辞書に変換"""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            limits[name.strip().lower()] = max(1, int(value))
+        except ValueError:
+            print(f"⚠️ {setting} の値が不正です: {item}")
+    return limits
+
+@dataclass(order=True)
+class Job:
+    priority: int
+    seq: int
+    kind: str = field(compare=False)  # JOB_HANDLERS のキー
+    url: str = field(compare=False)
+    platform: str = field(compare=False)
+    channel: object = field(compare=False)
+    journal_id: int | None = field(default=None, compare=False)
+    queue_id: int | None = field(default=None, compare=False)  # 共有キューから取得したジョブ（workerロール）
+    notice: object = field(default=None, compare=False)  # 待機中の通知メッセージ（開始後は進捗・プレビューの表示に使う）
+
+# 実行中のジョブ（スケジューラがタスク毎に設定）
+current_job: contextvars.ContextVar[Job | None] = contextvars.ContextVar("current_job", default=None)
+
+class JobScheduler:
+    """全体とプラットフォーム別の同時実行数を制限する優先度付きジョブキュー"""
+
+    def __init__(self, max_concurrent: int, platform_limits: dict[str, int]):
+        self.max_concurrent = max(1, max_concurrent)
+        self.platform_limits = platform_limits
+        self.pending: list[Job] = []  # (priority, seq) 順にソート済み
+        self.running: dict[str, int] = {}
+        self.active = 0
+        self.tasks: set[asyncio.Task] = set()  # 実行中タスクの参照を保持
+        self.wakeup: asyncio.TimerHandle | None = None  # レート制限明けの再ディスパッチ
+        self._seq = itertools.count()
+
+    def limit_for(self, platform: str) -> int:
+        return self.platform_limits.get(platform, self.max_concurrent)
 
-# --------------------------------------------------
-# 2. 外部コマンドと正規表現
-# --------------------------------------------------
-YTDL = shutil.which("yt-dlp") or "/usr/local/bin/yt-dlp"
+    async def submit(self, kind: str, url: str, channel, platform: str,
+                     priority: int = PRIORITY_AUTO, journal_id: int | None = None, queue_id: int | None = None):
+        """ジョブをジャーナルに記録して登録し、すぐに実行できない場合は待機順をチャンネルに表示"""
+        if journal_id is None:
+            journal_id = job_journal.add(kind, url, channel.id, platform, priority)
+        job = Job(priority, next(self._seq), kind, url, platform, channel, journal_id, queue_id)
+        bisect.insort(self.pending, job)
+        self._dispatch()
+        JOBS_QUEUED.set(len(self.pending))
+        if job in self.pending:
+            position = self.pending.index(job) + 1
+            print(f"Job queued: {url} (position {position})")
+            job.notice = await channel.send(f"⏳ 待機中（{position}番目）: {url}")
 
-# 対応プラットフォームのURL正規表現
-PLATFORM_PATTERNS = {
-    'twitter': re.compile(r"(https?://(?:www\.)?(?:x\.com|twitter\.com)/\w+/status/\d+)", re.I),
-    'instagram': re.compile(r"(https?://(?:www\.)?instagram\.com/(?:p|reel)/([^/?]+))", re.I),
-    'tiktok': re.compile(r"(https?://(?:www\.)?tiktok\.com/@[\w.-]+/video/\d+)", re.I),
-    'youtube': re.compile(r"(https?://(?:www\.)?(?:youtube\.com/shorts/|youtu\.be/)[\w-]+)", re.I),
-}
+    def _dispatch(self):
+        """
+        空きスロットがある限り、優先度の高い実行可能なジョブから開始
+        レート制限で待機中のプラットフォームのジョブはスロットを使わないよう、明けるまで開始しない
+        """
+        i = 0
+        while self.active < self.max_concurrent and i < len(self.pending):
+            job = self.pending[i]
+            blocked = platform_limiter.blocked_for(job.platform)
+            if blocked > 0:
+                self._dispatch_later(blocked)
+                i += 1
+            elif self.running.get(job.platform, 0) < self.limit_for(job.platform):
+                self.pending.pop(i)
+                self._start(job)
+            else:
+                i += 1
 
-# 全プラットフォーム統合正規表現
-ALL_PLATFORMS_RE = re.compile(
-    r"(https?://(?:www\.)?(?:instagram\.com/(?:p|reel)/|x\.com/\w+/status/|twitter\.com/\w+/status/|tiktok\.com/@[\w.-]+/video/|youtube\.com/shorts/|youtu\.be/)[\w-]+)",
-    re.I
-)
+    def _dispatch_later(self, delay: float):
+        loop = asyncio.get_running_loop()
+        if self.wakeup is not None and self.wakeup.when() <= loop.time() + delay:
+            return
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+        self.wakeup = loop.call_later(delay, self._wake)
 
-# 画像URLを判定する正規表現
-IMAGE_RE = re.compile(
-    r"(https?://\S+\.(?:jpg|jpeg|png|gif|webp)(?:\?\S*)?$)", 
-    re.I
-)
+    def _wake(self):
+        self.wakeup = None
+        self._dispatch()
+
+    def _start(self, job: Job):
+        JOBS_RUNNING.inc()
+        self.active += 1
+        self.running[job.platform] = self.running.get(job.platform, 0) + 1
+        task = asyncio.create_task(self._run(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job: Job):
+        current_job_id.set(job.journal_id)
+        current_job.set(job)
+        finished = False
+        try:
+            await job_handler(job.kind)(job.url, job.channel, job.platform)
+            finished = True
+            # 結果の表示に使われなかった待機中の表示は、結果を別に送信済みのため削除する
+            if job.notice is not None:
+                try:
+                    await job.notice.delete()
+                except discord.HTTPException:
+                    pass
+        except asyncio.CancelledError:
+            # シャットダウン時はジャーナルを残し、次回起動時に再開する
+            raise
+        except Exception as e:
+            print(f"✖ JOB ERROR: {job.url} - {str(e)}")
+            finished = True
+        finally:
+            if finished:
+                job_journal.finish(job.journal_id)
+            if job.queue_id is not None:
+                queue_worker.release(job.queue_id, finished)
+            JOBS_RUNNING.dec()
+            self.active -= 1
+            self.running[job.platform] -= 1
+            self._dispatch()
+            JOBS_QUEUED.set(len(self.pending))
+
+scheduler = JobScheduler(MAX_CONCURRENT_JOBS, parse_platform_limits(PLATFORM_CONCURRENCY))
+FRAGMENT_LIMITS = parse_platform_limits(FRAGMENT_CONCURRENCY, "FRAGMENT_CONCURRENCY")
+
+def fragment_concurrency(platform: str) -> int:
+    """1回のダウンロードで使いたい断片の同時取得数（実際の数は実行時に fragment_connections から借りられた分）"""
+    return max(1, min(FRAGMENT_LIMITS.get(platform, 1), FRAGMENT_CONNECTIONS_MAX))
+
+class ConnectionBudget:
+    """
+    全ジョブ合計の断片取得の同時接続数
+    yt-dlpの実行毎に希望数を上限として空いている分だけ借り、終了時に返す（空きが無ければ1つ空くまで待つ）
+    """
+
+    def __init__(self, total: int):
+        self.available = max(1, total)
+        self.changed = asyncio.Event()
+
+    @asynccontextmanager
+    async def hold(self, want: int):
+        while self.available <= 0:
+            self.changed.clear()
+            await self.changed.wait()
+        n = min(want, self.available)
+        self.available -= n
+        try:
+            yield n
+        finally:
+            self.available += n
+            self.changed.set()
+
+fragment_connections = ConnectionBudget(FRAGMENT_CONNECTIONS_MAX)
+
+def report_download_throughput(platform: str, nbytes: int, elapsed: float, opts: dict):
+    """yt-dlpのダウンロード部分の実効スループットを記録（断片の並行取得が効いているかの確認用）"""
+    if nbytes <= 0 or elapsed <= 0:
+        return
+    mb = nbytes / (1024 * 1024)
+    DOWNLOAD_THROUGHPUT.labels(platform).observe(mb / elapsed)
+    print(f"実効スループット: {mb / elapsed:.2f} MB/s（{mb:.1f} MB / {elapsed:.1f}秒, 断片の並列 {opts.get('concurrent_fragment_downloads', 1)}）")
+
+async def resume_journaled_jobs():
+    """前回のプロセスで未完了だったジョブを再投入"""
+    for job in job_journal.unfinished():
+        channel = bot.get_channel(job["channel_id"])
+        if channel is None:
+            print(f"⚠️ チャンネルが見つからないためジョブを破棄: {job['url']}")
+            job_journal.finish(job["id"])
+            continue
+        if job["attempts"] >= JOURNAL_MAX_ATTEMPTS:
+            print(f"✖ 再開回数の上限に達したためジョブを破棄: {job['url']}")
+            job_journal.finish(job["id"])
+            await channel.send(f"❌ 再起動を繰り返したため処理を中止しました: {job['url']}")
+            continue
+        job_journal.update(job["id"], attempts=job["attempts"] + 1)
+        print(f"🔁 Resuming job: {job['url']} (stage={job['stage']}, offset={job['upload_offset']})")
+        await channel.send(f"🔁 再起動前のジョブを再開します: {job['url']}")
+        await scheduler.submit(
+            job["kind"], job["url"], channel, job["platform"], job["priority"], journal_id=job["id"]
+        )
 
 # --------------------------------------------------
-# 3. Google Drive 設定
+# 6-2. 共有ジョブキュー（gateway / worker 分離）
 # --------------------------------------------------
-def setup_google_drive():
-    """Google Drive APIクライアントを設定"""
-    if not GOOGLE_SERVICE_ACCOUNT_JSON:
-        print("Google Drive サービスアカウントJSONが設定されていません")
-        return None
-    
-    try:
-        # サービスアカウント情報をJSONから読み込み
-        service_account_info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-        credentials = Credentials.from_service_account_info(
-            service_account_info,
-            scopes=['https://www.googleapis.com/auth/drive']
+class WorkQueue:
+    """
+    gatewayとworkerで共有するSQLiteのジョブキューと送信箱（outbox）
+    ジョブは貸出期限付きで取得し、期限が切れたもの（ワーカーの停止など）は他のワーカーが取得し直す
+    workerからのDiscordへの送信・編集・削除は送信箱に積み、gatewayが順番に実行する
+    """
+
+    def __init__(self, db_path: str):
+        self.lock = threading.Lock()
+        # 取得処理で BEGIN IMMEDIATE を使うため自動コミットモードで開く
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                channel_id INTEGER NOT NULL,
+                platform TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS queue_order ON queue (priority, id);
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                content TEXT,
+                embed TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox_files (
+                outbox_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL
+            );"""
         )
-        service = build('drive', 'v3', credentials=credentials)
-        print("Google Drive API初期化完了")
-        return service
-    except Exception as e:
-        print(f"Google Drive API初期化エラー: {e}")
-        return None
 
-# Google Drive サービス初期化
-drive_service = setup_google_drive()
+    def _transaction(self, work):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
 
-# --------------------------------------------------
-# 4. Cookie ファイルパス
-# --------------------------------------------------
-COOKIE_DIR = "/app/cookies"
-Path(COOKIE_DIR).mkdir(exist_ok=True)
+    def publish(self, kind: str, url: str, channel_id: int, platform: str, priority: int) -> tuple[int, int]:
+        """ジョブを登録し、(ID, 先に待っている未取得ジョブ数) を返す"""
+        def work():
+            cur = self.db.execute(
+                "INSERT INTO queue (kind, url, channel_id, platform, priority, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, url, channel_id, platform, priority, time.time()),
+            )
+            ahead = self.db.execute(
+                "SELECT COUNT(*) FROM queue WHERE worker IS NULL AND (priority < ? OR (priority = ? AND id < ?))",
+                (priority, priority, cur.lastrowid),
+            ).fetchone()[0]
+            return cur.lastrowid, ahead
+        return self._transaction(work)
 
-COOKIE_PATHS = {
-    "instagram": Path(COOKIE_DIR) / "instagram_cookies.txt",
-    "twitter": Path(COOKIE_DIR) / "twitter_cookies.txt",
-    "tiktok": Path(COOKIE_DIR) / "tiktok_cookies.txt",
-    "youtube": Path(COOKIE_DIR) / "youtube_cookies.txt",
-}
+    def claim(self, worker_id: str, exclude: list[str]) -> dict | None:
+        """未取得または貸出期限切れのジョブを優先度順に1件取得（exclude のプラットフォームは除く）"""
+        now = time.time()
+        skip = f" AND platform NOT IN ({', '.join('?' * len(exclude))})" if exclude else ""
+        def work():
+            row = self.db.execute(
+                f"SELECT * FROM queue WHERE (worker IS NULL OR lease_until < ?){skip} ORDER BY priority, id LIMIT 1",
+                (now, *exclude),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE queue SET worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + WORKER_LEASE_SEC, row["id"]),
+            )
+            return dict(row, worker=worker_id, attempts=row["attempts"] + 1)
+        return self._transaction(work)
 
-def cookie_for(url: str) -> Path | None:
-    """URLからクッキーファイルのパスを取得"""
-    if "instagram.com" in url:
-        return COOKIE_PATHS["instagram"]
-    if "twitter.com" in url or "x.com" in url:
-        return COOKIE_PATHS["twitter"]
-    if "tiktok.com" in url:
-        return COOKIE_PATHS["tiktok"]
-    if "youtube.com" in url or "youtu.be" in url:
-        return COOKIE_PATHS["youtube"]
-    return None
+    def owned(self, worker_id: str) -> list[dict]:
+        """前回のプロセスで同じワーカーが取得したまま終わらなかったジョブを取得し直す"""
+        def work():
+            self.db.execute(
+                "UPDATE queue SET lease_until = ?, attempts = attempts + 1 WHERE worker = ?",
+                (time.time() + WORKER_LEASE_SEC, worker_id),
+            )
+            rows = self.db.execute("SELECT * FROM queue WHERE worker = ? ORDER BY priority, id", (worker_id,)).fetchall()
+            return [dict(r) for r in rows]
+        return self._transaction(work)
 
-def detect_platform(url: str) -> str:
-    """URLからプラットフォームを検出"""
-    for platform, pattern in PLATFORM_PATTERNS.items():
-        if pattern.search(url):
-            return platform
-    return "unknown"
+    def renew(self, worker_id: str, job_ids: list[int]):
+        if not job_ids:
+            return
+        with self.lock:
+            self.db.execute(
+                f"UPDATE queue SET lease_until = ? WHERE worker = ? AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time() + WORKER_LEASE_SEC, worker_id, *job_ids),
+            )
 
-# --------------------------------------------------
-# 5. Google Drive アップロード関数
-# --------------------------------------------------
-async def upload_to_drive(file_path: str, filename: str, platform: str) -> tuple[str, str]:
+    def finish(self, job_id: int):
+        with self.lock:
+            self.db.execute("DELETE FROM queue WHERE id = ?", (job_id,))
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM queue WHERE worker IS NULL").fetchone()[0]
+
+    def post(self, channel_id: int, op: str, ref: str, content: str | None = None,
+             embed: dict | None = None, files: list[discord.File] = ()):
+        """送信箱に送信・編集・削除を積む（添付ファイルは内容ごと保存）"""
+        attachments = []
+        for f in files:
+            try:
+                attachments.append((f.filename, f.fp.read()))
+            finally:
+                f.close()
+        def work():
+            cur = self.db.execute(
+                "INSERT INTO outbox (channel_id, op, ref, content, embed, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (channel_id, op, ref, content, json.dumps(embed) if embed else None, time.time()),
+            )
+            self.db.executemany(
+                "INSERT INTO outbox_files (outbox_id, name, data) VALUES (?, ?, ?)",
+                [(cur.lastrowid, name, data) for name, data in attachments],
+            )
+        self._transaction(work)
+
+    def take_outbox(self, limit: int = 50) -> list[dict]:
+        with self.lock:
+            rows = [dict(r) for r in self.db.execute("SELECT * FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()]
+            for row in rows:
+                row["files"] = [
+                    (f["name"], f["data"])
+                    for f in self.db.execute("SELECT name, data FROM outbox_files WHERE outbox_id = ?", (row["id"],))
+                ]
+        return rows
+
+    def ack(self, outbox_ids: list[int]):
+        marks = ", ".join("?" * len(outbox_ids))
+        self._transaction(lambda: (
+            self.db.execute(f"DELETE FROM outbox WHERE id IN ({marks})", outbox_ids),
+            self.db.execute(f"DELETE FROM outbox_files WHERE outbox_id IN ({marks})", outbox_ids),
+        ))
+
+work_queue = WorkQueue(QUEUE_DB or os.path.join(DATA_DIR, "queue.sqlite3")) if ROLE in ("gateway", "worker") else None
+
+class RemoteMessage:
+    """workerから送信したメッセージの参照（編集・削除もgatewayが実行する）"""
+
+    def __init__(self, channel: "RemoteChannel", ref: str):
+        self.channel = channel
+        self.ref = ref
+
+    async def edit(self, content: str | None = None, embed: discord.Embed | None = None, **kwargs):
+        await self.channel.post("edit", self.ref, content, embed)
+        return self
+
+    async def delete(self):
+        await self.channel.post("delete", self.ref)
+
+class RemoteChannel:
+    """workerロールでハンドラに渡すチャンネル。送信内容を送信箱に積み、gatewayが実際に送信する"""
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+    async def post(self, op: str, ref: str, content: str | None = None, embed: discord.Embed | None = None,
+                   files: list[discord.File] = ()):
+        await asyncio.to_thread(
+            work_queue.post, self.id, op, ref, content, embed.to_dict() if embed else None, files
+        )
+
+    async def send(self, content: str | None = None, *, embed: discord.Embed | None = None,
+                   file: discord.File | None = None, files: list[discord.File] | None = None, **kwargs):
+        ref = uuid.uuid4().hex
+        await self.post("send", ref, content, embed, ([file] if file else []) + list(files or []))
+        return RemoteMessage(self, ref)
+
+class QueueScheduler:
+    """gatewayロール用: ジョブを実行せず共有キューに登録する（JobScheduler.submit と同じ呼び出し方）"""
+
+    async def submit(self, kind: str, url: str, channel, platform: str,
+                     priority: int = PRIORITY_AUTO, journal_id: int | None = None):
+        job_id, ahead = await asyncio.to_thread(work_queue.publish, kind, url, channel.id, platform, priority)
+        print(f"Job published: {url} (id {job_id}, {ahead} ahead)")
+        if ahead:
+            await channel.send(f"⏳ 待機中（{ahead + 1}番目）: {url}")
+
+class OutboxRelay:
+    """gatewayロール用: workerが積んだ送信・編集・削除を順番にDiscordへ反映する"""
+
+    MAX_TRACKED = 1000  # 編集・削除のために保持する送信済みメッセージ数
+
+    def __init__(self):
+        self.messages: OrderedDict[str, discord.Message] = OrderedDict()  # ref → 送信済みメッセージ
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                rows = await asyncio.to_thread(work_queue.take_outbox)
+                JOBS_QUEUED.set(await asyncio.to_thread(work_queue.depth))
+            except sqlite3.Error as e:
+                print(f"送信箱の読み込みエラー: {e}")
+                rows = []
+            if not rows:
+                await asyncio.sleep(QUEUE_POLL_SEC)
+                continue
+            # 同じメッセージへの編集が溜まっている場合は最後の編集（または削除）だけを反映する
+            last_change = {row["ref"]: row["id"] for row in rows if row["op"] in ("edit", "delete")}
+            for row in rows:
+                if row["op"] == "edit" and last_change[row["ref"]] != row["id"]:
+                    continue
+                try:
+                    await self.apply(row)
+                except discord.HTTPException as e:
+                    print(f"送信箱の反映エラー: {row['op']} - {e}")
+            await asyncio.to_thread(work_queue.ack, [row["id"] for row in rows])
+
+    async def apply(self, row: dict):
+        if row["op"] == "delete":
+            message = self.messages.pop(row["ref"], None)
+            if message is not None:
+                await message.delete()
+            return
+        kwargs = {}
+        if row["content"] is not None:
+            kwargs["content"] = row["content"]
+        if row["embed"]:
+            kwargs["embed"] = discord.Embed.from_dict(json.loads(row["embed"]))
+        if row["op"] == "edit":
+            message = self.messages.get(row["ref"])
+            if message is not None:
+                try:
+                    await message.edit(**kwargs)
+                    return
+                except discord.NotFound:
+                    self.messages.pop(row["ref"], None)
+            # 編集対象を保持していない場合（gatewayの再起動・保持数の超過・最初の送信の失敗・削除済み）は
+            # 結果が失われないよう新しく返信する（以降の編集はこのメッセージに反映する）
+            if not kwargs:
+                return
+        channel = bot.get_channel(row["channel_id"])
+        if channel is None:
+            print(f"⚠️ チャンネルが見つからないため送信を破棄: {row['channel_id']}")
+            return
+        if row["files"]:
+            kwargs["files"] = [discord.File(io.BytesIO(data), filename=name) for name, data in row["files"]]
+        self.messages[row["ref"]] = await channel.send(**kwargs)
+        while len(self.messages) > self.MAX_TRACKED:
+            self.messages.popitem(last=False)
+
+class QueueWorker:
     """
-    ファイルをGoogle Driveにアップロードして共有リンクを返す
-    Returns: (file_id, shareable_link)
+    workerロール用: 共有キューからジョブを取得し、ローカルのJobSchedulerで実行する
+    空きスロットがあり、同時実行数・レート制限に余裕のあるプラットフォームのジョブだけを取得する
     """
-    if not drive_service:
-        raise Exception("Google Drive APIが初期化されていません")
-    
-    try:
-        # ファイル名にプラットフォームと日時を追加
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        drive_filename = f"[{platform.upper()}]_{timestamp}_{filename}"
-        
-        # ファイルメタデータ
-        file_metadata = {
-            'name': drive_filename,
-            'parents': [GOOGLE_DRIVE_FOLDER_ID] if GOOGLE_DRIVE_FOLDER_ID else []
-        }
-        
-        # ファイルをアップロード
-        media = MediaFileUpload(file_path, resumable=True)
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-        
-        file_id = file.get('id')
-        
-        # ファイルを誰でもアクセス可能に設定
-        drive_service.permissions().create(
-            fileId=file_id,
-            body={
-                'role': 'reader',
-                'type': 'anyone'
-            }
-        ).execute()
-        
-        # 共有可能なリンクを生成
-        shareable_link = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
-        
-        print(f"Google Driveにアップロード完了: {drive_filename}")
-        return file_id, shareable_link
-        
-    except Exception as e:
-        print(f"Google Driveアップロードエラー: {e}")
-        raise
 
-# --------------------------------------------------
-# 6. Discord Bot 初期化
-# --------------------------------------------------
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.leased: set[int] = set()  # 実行中・待機中のキュー上のジョブID
 
-# 監視対象チャンネルのリスト
-MONITORED_CHANNELS = [CHANNEL_1, CHANNEL_2]
+    def release(self, job_id: int, finished: bool):
+        """ジョブ終了時にスケジューラから呼ばれる。中断（シャットダウン）時はキューに残して再実行させる"""
+        self.leased.discard(job_id)
+        if finished:
+            work_queue.finish(job_id)
+
+    def busy_platforms(self) -> list[str]:
+        platforms = {*MEDIA_PLATFORMS, "image", *scheduler.running}
+        return [
+            p for p in platforms
+            if scheduler.running.get(p, 0) >= scheduler.limit_for(p) or platform_limiter.blocked_for(p) > 0
+        ]
+
+    async def start_job(self, job: dict, journal_id: int | None = None):
+        channel = RemoteChannel(job["channel_id"])
+        if job["attempts"] > JOURNAL_MAX_ATTEMPTS + 1:
+            print(f"✖ 再開回数の上限に達したためジョブを破棄: {job['url']}")
+            work_queue.finish(job["id"])
+            job_journal.finish(journal_id)
+            await channel.send(f"❌ 再起動を繰り返したため処理を中止しました: {job['url']}")
+            return
+        if job["attempts"] > 1:
+            print(f"🔁 Resuming job: {job['url']} (attempt {job['attempts']})")
+            await channel.send(f"🔁 再起動前のジョブを再開します: {job['url']}")
+        self.leased.add(job["id"])
+        await scheduler.submit(
+            job["kind"], job["url"], channel, job["platform"], job["priority"],
+            journal_id=journal_id, queue_id=job["id"],
+        )
+
+    async def resume(self):
+        """
+        前回のプロセスが取得していたジョブを、ローカルのジャーナル（作業ディレクトリ・アップロードセッション）と
+        対応付けて再開する。対応するキュー上のジョブが無い（他のワーカーが引き継いだ）ジャーナルは破棄
+        """
+        journal = {(j["kind"], j["url"], j["channel_id"]): j["id"] for j in job_journal.unfinished()}
+        for job in await asyncio.to_thread(work_queue.owned, self.worker_id):
+            await self.start_job(job, journal.pop((job["kind"], job["url"], job["channel_id"]), None))
+        for journal_id in journal.values():
+            job_journal.finish(journal_id)
+
+    async def heartbeat(self):
+        """実行中のジョブの貸出期限を延長する"""
+        while True:
+            await asyncio.sleep(WORKER_LEASE_SEC / 3)
+            try:
+                await asyncio.to_thread(work_queue.renew, self.worker_id, list(self.leased))
+            except sqlite3.Error as e:
+                print(f"貸出期限の延長エラー: {e}")
+
+    async def run(self):
+        await self.resume()
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            while True:
+                job = None
+                if scheduler.active + len(scheduler.pending) < scheduler.max_concurrent:
+                    try:
+                        job = await asyncio.to_thread(work_queue.claim, self.worker_id, self.busy_platforms())
+                    except sqlite3.Error as e:
+                        print(f"キューの取得エラー: {e}")
+                if job is None:
+                    await asyncio.sleep(QUEUE_POLL_SEC)
+                    continue
+                print(f"Job claimed: {job['url']} (id {job['id']})")
+                await self.start_job(job)
+        finally:
+            heartbeat.cancel()
+
+queue_worker = QueueWorker(WORKER_ID)
+outbox_relay = OutboxRelay()
+if ROLE == "gateway":
+    scheduler = QueueScheduler()  # ジョブの実行はworkerが行う
+
+async def run_worker():
+    """workerロールのメインループ（Discordには接続しない）"""
+    print(f"ワーカーとして起動しました: {WORKER_ID}")
+    print(f'Google Drive設定: {"有効" if drive_enabled else "無効"}')
+    log_ready()
+    await start_metrics_server()
+    start_warm_up()
+    try:
+        await queue_worker.run()
+    finally:
+        await image_fetcher.close()
+        await url_router.close()
 
 # --------------------------------------------------
 # 7. メッセージ受信ハンドラ
@@ -171,24 +3594,55 @@ async def on_message(msg: discord.Message):
         return
     
     # メッセージ内のすべてのURLを取得
-    all_urls = re.findall(r'(https?://\S+)', msg.content)
+    all_urls = extract_urls(msg.content)
     
     if all_urls:
         print(f"Found URLs: {all_urls}")
         
-        for url in all_urls:
-            platform = detect_platform(url)
-            print(f"Platform detected: {platform} for URL: {url}")
+        # 短縮URLの展開・正規化を行い、同じメディアを指すURLは1つにまとめる
+        routes = [
+            route for route in await url_router.route_all(all_urls)
+            if route.platform in MEDIA_PLATFORMS or route.platform == "image"
+        ]
+        # 複数リンクへの返信は1つのメッセージにまとめる（gateway/worker分離時はworkerが個別に返信する）
+        group = None
+        if len(routes) > 1 and ROLE == "all" and REPLY_GROUP_WINDOW_SEC > 0:
+            group = ReplyGroup(msg.channel, [route.url for route in routes], REPLY_GROUP_WINDOW_SEC)
+        # アップロード済みのリンクは待ち行列に入れずにその場で返信する
+        cached_entries = await asyncio.gather(*(
+            lookup_cached_upload(media_key(route.url, route.platform)) for route in routes
+        ))
+        for route, cached in zip(routes, cached_entries):
+            print(f"Platform detected: {route.platform} for URL: {route.url}")
+            channel = group.member(route.url) if group else msg.channel
+            if cached:
+                await send_cached_upload(channel, route.url, cached, route.platform)
+                continue
             
             # 対応プラットフォームの場合はメディアダウンロード
-            if platform != "unknown":
-                asyncio.create_task(download_and_upload_media(url, msg.channel, platform))
+            if route.platform in MEDIA_PLATFORMS:
+                await scheduler.submit("media", route.url, channel, route.platform)
             # 画像URLの場合は画像ダウンロード
-            elif is_image_url(url):
-                asyncio.create_task(download_and_upload_image(url, msg.channel))
+            else:
+                if ROLE != "gateway":  # gatewayでは取得しない（workerが取得する）
+                    image_fetcher.prefetch(route.url, image_filename_for(route.url))
+                await scheduler.submit("image", route.url, channel, "image")
+        log_first_message()
     
     await bot.process_commands(msg)
 
+first_message_logged = False
+
+def log_first_message():
+    """起動から最初にリンクを受け付けるまでの時間を記録（コールドスタートの計測用）"""
+    global first_message_logged
+    if first_message_logged:
+        return
+    first_message_logged = True
+    elapsed = time.monotonic() - PROCESS_START
+    STARTUP_SECONDS.labels("first_message").set(elapsed)
+    print(f"起動から最初のメッセージ処理まで: {elapsed:.2f}秒")
+
 def is_image_url(url: str) -> bool:
     """URLが画像URLかどうかを判定する"""
     if IMAGE_RE.match(url):
@@ -204,42 +3658,43 @@ async def download_and_upload_image(url: str, channel):
     """URLから画像をダウンロードし、Google Driveにアップロードして共有リンクを送信"""
     print(f"▶ START IMAGE DOWNLOAD & UPLOAD: {url}")
     
-    tmpdir = tempfile.mkdtemp()
+    key = media_key(url, "image")
+    cached = await lookup_cached_upload(key)
+    if cached:
+        image_fetcher.discard(url)
+        await send_cached_upload(channel, url, cached, "image")
+        return
+    
+    reservation = await admit_job(channel, url, "image", IMAGE_JOB_DISK, IMAGE_JOB_MEMORY)
+    if reservation is None:
+        image_fetcher.discard(url)
+        return
+    tmpdir = job_scratch_dir()
+    reservation.path = tmpdir
+    keep_tmpdir = False
     
     try:
         # URLからファイル名を取得
-        parsed_url = urlparse(url)
-        path = parsed_url.path
-        filename = os.path.basename(path)
-        
-        if not filename or '.' not in filename:
-            filename = f"image_{int(asyncio.get_event_loop().time())}.jpg"
-        
+        filename = image_filename_for(url)
         file_path = os.path.join(tmpdir, filename)
         
-        # 画像をダウンロード
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
-            'Referer': 'https://www.instagram.com/',
-        }
-        
-        response = requests.get(url, headers=headers, stream=True, timeout=30)
+        # 画像をダウンロード（先行取得済みならその結果を使う）
+        with track_stage("image_download", "image"):
+            fetched = await image_fetcher.fetch(url, file_path)
         
-        if response.status_code == 200:
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            
-            file_size = os.path.getsize(file_path)
+        if fetched.status == 200:
+            file_size = fetched.size
+            TRANSFER_BYTES.labels("download", "image").inc(file_size)
             file_size_mb = file_size / (1024 * 1024)
             print(f"Image downloaded: {filename} ({file_size_mb:.2f} MB)")
             
             # Google Driveにアップロード
-            if drive_service:
+            if drive_enabled:
                 try:
-                    file_id, shareable_link = await upload_to_drive(file_path, filename, "image")
+                    file_id, shareable_link = await upload_to_drive(
+                        file_path, filename, "image", md5=fetched.md5
+                    )
+                    media_cache.put(key, file_id, shareable_link, file_size)
                     
                     embed = discord.Embed(
                         title="✅ 画像ダウンロード＆アップロード完了",
@@ -249,7 +3704,7 @@ async def download_and_upload_image(url: str, channel):
                     embed.add_field(name="Google Drive リンク", value=f"[ファイルを開く]({shareable_link})", inline=False)
                     embed.add_field(name="ダウンロード", value=f"[直接ダウンロード](https://drive.google.com/uc?id={file_id})", inline=False)
                     
-                    await channel.send(embed=embed)
+                    await deliver(channel, "image", "drive", embed=embed)
                     print(f"✔ Image uploaded to Google Drive: {filename}")
                     
                 except Exception as e:
@@ -257,171 +3712,433 @@ async def download_and_upload_image(url: str, channel):
                     discord_limit = 8 * 1024 * 1024
                     if file_size <= discord_limit:
                         discord_file = discord.File(file_path)
-                        await channel.send(f"⚠️ Google Driveアップロード失敗。Discordに直接送信: {url}", file=discord_file)
+                        await deliver(channel, "image", "discord_fallback", f"⚠️ Google Driveアップロード失敗。Discordに直接送信: {url}", file=discord_file)
                     else:
-                        await channel.send(f"❌ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}")
+                        await deliver(channel, "image", "failed", f"❌ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}")
             else:
                 # Google Drive未設定の場合はDiscordに直接送信
                 discord_limit = 8 * 1024 * 1024
                 if file_size <= discord_limit:
                     discord_file = discord.File(file_path)
-                    await channel.send(f"✅ 画像ダウンロード完了: {url}", file=discord_file)
+                    await deliver(channel, "image", "discord", f"✅ 画像ダウンロード完了: {url}", file=discord_file)
                 else:
-                    await channel.send(f"⚠️ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}")
+                    await deliver(channel, "image", "failed", f"⚠️ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}")
         else:
-            await channel.send(f"❌ 画像ダウンロード失敗: {url} (ステータスコード: {response.status_code})")
+            STAGE_FAILURES.labels("image_download", "image").inc()
+            await deliver(channel, "image", "failed", f"❌ 画像ダウンロード失敗: {url} (ステータスコード: {fetched.status})")
+    
+    except asyncio.CancelledError:
+        keep_tmpdir = True
+        raise
     
     except Exception as e:
-        await channel.send(f"❌ 画像処理中にエラーが発生しました: {url}")
+        await deliver(channel, "image", "failed", f"❌ 画像処理中にエラーが発生しました: {url}")
         print(f"✖ IMAGE DOWNLOAD ERROR: {url} - {str(e)}")
     
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        resource_governor.release(reservation)
+        if not keep_tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
 # --------------------------------------------------
 # 9. メディアダウンロード＆アップロード関数
 # --------------------------------------------------
 async def download_and_upload_media(url: str, channel, platform: str):
     """URLから動画をダウンロードし、Google Driveにアップロードして共有リンクを送信"""
+    reporter = ProgressReporter(channel, url)
+    try:
+        await _download_and_upload_media(url, channel, platform, reporter)
+    finally:
+        await reporter.close()
+
+async def _download_and_upload_media(url: str, channel, platform: str, reporter: ProgressReporter):
     print(f"▶ START MEDIA DOWNLOAD & UPLOAD: {url} (Platform: {platform})")
-    tmpdir = tempfile.mkdtemp()
     
+    key = media_key(url, platform)
+    # 結果はプレビュー（進捗）メッセージを書き換えて返信する
+    reply = reporter
+    cached = await lookup_cached_upload(key)
+    if cached:
+        # 待機中の表示があればキャッシュ済みの結果に書き換える
+        await send_cached_upload(reply, url, cached, platform)
+        return
+    
+    job = job_journal.current()
+    resuming_upload = bool(job and job["stage"] == "uploading")
+    started = time.monotonic()
+    
+    # プリフライト: メタデータから送信先に合う形式を決め、収まらなければダウンロード前に中止
+    info = None
+    format_override = None
+    size = None
+    notes = []  # プレビューに添える（プレビューを出さない場合は個別に送信する）通知
+    if PROBE_ENABLED and not resuming_upload:
+        error_msg, info = await probe_media(url, platform, ytdl_options(platform, "-"), key)
+        if error_msg:
+            await deliver(reply, platform, "failed", f"❌ {platform.upper()} ダウンロード失敗{failure_reason(error_msg)}: {url}")
+            print(f"✖ PROBE FAILED: {url} - {error_msg}")
+            return
+        size = expected_size(info)
+        # 複数メディア投稿は1件ずつ送信するため、合計サイズでは中止しない
+        if not drive_enabled and size and size > DISCORD_FILE_LIMIT and not info.get("entries"):
+            fitting = fitting_format(info, DISCORD_FILE_LIMIT)
+            if not fitting:
+                await deliver(
+                    reply, platform, "failed",
+                    f"⚠️ ファイルサイズが大きすぎます (予想 {size / (1024 * 1024):.2f}MB): {url}\n"
+                    f"Google Driveを設定するか `!compress` を使用してください。"
+                )
+                print(f"✖ REJECTED BEFORE DOWNLOAD: {url} (expected {size} bytes)")
+                return
+            format_override, size = fitting
+            notes.append(f"📉 Discordの上限に収まる形式でダウンロードします（予想 {size / (1024 * 1024):.2f}MB）")
+        if size and size >= PROBE_NOTICE_MB * 1024 * 1024:
+            notes.append(f"📦 予想サイズ {size / (1024 * 1024):.1f}MB・予想所要時間 約{throughput.eta(platform, size):.0f}秒")
+        if PREVIEW_REPLY:
+            await reporter.preview(platform, info, notes)
+        else:
+            for note in notes:
+                await channel.send(f"{note}: {url}")
+    
+    entries = [entry for entry in (info or {}).get("entries") or [] if entry][:MULTI_ITEM_MAX]
+    
+    # 想定使用量を予約してから開始（予算を超えている間は待機）。ストリーミングはディスクを使わない
+    streaming = drive_enabled and STREAM_UPLOAD and platform in STREAM_FORMATS and not resuming_upload and not entries
+    disk = job_disk_estimate(size, merge=not format_override)
+    memory = JOB_MEMORY_MB * 1024 * 1024 + (STREAM_BUFFER_CHUNKS + 1) * DRIVE_CHUNK_SIZE
+    reservation = await admit_job(channel, url, platform, 0 if streaming else disk, memory)
+    if reservation is None:
+        return
     try:
-        out_tpl = os.path.join(tmpdir, "%(uploader)s_%(id)s.%(ext)s")
-
-        # プラットフォーム別のyt-dlpオプション
-        cmd = [YTDL]
+        # 単一ファイル形式はDriveへ直接ストリーミング（失敗時は一時ファイル経由）
+        if streaming:
+            job_journal.update_current(stage="streaming")
+            try:
+                streamed = await stream_to_drive(
+                    url, platform, key.replace(":", "_") + ".mp4",
+                    progress=reporter.upload, info=info, download_progress=reporter.download
+                )
+                if streamed:
+                    file_id, shareable_link, file_size = streamed
+                    throughput.observe(platform, file_size, time.monotonic() - started)
+                    media_cache.put(key, file_id, shareable_link, file_size)
+                    await deliver(reply, platform, "drive", embed=media_upload_embed(
+                        platform, url, file_size / (1024 * 1024), file_id, shareable_link
+                    ))
+                    print(f"✔ Media streamed to Google Drive: {url}")
+                    return
+            except Exception as e:
+                print(f"ストリーミングアップロードエラー（一時ファイル経由で再試行）: {e}")
+            # 一時ファイル経由に切り替えるため、ディスク分も含めて予約し直す
+            resource_governor.release(reservation)
+            reservation = await admit_job(channel, url, platform, disk, memory)
+            if reservation is None:
+                return
         
-        if platform == "instagram":
-            cmd.extend([
-                "-f", "best[ext=mp4]/best",
-                "--merge-output-format", "mp4",
-                "--write-thumbnail",
-                "-o", out_tpl,
-                url,
-            ])
-        elif platform == "tiktok":
-            cmd.extend([
-                "-f", "best[ext=mp4]/best",
-                "--merge-output-format", "mp4",
-                "-o", out_tpl,
-                url,
-            ])
-        elif platform == "youtube":
-            cmd.extend([
-                "-f", "best[height<=1080][ext=mp4]/best[ext=mp4]/best",
-                "--merge-output-format", "mp4",
-                "-o", out_tpl,
-                url,
-            ])
-        else:  # Twitter/X
-            cmd.extend([
-                "-S", "vcodec:h264,acodec:m4a,ext:mp4",
-                "--merge-output-format", "mp4",
-                "-o", out_tpl,
-                url,
-            ])
-
-        # Cookieファイルがあれば追加
-        ck = cookie_for(url)
-        if ck and ck.is_file():
-            cmd.extend(["--cookies", str(ck)])
-            print(f"Using cookie file: {ck}")
-
-        print(f"Running command: {' '.join(cmd)}")
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
+        tmpdir = job_scratch_dir()
+        reservation.path = tmpdir
+        keep_tmpdir = False
+        
+        try:
+            out_tpl = os.path.join(tmpdir, "%(uploader)s_%(id)s.%(ext)s")
 
-        if proc.returncode == 0:
-            # ダウンロード成功 - ファイルを検索
-            media_files = []
-            for ext in ['*.mp4', '*.mov', '*.avi', '*.mkv']:
-                media_files.extend(list(Path(tmpdir).glob(ext)))
-            
-            if not media_files:
-                # 動画がない場合は画像を検索
-                for ext in ['*.jpg', '*.jpeg', '*.png', '*.webp']:
+            if resuming_upload:
+                # 再起動前にダウンロードは完了している
+                print(f"ダウンロード済みのファイルから再開: {url}")
+                returncode, error_msg = 0, ""
+            else:
+                # プラットフォーム別のyt-dlpオプション（途中までの .part があれば続きから）
+                job_journal.update_current(stage="downloading")
+                opts = ytdl_options(platform, out_tpl)
+                if format_override:
+                    opts.pop("format_sort", None)
+                    opts["format"] = format_override
+                before, download_start = dir_size(tmpdir), time.monotonic()
+                if entries:
+                    returncode, error_msg = await download_entries(entries, opts, platform, reporter)
+                else:
+                    split = None if format_override else await download_split_streams(url, opts, platform, info, tmpdir, reporter)
+                    returncode, error_msg = split or await run_ytdl(url, opts, platform, info, progress=reporter.download)
+                if returncode == 0:
+                    report_download_throughput(platform, dir_size(tmpdir) - before, time.monotonic() - download_start, opts)
+
+            if returncode == 0:
+                # ダウンロード成功 - ファイルを検索
+                media_files = []
+                for ext in ['*.mp4', '*.mov', '*.avi', '*.mkv']:
                     media_files.extend(list(Path(tmpdir).glob(ext)))
-            
-            if media_files:
-                for media_file in media_files[:1]:  # 最初のファイルのみ処理
-                    file_size = media_file.stat().st_size
-                    file_size_mb = file_size / (1024 * 1024)
-                    print(f"Media file found: {media_file.name} ({file_size_mb:.2f} MB)")
-                    
-                    # Google Driveにアップロード
-                    if drive_service:
-                        try:
-                            file_id, shareable_link = await upload_to_drive(
-                                str(media_file), media_file.name, platform
-                            )
-                            
-                            # 埋め込みメッセージを作成
-                            embed = discord.Embed(
-                                title=f"✅ {platform.upper()} メディアダウンロード＆アップロード完了",
-                                description=f"**元URL:** {url}\n**ファイルサイズ:** {file_size_mb:.2f} MB",
-                                color=0x00ff00
-                            )
-                            embed.add_field(
-                                name="Google Drive リンク", 
-                                value=f"[ファイルを開く]({shareable_link})", 
-                                inline=False
-                            )
-                            embed.add_field(
-                                name="ダウンロード", 
-                                value=f"[直接ダウンロード](https://drive.google.com/uc?id={file_id})", 
-                                inline=False
-                            )
-                            embed.set_footer(text=f"プラットフォーム: {platform.upper()}")
-                            
-                            await channel.send(embed=embed)
-                            print(f"✔ Media uploaded to Google Drive: {media_file.name}")
-                            
-                        except Exception as e:
-                            print(f"Google Drive upload error: {e}")
-                            # フォールバック: Discordに直接送信を試行
+                
+                if not media_files:
+                    # 動画がない場合は画像を検索
+                    for ext in ['*.jpg', '*.jpeg', '*.png', '*.webp']:
+                        media_files.extend(list(Path(tmpdir).glob(ext)))
+                
+                media_files = order_media_files(media_files, entries)[:MULTI_ITEM_MAX]
+                if media_files:
+                    job_journal.update_current(stage="remuxing")
+                    media_files = list(await asyncio.gather(*(faststart_remux(p, platform) for p in media_files)))
+                if len(media_files) > 1:
+                    await deliver_multi_item_post(reply, platform, url, key, media_files, reporter, started)
+                elif media_files:
+                    for media_file in media_files:
+                        file_size = media_file.stat().st_size
+                        file_size_mb = file_size / (1024 * 1024)
+                        TRANSFER_BYTES.labels("download", platform).inc(file_size)
+                        print(f"Media file found: {media_file.name} ({file_size_mb:.2f} MB)")
+                        job_journal.update_current(stage="uploading")
+                        
+                        # Google Driveにアップロード
+                        if drive_enabled:
+                            try:
+                                file_id, shareable_link = await upload_to_drive(
+                                    str(media_file), media_file.name, platform, progress=reporter.upload
+                                )
+                                media_cache.put(key, file_id, shareable_link, file_size)
+                                throughput.observe(platform, file_size, time.monotonic() - started)
+                                
+                                # 埋め込みメッセージを作成
+                                embed = media_upload_embed(platform, url, file_size_mb, file_id, shareable_link)
+                                await deliver(reply, platform, "drive", embed=embed)
+                                print(f"✔ Media uploaded to Google Drive: {media_file.name}")
+                                
+                            except Exception as e:
+                                print(f"Google Drive upload error: {e}")
+                                # フォールバック: Discordに直接送信を試行
+                                discord_limit = 8 * 1024 * 1024
+                                if file_size <= discord_limit:
+                                    discord_file = discord.File(str(media_file))
+                                    await deliver(
+                                        reply, platform, "discord_fallback",
+                                        f"⚠️ Google Driveアップロード失敗。Discordに直接送信: {url}", 
+                                        file=discord_file
+                                    )
+                                else:
+                                    await deliver(
+                                        reply, platform, "failed",
+                                        f"❌ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}\n"
+                                        f"Google Driveアップロードも失敗しました。"
+                                    )
+                        else:
+                            # Google Drive未設定の場合
                             discord_limit = 8 * 1024 * 1024
                             if file_size <= discord_limit:
                                 discord_file = discord.File(str(media_file))
-                                await channel.send(
-                                    f"⚠️ Google Driveアップロード失敗。Discordに直接送信: {url}", 
-                                    file=discord_file
-                                )
+                                await deliver(reply, platform, "discord", f"✅ {platform.upper()} ダウンロード完了: {url}", file=discord_file)
                             else:
-                                await channel.send(
-                                    f"❌ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}\n"
-                                    f"Google Driveアップロードも失敗しました。"
+                                await deliver(
+                                    reply, platform, "failed",
+                                    f"⚠️ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}\n"
+                                    f"Google Driveを設定してください。"
                                 )
-                    else:
-                        # Google Drive未設定の場合
-                        discord_limit = 8 * 1024 * 1024
-                        if file_size <= discord_limit:
-                            discord_file = discord.File(str(media_file))
-                            await channel.send(f"✅ {platform.upper()} ダウンロード完了: {url}", file=discord_file)
-                        else:
-                            await channel.send(
-                                f"⚠️ ファイルサイズが大きすぎます ({file_size_mb:.2f}MB): {url}\n"
-                                f"Google Driveを設定してください。"
-                            )
-                    break
+                        break
+                else:
+                    await deliver(reply, platform, "failed", f"❌ ダウンロードしたファイルが見つかりません: {url}")
+                    print(f"No media files found in {tmpdir}")
             else:
-                await channel.send(f"❌ ダウンロードしたファイルが見つかりません: {url}")
-                print(f"No media files found in {tmpdir}")
-        else:
-            error_msg = stderr.decode() if stderr else "Unknown error"
-            await channel.send(f"❌ {platform.upper()} ダウンロード失敗: {url}")
-            print(f"✖ DOWNLOAD FAILED: {url} (rc={proc.returncode}) - {error_msg}")
+                error_msg = error_msg or "Unknown error"
+                await deliver(reply, platform, "failed", f"❌ {platform.upper()} ダウンロード失敗{failure_reason(error_msg)}: {url}")
+                print(f"✖ DOWNLOAD FAILED: {url} (rc={returncode}) - {error_msg}")
 
-    except Exception as e:
-        await channel.send(f"❌ {platform.upper()} 処理中にエラーが発生しました: {url}")
-        print(f"✖ MEDIA DOWNLOAD ERROR: {url} - {str(e)}")
+        except asyncio.CancelledError:
+            keep_tmpdir = True
+            raise
+
+        except Exception as e:
+            await deliver(reply, platform, "failed", f"❌ {platform.upper()} 処理中にエラーが発生しました: {url}")
+            print(f"✖ MEDIA DOWNLOAD ERROR: {url} - {str(e)}")
+
+        finally:
+            if not keep_tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    finally:
+        resource_governor.release(reservation)
+
+# --------------------------------------------------
+# 9-1. 複数メディア投稿（カルーセル・複数動画のツイート）
+# --------------------------------------------------
+async def download_entries(entries: list[dict], opts: dict, platform: str, reporter: ProgressReporter) -> tuple[int, str]:
+    """
+    プレイリストの各項目を同時実行数を制限して並行にダウンロード
+    1件でも成功すれば成功扱いとし、失敗した項目はログに残す
+    """
+    parallel = max(1, min(MULTI_ITEM_CONCURRENCY, len(entries)))
+    semaphore = asyncio.Semaphore(parallel)
+    if "concurrent_fragment_downloads" in opts:
+        # 断片の同時取得数は同時にダウンロードする項目で分け合う
+        opts = dict(opts, concurrent_fragment_downloads=max(1, opts["concurrent_fragment_downloads"] // parallel))
+    
+    async def download_one(n: int, entry: dict) -> tuple[int, str]:
+        async with semaphore:
+            entry_url = entry.get("webpage_url") or entry.get("url")
+            return await run_ytdl(entry_url, opts, platform, entry, progress=reporter.download_part(n))
+    
+    results = await asyncio.gather(*(download_one(n, entry) for n, entry in enumerate(entries)))
+    errors = [error_msg or "Unknown error" for returncode, error_msg in results if returncode != 0]
+    if len(errors) == len(results):
+        return 1, "\n".join(errors)
+    if errors:
+        print(f"一部の項目のダウンロードに失敗 ({len(errors)}/{len(results)}): " + "\n".join(errors))
+    return 0, ""
+
+def order_media_files(media_files: list[Path], entries: list[dict]) -> list[Path]:
+    """ダウンロードしたファイルを投稿内の順に並べる（出力名に含まれるIDで照合）"""
+    ids = [entry.get("id") for entry in entries]
+    
+    def position(path: Path) -> tuple[int, str]:
+        for n, entry_id in enumerate(ids):
+            if entry_id and f"_{entry_id}." in path.name:
+                return n, path.name
+        return len(ids), path.name
+    return sorted(media_files, key=position)
+
+async def send_files_to_discord(channel, platform: str, url: str, via: str, content: str, files: list[tuple[Path, int]]):
+    """上限に収まるファイルをまとめて（1メッセージ最大10件）送信し、収まらないものは通知"""
+    too_large = [f"{path.name} ({size / (1024 * 1024):.2f}MB)" for path, size in files if size > DISCORD_FILE_LIMIT]
+    batch, batch_size = [], 0
+    for path, size in files:
+        if size > DISCORD_FILE_LIMIT:
+            continue
+        if batch and (len(batch) == 10 or batch_size + size > DISCORD_FILE_LIMIT):
+            await deliver(channel, platform, via, content, files=[discord.File(str(p)) for p in batch])
+            batch, batch_size = [], 0
+        batch.append(path)
+        batch_size += size
+    if batch:
+        await deliver(channel, platform, via, content, files=[discord.File(str(p)) for p in batch])
+    if too_large:
+        await deliver(
+            channel, platform, "failed",
+            f"⚠️ ファイルサイズが大きすぎるため送信できませんでした: {url}\n" + "\n".join(too_large)
+        )
+
+async def deliver_multi_item_post(channel, platform: str, url: str, key: str, media_files: list[Path],
+                                  reporter: ProgressReporter, started: float):
+    """複数メディア投稿の全ファイルを並行にアップロードし、1つの埋め込みメッセージで返信"""
+    sizes = [path.stat().st_size for path in media_files]
+    TRANSFER_BYTES.labels("download", platform).inc(sum(sizes))
+    print(f"Media files found: {len(media_files)} items ({sum(sizes) / (1024 * 1024):.2f} MB)")
+    job_journal.update_current(stage="uploading")
+    
+    if not drive_enabled:
+        await send_files_to_discord(
+            channel, platform, url, "discord",
+            f"✅ {platform.upper()} ダウンロード完了（{len(media_files)}件）: {url}", list(zip(media_files, sizes))
+        )
+        return
+    
+    # 投稿毎のサブフォルダ（作成に失敗した場合は通常の保存先へ）
+    folder_id = None
+    if DRIVE_POST_SUBFOLDER:
+        try:
+            loop = asyncio.get_running_loop()
+            folder = await loop.run_in_executor(
+                drive_api_executor, _create_drive_folder_blocking, drive_filename_for(key.replace(":", "_"), platform), platform
+            )
+            await grant_public_read(folder, platform)
+            folder_id = folder
+        except Exception as e:
+            print(f"Driveサブフォルダ作成エラー（通常の保存先を使用）: {e}")
+    
+    results = await asyncio.gather(*(
+        upload_to_drive(str(path), path.name, platform, progress=reporter.upload_part(n), parent=folder_id, grant=False)
+        for n, path in enumerate(media_files)
+    ), return_exceptions=True)
+    # サブフォルダに入れない場合は、全ファイルの公開設定を1回のバッチリクエストで行う
+    if not folder_id:
+        grant_errors = await grant_public_read_all(
+            [result[0] for result in results if not isinstance(result, BaseException)], platform
+        )
+        results = [
+            grant_errors.get(result[0], result) if not isinstance(result, BaseException) else result
+            for result in results
+        ]
+    
+    items, failed = [], []
+    for path, size, result in zip(media_files, sizes, results):
+        if isinstance(result, BaseException):
+            print(f"Google Drive upload error: {path.name} - {result}")
+            failed.append((path, size))
+        else:
+            file_id, shareable_link = result
+            items.append({"file_id": file_id, "link": shareable_link, "size": size})
+    
+    if items:
+        folder_link = f"https://drive.google.com/drive/folders/{folder_id}" if folder_id else None
+        if not failed:
+            media_cache.put(
+                key, folder_id or items[0]["file_id"], folder_link or items[0]["link"], sum(sizes), items=items
+            )
+        throughput.observe(platform, sum(sizes), time.monotonic() - started)
+        await deliver(channel, platform, "drive", embed=multi_upload_embed(
+            platform, url, items, folder_link, failed=[path.name for path, _ in failed]
+        ))
+        print(f"✔ {len(items)} media files uploaded to Google Drive: {url}")
+    if failed:
+        # アップロードできなかったファイルはDiscordへ直接送信を試行
+        await send_files_to_discord(
+            channel, platform, url, "discord_fallback",
+            f"⚠️ Google Driveアップロード失敗。Discordに直接送信: {url}", failed
+        )
 
+# --------------------------------------------------
+# 9-2. 映像・音声の同時ダウンロード（DASH・別音声のHLS）
+# --------------------------------------------------
+async def download_split_streams(url: str, opts: dict, platform: str, info: dict | None, tmpdir: str,
+                                 reporter: ProgressReporter) -> tuple[int, str] | None:
+    """
+    映像と音声が別の形式に分かれている場合は、2つを同時にダウンロードしてから再エンコードせずに結合する
+    （yt-dlpは選択した形式を1つずつ順にダウンロードするため、同時に取得すると短い方の待ち時間が隠れる）
+    分けて取得しない場合（単一の形式・メタデータ無し・無効・結合の失敗）は None を返す（通常どおりダウンロードする）
+    """
+    formats = (info or {}).get("requested_formats") or []
+    if not SPLIT_STREAM_DOWNLOAD or len(formats) != 2:
+        return None
+    video = next((f for f in formats if f.get("vcodec") != "none"), None)
+    audio = next((f for f in formats if f is not video and f.get("acodec") != "none"), None)
+    if video is None or audio is None or video.get("acodec") not in (None, "none"):
+        return None
+    ext = opts.get("merge_output_format", "mp4")
+    if "concurrent_fragment_downloads" in opts:
+        # 断片の同時取得数は映像と音声で分け合う（合計は fragment_connections の範囲内）
+        opts = dict(opts, concurrent_fragment_downloads=max(1, opts["concurrent_fragment_downloads"] // 2))
+    # 作業中のファイルは動画の拡張子にしない（中断後の再開時にダウンロード結果として拾わないように）
+    out_tpl = os.path.join(tmpdir, "%(uploader)s_%(id)s.%(ext)s")
+    
+    async def fetch(n: int, fmt: dict, kind: str) -> tuple[int, str]:
+        part_opts = dict(opts, format=fmt["format_id"], outtmpl=f"{out_tpl}.{kind}")
+        part_opts.pop("format_sort", None)
+        if kind == "audio":
+            part_opts.pop("writethumbnail", None)
+        return await run_ytdl(url, part_opts, platform, info, progress=reporter.download_part(n))
+    
+    print(f"映像と音声を同時にダウンロード: {url} ({video['format_id']} + {audio['format_id']})")
+    results = await asyncio.gather(fetch(0, video, "video"), fetch(1, audio, "audio"))
+    for returncode, error_msg in results:
+        if returncode != 0:
+            return returncode, error_msg
+    parts = [next(Path(tmpdir).glob(f"*.{kind}"), None) for kind in ("video", "audio")]
+    if None in parts:
+        print(f"⚠️ 分割ダウンロードしたファイルが見つかりません（通常のダウンロードに切り替え）: {url}")
+        return None
+    video_path, audio_path = parts
+    output = video_path.with_name(f"{video_path.name.rsplit('.', 2)[0]}.{ext}")
+    working = output.with_name(f"{output.name}.mux")
+    try:
+        with track_stage("mux", platform):
+            returncode, error_msg = await run_ffmpeg(
+                ["-i", str(video_path), "-i", str(audio_path), "-map", "0:v:0", "-map", "1:a:0",
+                 "-c", "copy", "-movflags", "+faststart", "-f", ext, str(working)],
+                slots=remux_slots,
+            )
+        if returncode != 0:
+            print(f"⚠️ 映像と音声の結合に失敗（通常のダウンロードに切り替え）: {url} - {error_msg[-500:]}")
+            return None
+        os.replace(working, output)
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        working.unlink(missing_ok=True)
+        video_path.unlink(missing_ok=True)
+        audio_path.unlink(missing_ok=True)
+    return 0, ""
 
 # --------------------------------------------------
 # 10. 手動ダウンロードコマンド
@@ -432,15 +4149,17 @@ async def manual_download(ctx, url: str, platform: str = None):
     if ctx.channel.id not in MONITORED_CHANNELS:
         return
     
+    route = await url_router.resolve(url)
+    url = route.url
     if platform is None:
-        platform = detect_platform(url)
+        platform = route.platform
     
     if platform == "unknown":
         await ctx.send(f"❌ 対応していないプラットフォームです: {url}")
         return
     
     await ctx.send(f"🔄 {platform.upper()} メディアをダウンロード中: {url}")
-    await download_and_upload_media(url, ctx.channel, platform)
+    await scheduler.submit("media", url, ctx.channel, platform, priority=PRIORITY_MANUAL)
 
 @bot.command(name="image")
 async def image_download_command(ctx, url: str):
@@ -449,84 +4168,170 @@ async def image_download_command(ctx, url: str):
         return
     
     await ctx.send(f"🔄 画像のダウンロード中: {url}")
-    await download_and_upload_image(url, ctx.channel)
+    await scheduler.submit("image", url, ctx.channel, "image", priority=PRIORITY_MANUAL)
 
 # --------------------------------------------------
 # 11. 圧縮ダウンロードコマンド
 # --------------------------------------------------
 @bot.command(name="compress")
-async def compress_download(ctx, url: str):
-    """画質を下げて動画をダウンロードするコマンド"""
+async def compress_download(ctx, url: str, target_mb: float = None):
+    """目標サイズ（既定はDiscordの上限）に収まるよう再エンコードしてダウンロードするコマンド"""
     if ctx.channel.id not in MONITORED_CHANNELS:
         return
     
-    await ctx.send(f"🔄 圧縮モードで処理中: {url}")
+    if target_mb is not None and not 1 <= target_mb <= COMPRESS_MAX_MB:
+        await ctx.send(f"❌ 目標サイズは1〜{COMPRESS_MAX_MB}MBで指定してください")
+        return
+    route = await url_router.resolve(url)
+    kind = "compress" if target_mb is None else f"compress:{target_mb:g}"
+    await ctx.send(f"🔄 圧縮モードで処理中: {route.url}")
+    await scheduler.submit(kind, route.url, ctx.channel, route.platform, priority=PRIORITY_MANUAL)
+
+async def compress_and_upload(url: str, ctx, platform: str, target_mb: float | None = None):
+    """
+    目標サイズに収まるようダウンロードしてアップロード（スケジューラから実行）
+    収まる形式があればそのままダウンロードし、無ければ720pまでの形式を取得して長さから決めたビットレートで再エンコードする
+    """
+    target = int(target_mb * 1024 * 1024) if target_mb else DISCORD_FILE_LIMIT
+    target_label = f"{target / (1024 * 1024):g}MB"
+    key = compress_cache_key(media_key(url, platform), target_mb)
+    cached = await lookup_cached_upload(key)
+    if cached:
+        await send_cached_upload(ctx, url, cached, platform)
+        return
+    if not drive_enabled and target > DISCORD_FILE_LIMIT:
+        await deliver(ctx, platform, "failed", f"❌ Google Driveが無効のため、Discordの上限（{DISCORD_FILE_LIMIT // (1024 * 1024)}MB）を超える目標サイズは指定できません")
+        return
     
-    tmpdir = tempfile.mkdtemp()
+    tmpdir = job_scratch_dir()
+    keep_tmpdir = False
+    reporter = ProgressReporter(ctx, url)
+    reservation = None
     try:
-        platform = detect_platform(url)
         out_tpl = os.path.join(tmpdir, "%(uploader)s_%(id)s.%(ext)s")
         
-        # 低画質でダウンロード
-        cmd = [
-            YTDL,
-            "-f", "worst[height<=480][ext=mp4]/worst[ext=mp4]/worst",
-            "--merge-output-format", "mp4",
-            "-o", out_tpl,
-            url,
-        ]
-
-        ck = cookie_for(url)
-        if ck and ck.is_file():
-            cmd.extend(["--cookies", str(ck)])
+        job_journal.update_current(stage="downloading")
+        opts = ytdl_options(platform, out_tpl, compress=True)
+        info = None
+        size = None
+        fitting = None
+        if PROBE_ENABLED:
+            error_msg, info = await probe_media(url, platform, dict(opts, outtmpl="-"), key)
+            if info:
+                duration = info.get("duration")
+                if duration and plan_encode(target, duration) is None:
+                    await deliver(ctx, platform, "failed", f"❌ {target_label}に収めるには動画が長すぎます（{duration:.0f}秒）: {url}")
+                    return
+                # 目標サイズに収まる単一形式があれば再エンコードせずにそれを使う
+                fitting = fitting_format(info, target)
+                if fitting:
+                    opts["format"], size = fitting
+                else:
+                    size = expected_size(info)
+        reservation = await admit_job(ctx, url, platform, job_disk_estimate(size), JOB_MEMORY_MB * 1024 * 1024)
+        if reservation is None:
+            return
+        reservation.path = tmpdir
+        before, download_start = dir_size(tmpdir), time.monotonic()
+        split = None if fitting else await download_split_streams(url, opts, platform, info, tmpdir, reporter)
+        returncode, error_msg = split or await run_ytdl(url, opts, platform, info, progress=reporter.download)
+        if returncode != 0:
+            await deliver(ctx, platform, "failed", f"❌ 圧縮ダウンロードに失敗しました{failure_reason(error_msg)}: {url}")
+            return
+        report_download_throughput(platform, dir_size(tmpdir) - before, time.monotonic() - download_start, opts)
         
-        proc = await asyncio.create_subprocess_exec(*cmd)
-        await proc.wait()
+        # 再開時に残っている前回の再エンコード途中のファイル（compressed_*）は元ファイルとして扱わない
+        media_files = sorted(
+            p for ext in ("mp4", "webm", "mkv", "mov") for p in Path(tmpdir).glob(f"*.{ext}")
+            if not p.name.startswith("compressed_")
+        )
+        if not media_files:
+            await deliver(ctx, platform, "failed", f"❌ 圧縮ダウンロードに失敗しました: {url}")
+            return
+        media_file = media_files[0]
+        if media_file.stat().st_size > target or media_file.suffix != ".mp4":
+            job_journal.update_current(stage="transcoding")
+            error_msg, media_file = await compress_to_target(
+                media_file, target, platform, (info or {}).get("duration"), progress=reporter.transcode
+            )
+            if media_file is None:
+                await deliver(ctx, platform, "failed", f"❌ 圧縮に失敗しました（{error_msg}）: {url}")
+                print(f"✖ COMPRESS FAILED: {url} - {error_msg}")
+                return
+        else:
+            media_file = await faststart_remux(media_file, platform)
         
-        if proc.returncode == 0:
-            mp4_files = list(Path(tmpdir).glob("*.mp4"))
-            
-            if mp4_files:
-                media_file = mp4_files[0]
-                file_size = media_file.stat().st_size
-                file_size_mb = file_size / (1024 * 1024)
+        file_size = media_file.stat().st_size
+        file_size_mb = file_size / (1024 * 1024)
+        drive_name = media_file.name if media_file.name.startswith("compressed_") else f"compressed_{media_file.name}"
+        
+        if drive_enabled:
+            try:
+                file_id, shareable_link = await upload_to_drive(
+                    str(media_file), drive_name, platform, progress=reporter.upload
+                )
+                media_cache.put(key, file_id, shareable_link, file_size)
                 
-                if drive_service:
-                    try:
-                        file_id, shareable_link = await upload_to_drive(
-                            str(media_file), f"compressed_{media_file.name}", platform
-                        )
-                        
-                        embed = discord.Embed(
-                            title="✅ 圧縮ダウンロード＆アップロード完了",
-                            description=f"**元URL:** {url}\n**ファイルサイズ:** {file_size_mb:.2f} MB",
-                            color=0x00ff00
-                        )
-                        embed.add_field(name="Google Drive リンク", value=f"[ファイルを開く]({shareable_link})", inline=False)
-                        embed.add_field(name="ダウンロード", value=f"[直接ダウンロード](https://drive.google.com/uc?id={file_id})", inline=False)
-                        
-                        await ctx.send(embed=embed)
-                    except Exception:
-                        discord_limit = 8 * 1024 * 1024
-                        if file_size <= discord_limit:
-                            discord_file = discord.File(str(media_file))
-                            await ctx.send(f"✅ 圧縮ダウンロード完了 ({file_size_mb:.2f}MB): {url}", file=discord_file)
-                        else:
-                            await ctx.send(f"❌ 圧縮してもファイルサイズが大きすぎます ({file_size_mb:.2f}MB)")
+                embed = discord.Embed(
+                    title="✅ 圧縮ダウンロード＆アップロード完了",
+                    description=f"**元URL:** {url}\n**ファイルサイズ:** {file_size_mb:.2f} MB（目標 {target_label}）",
+                    color=0x00ff00
+                )
+                embed.add_field(name="Google Drive リンク", value=f"[ファイルを開く]({shareable_link})", inline=False)
+                embed.add_field(name="ダウンロード", value=f"[直接ダウンロード](https://drive.google.com/uc?id={file_id})", inline=False)
+                
+                await deliver(ctx, platform, "drive", embed=embed)
+            except Exception:
+                if file_size <= DISCORD_FILE_LIMIT:
+                    discord_file = discord.File(str(media_file))
+                    await deliver(ctx, platform, "discord_fallback", f"✅ 圧縮ダウンロード完了 ({file_size_mb:.2f}MB): {url}", file=discord_file)
                 else:
-                    discord_limit = 8 * 1024 * 1024
-                    if file_size <= discord_limit:
-                        discord_file = discord.File(str(media_file))
-                        await ctx.send(f"✅ 圧縮ダウンロード完了 ({file_size_mb:.2f}MB): {url}", file=discord_file)
-                    else:
-                        await ctx.send(f"❌ 圧縮してもファイルサイズが大きすぎます ({file_size_mb:.2f}MB)")
-            else:
-                await ctx.send(f"❌ 圧縮ダウンロードに失敗しました: {url}")
+                    await deliver(ctx, platform, "failed", f"❌ Google Driveへのアップロードに失敗しました ({file_size_mb:.2f}MB): {url}")
         else:
-            await ctx.send(f"❌ 圧縮ダウンロードに失敗しました: {url}")
+            discord_file = discord.File(str(media_file))
+            await deliver(ctx, platform, "discord", f"✅ 圧縮ダウンロード完了 ({file_size_mb:.2f}MB): {url}", file=discord_file)
+    
+    except asyncio.CancelledError:
+        keep_tmpdir = True
+        raise
+    
+    except Exception as e:
+        await deliver(ctx, platform, "failed", f"❌ 圧縮処理中にエラーが発生しました: {url}")
+        print(f"✖ COMPRESS ERROR: {url} - {str(e)}")
     
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        if reservation:
+            resource_governor.release(reservation)
+        await reporter.close()
+        if not keep_tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+# スケジューラ・ジャーナルから実行するジョブの種類
+JOB_HANDLERS = {
+    "media": download_and_upload_media,
+    "image": lambda url, channel, platform: download_and_upload_image(url, channel),
+    "compress": compress_and_upload,
+}
+
+def job_handler(kind: str):
+    """種別からハンドラを取得。"compress:25" のように引数（目標サイズMB）付きの種別もある"""
+    name, _, arg = kind.partition(":")
+    if arg:
+        return partial(JOB_HANDLERS[name], target_mb=float(arg))
+    return JOB_HANDLERS[name]
+
+@bot.command(name="forget")
+async def forget_command(ctx, url: str):
+    """URLのキャッシュを削除し、次回は再ダウンロードさせるコマンド"""
+    if ctx.channel.id not in MONITORED_CHANNELS:
+        return
+    
+    route = await url_router.resolve(url)
+    platform = "image" if route.platform == "unknown" else route.platform
+    key = media_key(route.url, platform)
+    media_cache.invalidate(key)
+    media_cache.invalidate("compress:" + key)
+    await ctx.send(f"🗑️ キャッシュを削除しました: {url}")
 
 # --------------------------------------------------
 # 12. ヘルプコマンド
@@ -553,7 +4358,8 @@ async def help_command(ctx):
         name="📋 手動コマンド",
         value="`!download <URL> [platform]` - 手動ダウンロード\n"
               "`!image <URL>` - 画像ダウンロード\n"
-              "`!compress <URL>` - 圧縮ダウンロード",
+              "`!compress <URL> [MB]` - 目標サイズ（既定はDiscordの上限）に収まるよう圧縮\n"
+              "`!forget <URL>` - キャッシュを削除して再ダウンロード可能にする",
         inline=False
     )
     
@@ -568,11 +4374,74 @@ async def help_command(ctx):
 # --------------------------------------------------
 # 13. Bot起動時の処理
 # --------------------------------------------------
+startup_done = False
+warm_up_task = None
+
+def log_ready():
+    elapsed = time.monotonic() - PROCESS_START
+    STARTUP_SECONDS.labels("ready").set(elapsed)
+    print(f"起動完了まで: {elapsed:.2f}秒")
+
+def _warm_drive_blocking():
+    """Driveクライアントの生成とアクセストークンの取得（drive_executor のスレッドで実行）"""
+    worker_drive_service()
+    drive_credentials.refresh(AuthRequest(httplib2.Http(timeout=30)))
+
+async def warm_up():
+    """
+    初回のジョブを待たせないための準備（ログインを遅らせないよう起動後にバックグラウンドで行う）
+    前回の作業領域の掃除・yt-dlp常駐プロセスのインポート完了・Driveの認証・クッキー一覧の読み込み
+    """
+    global ytdl_pool
+    start = time.monotonic()
+    done = []
+    try:
+        await asyncio.to_thread(sweep_scratch_root)
+    except OSError as e:
+        print(f"作業領域の掃除エラー: {e}")
+    if ytdl_pool_warmup:
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in ytdl_pool_warmup))
+            done.append("yt-dlp")
+        except Exception as e:
+            print(f"yt-dlpプロセスプール起動エラー（subprocessを使用します）: {e}")
+            ytdl_pool = None
+    if drive_enabled:
+        try:
+            await asyncio.get_running_loop().run_in_executor(drive_executor, _warm_drive_blocking)
+            done.append("Google Drive")
+        except Exception as e:
+            print(f"⚠️ Google Driveの準備に失敗（最初のアップロード時に再試行します）: {e}")
+    await asyncio.to_thread(cookie_pool.refresh, True)
+    done.append("cookies")
+    elapsed = time.monotonic() - start
+    STARTUP_SECONDS.labels("warm").set(time.monotonic() - PROCESS_START)
+    print(f"✔ ウォームアップ完了（{', '.join(done)}）: {elapsed:.2f}秒")
+
+def start_warm_up():
+    global warm_up_task
+    if warm_up_task is None:
+        warm_up_task = asyncio.create_task(warm_up())
+
 @bot.event
 async def on_ready():
-    print(f'{bot.user} としてログインしました')
+    print(f'{bot.user} としてログインしました（ROLE={ROLE}）')
     print(f'監視チャンネル: {MONITORED_CHANNELS}')
-    print(f'Google Drive設定: {"有効" if drive_service else "無効"}')
+    print(f'Google Drive設定: {"有効" if drive_enabled else "無効"}')
+    await start_metrics_server()
+    
+    # 起動時の処理（on_readyは再接続時にも呼ばれるため一度だけ）
+    global startup_done
+    if not startup_done:
+        startup_done = True
+        log_ready()
+        if ROLE == "gateway":
+            # ジョブはworkerが実行し、結果は送信箱経由で受け取る
+            outbox_relay.start()
+        else:
+            start_warm_up()
+            # 再起動前の未完了ジョブを再開
+            await resume_journaled_jobs()
     
     # チャンネル存在確認
     for channel_id in MONITORED_CHANNELS:
@@ -586,12 +4455,25 @@ async def on_ready():
 # 14. エントリーポイント
 # --------------------------------------------------
 if __name__ == "__main__":
-    if not TOKEN:
+    if ROLE not in ("all", "gateway", "worker"):
+        print(f"❌ ROLEの値が不正です（all / gateway / worker）: {ROLE}")
+        exit(1)
+    if ROLE != "worker" and not TOKEN:
         print("❌ DISCORD_TOKEN環境変数が設定されていません")
         exit(1)
     
-    try:
-        bot.run(TOKEN)
-    except Exception as e:
-        print(f"❌ Bot起動エラー: {e}")
-        exit(1)
\ No newline at end of file
+    if ROLE != "gateway":
+        # yt-dlpの常駐プロセスはbot起動前（スレッド生成前）にforkしておく
+        start_ytdl_pool()
+    
+    if ROLE == "worker":
+        try:
+            asyncio.run(run_worker())
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            bot.run(TOKEN)
+        except Exception as e:
+            print(f"❌ Bot起動エラー: {e}")
+            exit(1)
\ No newline at end of file